@@ -0,0 +1,83 @@
+"""
+Many bots in one process on `AsyncChatClient`.
+
+`--bots` bots connect to the server from one process and are split into pairs
+chatting privately, every bot sends `--messages` messages to its partner by
+one `send_many`. The time is measured until all messages are received, the
+memory of the process is shown per bot.
+
+Run: python -m benchmarks.bench_bots [--bots 1000] [--messages 50]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+from benchmarks.bench_spill import rss_mb
+from benchmarks.bench_workers import HOST, free_port, run_server
+from client import AsyncChatClient
+from services import PRIVATE
+
+
+async def start_bot(port: int, name: str) -> AsyncChatClient:
+    bot = AsyncChatClient(HOST, port, reconnect=False)
+    for _ in range(100):  # waits for the server to start
+        try:
+            await bot.connect(name)
+            return bot
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise ConnectionError(f'The server at {port} is not available')
+
+
+async def receive(bot: AsyncChatClient, messages: int) -> None:
+    received = 0
+    async for msg in bot:
+        if msg['message'].startswith('bot '):
+            received += 1
+            if received == messages:
+                return
+
+
+async def run_bots(port: int, bots: int, messages: int) -> None:
+    rss_before = rss_mb()
+    names = [f'bot{idx}' for idx in range(bots)]
+    clients = [await start_bot(port, name) for name in names]
+    connected_rss = rss_mb()
+
+    for idx, bot in enumerate(clients):
+        await bot.change_chat(PRIVATE, names[idx ^ 1])
+    await asyncio.sleep(0.5)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.send_many(f'bot {idx}' for idx in range(messages))
+                           for bot in clients))
+    await asyncio.gather(*(receive(bot, messages) for bot in clients))
+    spent = time.perf_counter() - started
+
+    total = bots * messages
+    print(f'{bots} bots {total} messages {spent:6.2f} s {total / spent:8.0f} msg/s '
+          f'{(connected_rss - rss_before) * 1024 / bots:6.1f} KiB/bot')
+    await asyncio.gather(*(bot.close() for bot in clients))
+
+
+def run(bots: int, messages: int) -> None:
+    port = free_port()
+    process = multiprocessing.get_context('spawn').Process(target=run_server, args=(port, 1))
+    process.start()
+    try:
+        asyncio.run(run_bots(port, bots, messages))
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bots', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=50)
+    args = parser.parse_args()
+
+    run(args.bots, args.messages)
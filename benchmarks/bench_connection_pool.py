@@ -0,0 +1,109 @@
+"""
+Benchmark of `ConnectionPool.send_message` against the former linear implementation.
+
+Run: python -m benchmarks.bench_connection_pool [--clients 10000] [--messages 1000]
+"""
+import argparse
+import random
+import time
+from asyncio import BaseTransport
+from datetime import datetime
+from typing import List, Optional
+
+from services import (MessageItem, ConnectionItem, ConnectionPool, InfoMsgStatuses,
+                      CHANNEL, GENERAL, PRIVATE)
+
+
+class CountingTransport(BaseTransport):
+    def __init__(self):
+        super().__init__()
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        self.written += len(data)
+
+
+class LinearConnectionPool:
+    """
+    The list based pool as it was before indexing, kept for comparison
+    """
+
+    def __init__(self):
+        self.pool: List[ConnectionItem] = []
+
+    def add(self, con: ConnectionItem) -> None:
+        self.pool.append(con)
+
+    def change_chat(self, con: ConnectionItem, chat_type: str, chat_name: str) -> None:
+        con.current_connection_type = chat_type
+        con.current_connection_name = chat_name
+
+    def get_by_user_name(self, user_name: str) -> Optional[ConnectionItem]:
+        return next(filter(lambda x: x.user_name == user_name, self.pool), None)
+
+    def send_message(self, msg_item: MessageItem) -> None:
+        sender = self.get_by_user_name(msg_item.creator)
+        message = f'{InfoMsgStatuses.MESSAGE_FROM_SRV.value} {msg_item.serialize()}\n'.encode()
+        for conn in self.pool:
+            if conn != sender:
+                if msg_item.target(conn.current_connection_type,
+                                   conn.current_connection_name,
+                                   conn.user_name):
+                    conn.transport.write(message)
+
+
+def make_messages(clients: int, count: int) -> List[MessageItem]:
+    """
+    Every 20th message goes to the general channel, others are private ones
+    """
+
+    rnd = random.Random(count)
+    msgs = []
+    for idx in range(count):
+        creator = f'user{rnd.randrange(clients)}'
+        if idx % 20:
+            destination_type, destination_name = PRIVATE, f'user{rnd.randrange(clients)}'
+        else:
+            destination_type, destination_name = CHANNEL, GENERAL
+        msgs.append(MessageItem(uuid=str(idx), dt=datetime.now(), creator=creator,
+                                destination_type=destination_type,
+                                destination_name=destination_name,
+                                message=f'text {idx}', received_users=[]))
+    return msgs
+
+
+def run(clients: int, messages: int) -> None:
+    msgs = make_messages(clients, messages)
+
+    for pool_cls in (LinearConnectionPool, ConnectionPool):
+        rnd = random.Random(clients)
+        pool = pool_cls()
+        transports = []
+        for idx in range(clients):
+            transport = CountingTransport()
+            transports.append(transport)
+            conn = ConnectionItem(transport=transport, user_name=f'user{idx}')
+            pool.add(conn)
+
+            # One client of ten stays at the general channel, others chat privately
+            if idx % 10:
+                pool.change_chat(conn, PRIVATE, f'user{rnd.randrange(clients)}')
+
+        started = time.perf_counter()
+        for msg in msgs:
+            pool.send_message(msg)
+        spent = time.perf_counter() - started
+
+        written = sum(transport.written for transport in transports)
+        print(f'{clients:>7} clients {pool_cls.__name__:<22} '
+              f'{spent / messages * 1_000_000:10.1f} us per message, '
+              f'{written} bytes written')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=1_000)
+    args = parser.parse_args()
+
+    run(args.clients, args.messages)
@@ -0,0 +1,58 @@
+"""
+Cost of dispatching a command of a connected client in `ChatServerProtocol`.
+
+`--frames` cheap commands are fed to one connection by `data_received`: read acks
+of an empty chat and approvals of unknown messages, which do almost nothing
+besides the dispatch, then the same count of the commands with an unknown
+operator. The time per frame is shown with the cProfile profiler off and on.
+
+Run: python -m benchmarks.bench_dispatch [--frames 200000]
+"""
+import argparse
+import cProfile
+import time
+
+import server
+from benchmarks.bench_connection_pool import CountingTransport
+from services import EOS, InfoMsgStatuses
+
+
+class BenchTransport(CountingTransport):
+    def set_write_buffer_limits(self, high=None, low=None) -> None:
+        pass
+
+
+def feed(protocol: server.ChatServerProtocol, frame: bytes, count: int) -> float:
+    data = frame * 100
+    started = time.perf_counter()
+    for _ in range(count // 100):
+        protocol.data_received(data)
+    return (time.perf_counter() - started) / count * 1e9
+
+
+def run(frames: int) -> None:
+    protocol = server.ChatServerProtocol()
+    protocol.connection_made(BenchTransport())
+    protocol.data_received(b'bench' + EOS)
+
+    commands = {
+        'messages_read': InfoMsgStatuses.MESSAGES_READ.msg_bts + b' channel 1 empty' + EOS,
+        'message_approve': InfoMsgStatuses.MESSAGE_APPROVE.msg_bts
+        + b' {"uuid": "none", "user": "bench"}' + EOS,
+        'unknown': b'unknown command' + EOS,
+    }
+    for name, frame in commands.items():
+        plain = feed(protocol, frame, frames)
+        profile = cProfile.Profile()
+        profile.enable()
+        profiled = feed(protocol, frame, frames // 10)
+        profile.disable()
+        print(f'{name:>16}: {plain:6.0f} ns/frame, {profiled:6.0f} ns/frame under cProfile')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=200000)
+    args = parser.parse_args()
+
+    run(args.frames)
@@ -0,0 +1,67 @@
+"""
+Size and cost of the JSON and the compact encodings of server messages.
+
+Encoding builds the frame of a fresh message as the server does once per
+message, decoding turns the frame into the message dict as the client does.
+
+Run: python -m benchmarks.bench_encoding [--messages 100000] [--text-size 40]
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+
+from services import (MessageItem, split_command, decode_compact_message,
+                      CHANNEL, GENERAL, PRIVATE, NAME_IDS)
+
+
+def make_messages(count: int, text_size: int):
+    now = datetime.now()
+    text = 'x' * text_size
+    return [
+        MessageItem(uuid=str(uuid.uuid4()), dt=now, creator=f'user{idx % 100}',
+                    destination_type=CHANNEL if idx % 2 else PRIVATE,
+                    destination_name=GENERAL if idx % 2 else f'user{(idx + 1) % 100}',
+                    message=text, seq=idx + 1)
+        for idx in range(count)
+    ]
+
+
+def decode_json(frame: bytes) -> dict:
+    _, args = split_command(frame)
+    return json.loads(args)
+
+
+def run(count: int, text_size: int) -> None:
+    names = {name_id: NAME_IDS.name(name_id)
+             for msg in make_messages(200, 0) for name_id in msg.name_ids()}
+
+    for encoding, encode, decode in (
+        ('json', MessageItem.frame, decode_json),
+        ('compact', MessageItem.compact_frame,
+         lambda frame: decode_compact_message(split_command(frame)[1], names)),
+    ):
+        msgs = make_messages(count, text_size)
+        started = time.perf_counter()
+        frames = [encode(msg) for msg in msgs]
+        encode_spent = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        decode_spent = time.perf_counter() - started
+
+        size = sum(map(len, frames)) / count
+        print(f'{encoding:>8} {size:8.1f} bytes/message, '
+              f'encode {encode_spent / count * 1e6:6.2f} us, '
+              f'decode {decode_spent / count * 1e6:6.2f} us')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--text-size', type=int, default=40)
+    args = parser.parse_args()
+
+    run(args.messages, args.text_size)
@@ -0,0 +1,152 @@
+"""
+Restart of the server with and without the handover.
+
+`--clients` reconnecting clients (`AsyncChatClient`) are connected and each
+of them has written a message to the general channel, the server keeps them in
+the message log. Without the handover the server is stopped and started again,
+with it a new process takes the sockets and the state over, then the old one exits.
+
+A prober connects every 10 ms: the longest time between two greetings of the
+server shows how long new connections wait. When the old process is gone, a
+client writes a message and the time is measured until every client gets it.
+Reconnects and bytes received by the clients meanwhile show the reconnect storm.
+
+Run: python -m benchmarks.bench_handover [--clients 500]
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from benchmarks.bench_workers import HOST, free_port
+from client import AsyncChatClient, LibraryProtocol
+from server import Server
+
+
+class CountingProtocol(LibraryProtocol):
+    def data_received(self, data):
+        self.client.bytes_received += len(data)
+        super().data_received(data)
+
+
+class BenchClient(AsyncChatClient):
+    protocol_class = CountingProtocol
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_received = 0
+
+
+def run_server(port: int, data_dir: str, handover_path: str, takeover: bool) -> None:
+    Server(HOST, port, data_dir=data_dir, handover_path=handover_path, takeover=takeover).listen()
+
+
+class Prober:
+    """
+    Connects to the server in a loop, remembers the longest wait for the greeting
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.longest_gap = 0.0
+        self.running = True
+
+    async def run(self) -> None:
+        last_greeting = time.perf_counter()
+        while self.running:
+            with contextlib.suppress(OSError):
+                reader, writer = await asyncio.open_connection(HOST, self.port)
+                with contextlib.suppress(OSError):
+                    if await reader.readline():
+                        now = time.perf_counter()
+                        self.longest_gap = max(self.longest_gap, now - last_greeting)
+                        last_greeting = now
+                writer.close()
+            await asyncio.sleep(0.01)
+
+
+async def receive(client: AsyncChatClient, text: str) -> None:
+    async for msg in client:
+        if msg['message'] == text:
+            return
+
+
+async def restart(port: int, clients_count: int, handover: bool, start_server) -> None:
+    old = start_server(takeover=False)
+    clients = [BenchClient(HOST, port) for _ in range(clients_count)]
+    for _ in range(100):  # waits for the server to start
+        try:
+            await clients[0].connect('client0')
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    for idx, client in enumerate(clients[1:], 1):
+        await client.connect(f'client{idx}')
+    for idx, client in enumerate(clients):
+        await client.send(f'message {idx}')
+    await receive(clients[0], f'message {clients_count - 1}')
+
+    for client in clients:
+        client.bytes_received = 0
+    prober = Prober(port)
+    probing = asyncio.create_task(prober.run())
+    await asyncio.sleep(0.1)
+
+    if handover:
+        new = start_server(takeover=True)
+        while old.is_alive():
+            await asyncio.sleep(0.01)
+    else:
+        os.kill(old.pid, signal.SIGINT)
+        while old.is_alive():
+            await asyncio.sleep(0.01)
+        new = start_server(takeover=False)
+
+    started = time.perf_counter()
+    await clients[0].send('after restart')
+    await asyncio.gather(*(receive(client, 'after restart') for client in clients[1:]))
+    spent = time.perf_counter() - started
+    prober.running = False
+    await probing
+
+    print(f'{"handover" if handover else "restart":>9} {clients_count} clients: '
+          f'greeting gap {prober.longest_gap * 1000:7.0f} ms, '
+          f'delivery {spent * 1000:7.0f} ms, '
+          f'reconnects {sum(client.reconnects for client in clients):5}, '
+          f'{sum(client.bytes_received for client in clients) / 1024:8.0f} KiB received')
+
+    await asyncio.gather(*(client.close() for client in clients))
+    os.kill(new.pid, signal.SIGINT)
+    new.join()
+
+
+def run(clients: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    for handover in (False, True):
+        port = free_port()
+        data_dir = tempfile.mkdtemp(prefix='chat-log-')
+        handover_path = os.path.join(data_dir, 'handover.sock')
+
+        def start_server(takeover: bool):
+            process = context.Process(target=run_server,
+                                      args=(port, data_dir, handover_path, takeover))
+            process.start()
+            return process
+
+        try:
+            asyncio.run(restart(port, clients, handover, start_server))
+        finally:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=500)
+    args = parser.parse_args()
+
+    run(args.clients)
@@ -0,0 +1,144 @@
+"""
+Throughput of the HTTP API against the TCP protocol.
+
+Clients are split into pairs chatting privately like in `bench_workers`.
+Over HTTP every client sends its messages as pipelined `POST /send`
+requests on one keep-alive connection and receives them by long polling
+`GET /messages` on another one.
+
+Run: python -m benchmarks.bench_http [--clients 100] [--messages 200] [--pipeline 16]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+
+from server import Server
+from benchmarks.bench_workers import HOST, free_port, chat
+
+
+def run_server(port: int, http_port: int) -> None:
+    Server(HOST, port, data_dir=None, http_port=http_port).listen()
+
+
+class HttpConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, port: int) -> 'HttpConnection':
+        for _ in range(100):
+            try:
+                return cls(*await asyncio.open_connection(HOST, port))
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise ConnectionError(f'The server at {port} is not available')
+
+    def send(self, method: str, path: str, data=None, token=None) -> None:
+        body = json.dumps(data).encode() if data is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n'
+        if token:
+            head += f'Authorization: Bearer {token}\r\n'
+        self.writer.write(head.encode() + b'\r\n' + body)
+
+    async def response(self) -> dict:
+        await self.reader.readline()
+        headers = {}
+        while (line := await self.reader.readline()).strip():
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            return json.loads(await self.reader.readexactly(int(headers['content-length'])))
+        body = b''
+        while size := int(await self.reader.readline(), 16):
+            body += await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+        await self.reader.readexactly(2)
+        return json.loads(body)
+
+    async def call(self, method: str, path: str, data=None, token=None) -> dict:
+        self.send(method, path, data, token)
+        return await self.response()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+async def http_chat(port: int, clients: int, messages: int, pipeline: int) -> float:
+    names = [f'http{idx}' for idx in range(clients)]
+    senders = [await HttpConnection.open(port) for _ in names]
+    pollers = [await HttpConnection.open(port) for _ in names]
+
+    sessions = []
+    for idx, (name, conn) in enumerate(zip(names, senders)):
+        session = await conn.call('POST', '/connect', {'name': name})
+        await conn.call('POST', '/chat', {'type': 'private', 'name': names[idx ^ 1]},
+                        session['token'])
+        sessions.append(session)
+
+    async def send(conn: HttpConnection, token: str) -> None:
+        for start in range(0, messages, pipeline):
+            batch = range(start, min(start + pipeline, messages))
+            for idx in batch:
+                conn.send('POST', '/send', {'text': f'text {idx}'}, token)
+            for _ in batch:
+                await conn.response()
+
+    async def receive(conn: HttpConnection, session: dict) -> None:
+        received = 0
+        last = (await conn.call('GET', f'/messages?since={session["last"]}&timeout=0',
+                                token=session['token']))['last']
+        while received < messages:
+            answer = await conn.call('GET', f'/messages?since={last}', token=session['token'])
+            received += sum(event['type'] == 'message_from_srv' for event in answer['events'])
+            last = answer['last']
+
+    receivers = [asyncio.create_task(receive(conn, session))
+                 for conn, session in zip(pollers, sessions)]
+    await asyncio.sleep(0.1)  # the receivers drain the handshake events
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(conn, session['token'])
+                           for conn, session in zip(senders, sessions)))
+    await asyncio.gather(*receivers)
+    spent = time.perf_counter() - started
+
+    for conn in senders + pollers:
+        conn.close()
+    return spent
+
+
+def run(clients: int, messages: int, pipeline: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    port = http_port = free_port()
+    while http_port == port:
+        http_port = free_port()
+    process = context.Process(target=run_server, args=(port, http_port))
+    process.start()
+    total = clients * messages
+    try:
+        for name, spent in (
+            ('tcp', asyncio.run(chat(port, clients, messages))),
+            ('http', asyncio.run(http_chat(http_port, clients, messages, pipeline))),
+        ):
+            print(f'{name:>5} {clients:>6} clients '
+                  f'{total / spent:12.0f} messages/s, {spent:.2f} s')
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--pipeline', type=int, default=16,
+                        help='requests sent by a client before reading the responses')
+    args = parser.parse_args()
+
+    run(args.clients, args.messages, args.pipeline)
@@ -0,0 +1,93 @@
+"""
+Stalls of the event loop by logging to a slow stream.
+
+The stream sleeps `--write-ms` on every write, like a full pipe or a busy disk.
+The loop logs `--records` records by bursts of 10 while a ticker measures how
+late its 1 ms timer fires. The records go to the stream by the handler of
+`logging.basicConfig` and then by `LogPipeline`.
+
+Run: python -m benchmarks.bench_logging [--records 2000] [--write-ms 1]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import time
+
+from logs import LogPipeline
+from services import LOG_FORMAT
+
+
+class SlowStream(io.StringIO):
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return super().write(text)
+
+
+async def measure(records: int) -> dict:
+    logger = logging.getLogger()
+    lags = []
+    running = True
+
+    async def tick():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    ticker = asyncio.create_task(tick())
+    spent = 0.0
+    for idx in range(0, records, 10):
+        started = time.perf_counter()
+        for record in range(idx, idx + 10):
+            logger.info(f'Has been deleted delivered messages ({record})',
+                        extra={'category': 'expiry'})
+        spent += time.perf_counter() - started
+        await asyncio.sleep(0.001)
+    running = False
+    await ticker
+
+    lags.sort()
+    return {'spent': spent, 'p99': lags[int(len(lags) * 0.99)], 'max': lags[-1]}
+
+
+def report(name: str, result: dict, extra: str = '') -> None:
+    print(f'{name:>12}: {result["spent"] * 1000:8.1f} ms in logging calls, loop lag '
+          f'p99 {result["p99"] * 1000:6.2f} ms, max {result["max"] * 1000:6.2f} ms{extra}')
+
+
+def run(records: int, write_ms: float) -> None:
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    try:
+        direct = logging.StreamHandler(SlowStream(write_ms / 1000))
+        direct.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(direct)
+        report('direct', asyncio.run(measure(records)))
+        root.removeHandler(direct)
+
+        pipeline = LogPipeline(SlowStream(write_ms / 1000), sampling={})
+        pipeline.start()
+        result = asyncio.run(measure(records))
+        dropped = pipeline.dropped
+        pipeline.stop()
+        report('pipeline', result, f', {dropped} dropped')
+    finally:
+        for handler in handlers:
+            root.addHandler(handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--write-ms', type=float, default=1)
+    args = parser.parse_args()
+
+    run(args.records, args.write_ms)
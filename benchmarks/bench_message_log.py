@@ -0,0 +1,73 @@
+"""
+Write throughput of the message log with batched fsync and the time to restore it.
+
+Run: python -m benchmarks.bench_message_log [--size 1000000] [--path /tmp/chat-log]
+"""
+import argparse
+import asyncio
+import shutil
+import time
+import uuid
+from datetime import datetime
+
+from services import MessageItem, MessagePool, ConnectionPool, CHANNEL, GENERAL
+from storage import MessageLog
+
+
+async def write(path: str, size: int, fsync_interval: float) -> None:
+    log = MessageLog(path, fsync_interval=fsync_interval)
+    flushing = asyncio.create_task(log.flushing())
+
+    started = time.perf_counter()
+    for idx in range(size):
+        msg = MessageItem(uuid=str(uuid.uuid4()), dt=datetime.now(), creator=f'user{idx % 1000}',
+                          destination_type=CHANNEL, destination_name=GENERAL,
+                          message=f'message number {idx}', received_users=[], seq=idx + 1)
+        log.message_added(msg)
+        log.message_received(msg, 'reader')
+        if idx % 1000 == 0:
+            # Clients are served meanwhile
+            await asyncio.sleep(0)
+    await log.flush()
+    spent = time.perf_counter() - started
+
+    flushing.cancel()
+    log.close()
+    print(f'fsync every {fsync_interval * 1000:5.0f} ms: '
+          f'{log.written_records / spent:10.0f} records/s, {log.fsync_count} fsyncs')
+
+
+def restore(path: str) -> MessagePool:
+    msg_pool = MessagePool()
+    started = time.perf_counter()
+    records_cnt, msgs_cnt = MessageLog(path).restore(msg_pool, ConnectionPool())
+    spent = time.perf_counter() - started
+    print(f'restored {msgs_cnt} messages from {records_cnt} records in {spent:.2f} s')
+    return msg_pool
+
+
+async def compact(path: str, msg_pool: MessagePool) -> None:
+    log = MessageLog(path)
+    log.restore(MessagePool(), ConnectionPool())
+    started = time.perf_counter()
+    await log.compact(msg_pool, ConnectionPool())
+    print(f'compacted to a snapshot in {time.perf_counter() - started:.2f} s')
+    log.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--path', default='/tmp/chat-message-log')
+    args = parser.parse_args()
+
+    for interval in (0.01, 0.05, 0.2):
+        shutil.rmtree(args.path, ignore_errors=True)
+        asyncio.run(write(args.path, args.size // 10, interval))
+
+    shutil.rmtree(args.path, ignore_errors=True)
+    asyncio.run(write(args.path, args.size, 0.05))
+    pool = restore(args.path)
+    asyncio.run(compact(args.path, pool))
+    restore(args.path)
+    shutil.rmtree(args.path, ignore_errors=True)
@@ -0,0 +1,99 @@
+"""
+Memory used by retained messages, measured with tracemalloc.
+
+The last case gives the messages more readers than fit into the tuple of receipts,
+and the readers have the ids of a server which has seen `--known-users` users.
+
+Run: python -m benchmarks.bench_message_memory [--size 1000000] [--readers 3]
+                                               [--known-users 100000]
+"""
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List
+
+from services import MessageItem, CHANNEL, GENERAL, RECEIPTS_TUPLE_LIMIT, USER_IDS
+
+USERS = [f'user{idx}' for idx in range(1000)]
+HIGH_ID_USERS: List[str] = []  # registered after `--known-users` other users
+
+
+@dataclass
+class LegacyMessageItem:
+    """
+    The message as it was before `__slots__` and read receipts by ids, kept for comparison
+    """
+    uuid: str
+    dt: datetime
+    creator: str
+    destination_type: str
+    destination_name: str
+    message: str
+    received_users: List
+
+
+def make_legacy(idx: int, readers: int) -> LegacyMessageItem:
+    return LegacyMessageItem(uuid=f'{idx:036}', dt=datetime.now(),
+                             # Names come from the network, so every message has its own copy
+                             creator=''.join(USERS[idx % len(USERS)]),
+                             destination_type=''.join(CHANNEL),
+                             destination_name=''.join(GENERAL),
+                             message=f'message number {idx}',
+                             received_users=[''.join(user) for user in USERS[:readers]])
+
+
+def make_compact(idx: int, readers: int) -> MessageItem:
+    return MessageItem(uuid=f'{idx:036}', dt=datetime.now(),
+                       creator=''.join(USERS[idx % len(USERS)]),
+                       destination_type=''.join(CHANNEL),
+                       destination_name=''.join(GENERAL),
+                       message=f'message number {idx}',
+                       received_users=[''.join(user) for user in USERS[:readers]])
+
+
+def make_high_ids(idx: int, readers: int) -> MessageItem:
+    return MessageItem(uuid=f'{idx:036}', dt=datetime.now(),
+                       creator=''.join(USERS[idx % len(USERS)]),
+                       destination_type=''.join(CHANNEL),
+                       destination_name=''.join(GENERAL),
+                       message=f'message number {idx}',
+                       received_users=HIGH_ID_USERS[-readers:])
+
+
+def measure(factory: Callable, size: int, readers: int, with_frame: bool = False) -> int:
+    tracemalloc.start()
+    items = [factory(idx, readers) for idx in range(size)]
+    if with_frame:
+        for item in items:
+            item.frame()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return current
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--readers', type=int, default=3)
+    parser.add_argument('--known-users', type=int, default=100_000)
+    args = parser.parse_args()
+
+    for user in USERS:
+        USER_IDS.get_or_create(user)
+    HIGH_ID_USERS.extend(f'known{idx}' for idx in range(args.known_users))
+    for user in HIGH_ID_USERS:
+        USER_IDS.get_or_create(user)
+    high_readers = max(args.readers, RECEIPTS_TUPLE_LIMIT + 2)
+
+    for title, factory, with_frame, readers in (
+            ('legacy dataclass', make_legacy, False, args.readers),
+            ('compact', make_compact, False, args.readers),
+            ('compact with cached frame', make_compact, True, args.readers),
+            (f'legacy, {high_readers} readers', make_legacy, False, high_readers),
+            (f'high ids, {high_readers} readers', make_high_ids, False, high_readers),
+    ):
+        used = measure(factory, args.size, readers, with_frame)
+        print(f'{args.size:>9} messages {title:<26} {used / 2 ** 20:9.1f} MiB '
+              f'{used / args.size:7.1f} bytes per message')
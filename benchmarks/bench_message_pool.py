@@ -0,0 +1,122 @@
+"""
+Benchmark of `MessagePool` lookups against the former linear implementation.
+
+Run: python -m benchmarks.bench_message_pool [--sizes 10000 100000 1000000]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from services import MessageItem, MessagePool, CHANNEL, GENERAL, PRIVATE
+
+USERS = [f'user{idx}' for idx in range(100)]
+READER = 'reader'
+UNREAD_TAIL = 20  # the reader has not seen the last messages of every chat
+
+
+class LinearMessagePool:
+    """
+    The list based pool as it was before indexing, kept for comparison
+    """
+
+    def __init__(self):
+        self.pool: List[MessageItem] = []
+
+    def add(self, msg: MessageItem):
+        self.pool.append(msg)
+
+    def get_message_by_uuid(self, uuid: str) -> Optional[MessageItem]:
+        return next(filter(lambda msg: msg.uuid == uuid, self.pool), None)
+
+    def get_messages(self, destination_type=CHANNEL, destination_name=GENERAL,
+                     not_received_user=None, creator=None, not_from_creator=None):
+        now = time.time()
+        msgs = filter(lambda msg: msg.ts < now, self.pool)
+        if creator:
+            msgs = filter(lambda msg: msg.creator == creator, msgs)
+        if destination_type:
+            msgs = filter(lambda msg: msg.destination_type == destination_type, msgs)
+        if destination_name:
+            msgs = filter(lambda msg: msg.destination_name == destination_name, msgs)
+        if not_received_user:
+            msgs = filter(lambda msg: not msg.is_received_by(not_received_user), msgs)
+        if not_from_creator:
+            msgs = filter(lambda msg: not_from_creator != msg.creator, msgs)
+        return list(msgs)
+
+
+def make_messages(size: int) -> List[MessageItem]:
+    """
+    Every 10th message is a private one, the reader has received all but the tail
+    """
+
+    rnd = random.Random(size)
+    start = datetime.now() - timedelta(minutes=5)
+    msgs = []
+    for idx in range(size):
+        creator = rnd.choice(USERS)
+        if idx % 10:
+            destination_type, destination_name = CHANNEL, GENERAL
+        else:
+            destination_type, destination_name = PRIVATE, READER
+        received = [READER] if idx < size - UNREAD_TAIL else []
+        msgs.append(MessageItem(uuid=f'uuid-{idx}', dt=start, creator=creator,
+                                destination_type=destination_type,
+                                destination_name=destination_name,
+                                message=f'text {idx}', received_users=received))
+    return msgs
+
+
+def measure(func: Callable, repeat: int) -> float:
+    """
+    Average time of one call in milliseconds
+    """
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def run(size: int) -> None:
+    msgs = make_messages(size)
+    uuids = [msg.uuid for msg in random.Random(0).sample(msgs, 100)]
+
+    for pool_cls in (LinearMessagePool, MessagePool):
+        pool = pool_cls()
+        for msg in msgs:
+            pool.add(msg)
+
+        def channel_unread():
+            return pool.get_messages(destination_type=CHANNEL, destination_name=GENERAL,
+                                     not_received_user=READER, not_from_creator=READER)
+
+        def private_unread():
+            return pool.get_messages(destination_type=PRIVATE, destination_name=READER,
+                                     creator=USERS[0], not_received_user=READER,
+                                     not_from_creator=READER)
+
+        # The first query of a user moves the read cursor over the history
+        first = measure(channel_unread, 1)
+
+        repeat = max(3, 100_000 // size)
+        lookup = measure(lambda: [pool.get_message_by_uuid(uuid) for uuid in uuids], repeat) / 100
+        channel = measure(channel_unread, repeat)
+        private = measure(private_unread, repeat)
+
+        print(f'{size:>9} {pool_cls.__name__:<18} '
+              f'uuid lookup {lookup:8.4f} ms  '
+              f'first unread {first:9.4f} ms  '
+              f'channel unread {channel:9.4f} ms  '
+              f'private unread {private:9.4f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    for pool_size in args.sizes:
+        run(pool_size)
@@ -0,0 +1,116 @@
+"""
+Bandwidth and time of the history replay with and without compressed batches.
+
+Readers connect first, then a writer posts `--messages` messages to a channel.
+Every reader switches to the channel and gets the whole backlog, the time is
+measured until the last message is received and decoded. Over the loopback the
+bandwidth is almost free, so the time to transfer the backlog over a link of
+`--link-mbit` is shown as well.
+
+Run: python -m benchmarks.bench_replay [--messages 10000] [--link-mbit 10]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+
+from benchmarks.bench_workers import HOST, free_port, run_server, connect
+from services import InfoMsgStatuses, split_command, decode_compact_message, EOS
+
+CHANNEL_NAME = 'bulk'
+READERS = (
+    ('json', ''),
+    ('compact', 'compact'),
+    ('compact zlib', 'compact zlib'),
+)
+
+
+async def open_reader(port: int, name: str, options: str):
+    if not options:
+        return await connect(port, name)
+
+    reader, writer = await asyncio.open_connection(HOST, port)
+    await reader.readline()  # choose_name
+    writer.write(f'encoding {options}\n{name}\n'.encode())
+    await reader.readline()  # encoding
+    await reader.readline()  # name_accepted
+    return reader, writer
+
+
+def decode(frame: bytes, names: dict) -> int:
+    """
+    Decode the messages of the frame as the client does, return their count
+    """
+
+    operator, args = split_command(frame)
+    if operator is InfoMsgStatuses.MESSAGE_FROM_SRV:
+        json.loads(args)
+    elif operator is InfoMsgStatuses.COMPACT_MESSAGE:
+        decode_compact_message(args, names)
+    elif operator is InfoMsgStatuses.NAME_ID:
+        name_id, name = args.split(b' ', 1)
+        names[int(name_id)] = name.decode()
+        return 0
+    elif operator is InfoMsgStatuses.MESSAGE_BATCH:
+        _, data = args.split(b' ', 1)
+        frames = zlib.decompress(base64.b64decode(data)).split(EOS)
+        return sum(decode(batch_frame, names) for batch_frame in frames if batch_frame)
+    else:
+        return 0
+    return 1
+
+
+async def replay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 messages: int):
+    writer.write(f'change_chat channel {CHANNEL_NAME}\n'.encode())
+    started = time.perf_counter()
+    received = size = 0
+    names = {}
+    while received < messages:
+        line = await reader.readline()
+        size += len(line)
+        received += decode(line, names)
+    return time.perf_counter() - started, size
+
+
+async def run_replay(port: int, messages: int, link_mbit: float) -> None:
+    _, writer = await connect(port, 'writer')  # waits for the server to start
+    readers = [await open_reader(port, f'reader{idx}', options)
+               for idx, (_, options) in enumerate(READERS)]
+    writer.write(f'change_chat channel {CHANNEL_NAME}\n'.encode())
+    writer.writelines(f'message_from_client message number {idx}\n'.encode()
+                      for idx in range(messages))
+    await writer.drain()
+    await asyncio.sleep(1)  # the server handles the messages
+
+    for (label, _), (reader, reader_writer) in zip(READERS, readers):
+        spent, size = await replay(reader, reader_writer, messages)
+        print(f'{label:>13} {size / 1024:10.1f} KiB {size / messages:8.1f} bytes/message '
+              f'{spent:8.3f} s, {size * 8 / link_mbit / 1e6:8.3f} s over {link_mbit} Mbit/s')
+        reader_writer.close()
+    writer.close()
+
+
+def run(messages: int, link_mbit: float) -> None:
+    port = free_port()
+    process = multiprocessing.get_context('spawn').Process(target=run_server, args=(port, 1))
+    process.start()
+    try:
+        asyncio.run(run_replay(port, messages, link_mbit))
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--link-mbit', type=float, default=10)
+    args = parser.parse_args()
+
+    run(args.messages, args.link_mbit)
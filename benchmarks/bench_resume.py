@@ -0,0 +1,114 @@
+"""
+Traffic and time of a mass reconnect with and without the client cache.
+
+`--clients` clients read the messages of the general channel, then all their
+links break before the read acks are sent and the clients reconnect at once.
+Without the cache every client gets the last `INIT_MSGS_CNT` messages again,
+with it the client sends the resume token and gets only newer messages.
+
+Run: python -m benchmarks.bench_resume [--clients 500]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from typing import Tuple
+
+from benchmarks.bench_workers import HOST, free_port, run_server, connect
+from client import ChatClientProtocol
+from services import INIT_MSGS_CNT, AVAILABLE_MSGS
+
+WRITERS = 5
+
+
+class BenchClient(ChatClientProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_received = 0
+        self.messages = 0
+
+    def data_received(self, data):
+        self.bytes_received += len(data)
+        super().data_received(data)
+
+    def message_received(self, msg: dict) -> None:
+        self.messages += 1
+        super().message_received(msg)
+
+
+async def join(port: int, name: str, cache_dir) -> BenchClient:
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_connection(
+        lambda: BenchClient(loop.create_future(), loop.create_future(), cache_dir=cache_dir),
+        HOST, port)
+    await client.name_offered
+    client.transport.write(client.name_frames(name))
+    await client.on_name_chosen
+    return client
+
+
+async def wait_messages(clients, count: int) -> None:
+    while any(client.messages < count for client in clients):
+        await asyncio.sleep(0.01)
+
+
+async def reconnect(port: int, clients_count: int, cache_dir) -> Tuple[int, float]:
+    writers = [await connect(port, f'writer{idx}')  # waits for the server to start
+               for idx in range(WRITERS)]
+    names = [f'reader{idx}' for idx in range(clients_count)]
+    clients = [await join(port, name, cache_dir) for name in names]
+
+    for _, writer in writers:
+        writer.writelines(f'message_from_client text {msg}\n'.encode()
+                          for msg in range(AVAILABLE_MSGS))
+    await wait_messages(clients, WRITERS * AVAILABLE_MSGS)
+
+    for client in clients:
+        if client.read_ack_handle:
+            client.read_ack_handle.cancel()
+        client.transport.abort()
+    await asyncio.sleep(0.5)
+
+    started = time.perf_counter()
+    clients = await asyncio.gather(*(join(port, name, cache_dir) for name in names))
+    expected = 0 if cache_dir else INIT_MSGS_CNT
+    await wait_messages(clients, expected)
+    spent = time.perf_counter() - started
+
+    for client in clients:
+        client.transport.close()
+    for _, writer in writers:
+        writer.close()
+    return sum(client.bytes_received for client in clients), spent
+
+
+def run(clients: int) -> None:
+    for with_cache in (False, True):
+        port = free_port()
+        process = multiprocessing.get_context('spawn').Process(target=run_server, args=(port, 1))
+        process.start()
+        cache_dir = tempfile.mkdtemp(prefix='chat-cache-') if with_cache else None
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # the clients print messages
+                size, spent = asyncio.run(reconnect(port, clients, cache_dir))
+            print(f'{"cache" if with_cache else "no cache":>9} {clients} clients '
+                  f'{size / clients:8.0f} bytes/client {spent:6.2f} s')
+        finally:
+            os.kill(process.pid, signal.SIGINT)
+            process.join()
+            if cache_dir:
+                shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=500)
+    args = parser.parse_args()
+
+    run(args.clients)
@@ -0,0 +1,79 @@
+"""
+Memory of the message pool under a long workload with and without the budget.
+
+Every simulated minute users post `--channel-rate` messages to the channel,
+each one is read and expires an hour later, and `--private-rate` private
+messages to users who never come back, nobody receives them. The clock of
+`services` is simulated, so a week passes in seconds. Without a budget the
+private messages pile up in memory, with it they are spilled to disk.
+
+Run: python -m benchmarks.bench_spill [--days 7] [--budget-mb 8]
+"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+import types
+import uuid
+from datetime import datetime
+
+import services
+from services import MessageItem, MessagePool, CHANNEL, GENERAL, PRIVATE
+from storage import open_spill_store
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def run_week(days: int, budget: int, channel_rate: int, private_rate: int) -> None:
+    start = datetime(2023, 1, 1).timestamp()
+    clock = types.SimpleNamespace(now=start)
+    services.time = types.SimpleNamespace(time=lambda: clock.now, perf_counter=time.perf_counter)
+
+    msg_pool = MessagePool(memory_budget=budget or None)
+    spill_dir = tempfile.mkdtemp(prefix='chat-spill-')
+    store = open_spill_store(spill_dir, msg_pool)
+
+    started = time.perf_counter()
+    for minute in range(days * MINUTES_PER_DAY):
+        clock.now = start + minute * 60
+        dt = datetime.fromtimestamp(clock.now)
+        for idx in range(channel_rate):
+            msg = MessageItem(str(uuid.uuid4()), dt, f'user{idx}', CHANNEL, GENERAL,
+                              f'message {minute} {idx}')
+            msg_pool.add(msg)
+            msg_pool.mark_received(msg, f'user{idx + 1}')
+        for idx in range(private_rate):
+            msg_pool.add(MessageItem(str(uuid.uuid4()), dt, f'user{idx}', PRIVATE,
+                                     f'gone{minute}', f'private {minute} {idx}'))
+        msg_pool.delete_delivered_messages()
+
+        if (minute + 1) % MINUTES_PER_DAY == 0:
+            gc.collect()
+            print(f'{"budget" if budget else "no budget":>10} day {(minute + 1) // 1440} '
+                  f'{msg_pool.count:9} messages {msg_pool.resident_count:8} resident '
+                  f'{msg_pool.resident_bytes / 1024 / 1024:7.1f} MiB estimated '
+                  f'{rss_mb():7.1f} MiB RSS {time.perf_counter() - started:6.1f} s')
+
+    if store:
+        store.close()
+    os.rmdir(spill_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--budget-mb', type=float, default=8)
+    parser.add_argument('--channel-rate', type=int, default=20, help='messages per minute')
+    parser.add_argument('--private-rate', type=int, default=10, help='messages per minute')
+    parser.add_argument('--no-budget', action='store_true',
+                        help='run without the budget for comparison')
+    args = parser.parse_args()
+
+    budget = 0 if args.no_budget else int(args.budget_mb * 1024 * 1024)
+    run_week(args.days, budget, args.channel_rate, args.private_rate)
@@ -0,0 +1,70 @@
+"""
+Timeouts of many idle connections: `TimerWheel` against a `call_later` per connection.
+
+`--connections` keys get a timeout, which is then moved `--moves` times, like
+a heartbeat check of a connection which keeps talking. The time and the memory
+of the timers are shown, and the cost of one tick of the wheel when nothing
+expires and when every key expires at once.
+
+Run: python -m benchmarks.bench_timers [--connections 100000] [--moves 3]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from services import TimerWheel
+
+
+class Connection:
+    __slots__ = ('handle',)
+
+    def __init__(self):
+        self.handle = None
+
+
+def measure(name: str, schedule, connections: int, moves: int) -> None:
+    conns = [Connection() for _ in range(connections)]
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(moves + 1):
+        for conn in conns:
+            schedule(conn)
+    spent = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{name:>12}: {spent / connections / (moves + 1) * 1e9:6.0f} ns per schedule, '
+          f'{memory / connections:6.0f} bytes per connection')
+
+
+async def run_timers(connections: int, moves: int) -> None:
+    loop = asyncio.get_running_loop()
+
+    def call_later(conn: Connection) -> None:
+        if conn.handle:
+            conn.handle.cancel()
+        conn.handle = loop.call_later(30, lambda: None)
+
+    measure('call_later', call_later, connections, moves)
+
+    wheel = TimerWheel(lambda key: None)
+    measure('TimerWheel', lambda conn: wheel.schedule(conn, 30), connections, moves)
+
+    started = time.perf_counter()
+    wheel.advance()
+    idle = time.perf_counter() - started
+    for _ in range(28):  # up to the tick before the deadline
+        wheel.advance()
+    started = time.perf_counter()
+    expired = wheel.advance()
+    print(f'{"tick":>12}: {idle * 1e6:6.0f} us with nothing expired, '
+          f'{(time.perf_counter() - started) * 1000:6.1f} ms for {expired} expired')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--moves', type=int, default=3)
+    args = parser.parse_args()
+
+    asyncio.run(run_timers(args.connections, args.moves))
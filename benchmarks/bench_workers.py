@@ -0,0 +1,104 @@
+"""
+Throughput of the server with one and several worker processes.
+
+Clients are split into pairs chatting privately, every client sends
+`--messages` messages to its partner. The time is measured until all
+messages are received.
+
+Run: python -m benchmarks.bench_workers [--workers 1 2 4] [--clients 200] [--messages 200]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from server import Server
+
+HOST = '127.0.0.1'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def run_server(port: int, workers: int) -> None:
+    Server(HOST, port, data_dir=None, workers=workers).listen()
+
+
+async def connect(port: int, name: str):
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection(HOST, port)
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    else:
+        raise ConnectionError(f'The server at {port} is not available')
+
+    await reader.readline()  # choose_name
+    writer.write(f'{name}\n'.encode())
+    await reader.readline()  # name_accepted
+    return reader, writer
+
+
+async def chat(port: int, clients: int, messages: int) -> float:
+    names = [f'user{idx}' for idx in range(clients)]
+    connections = [await connect(port, name) for name in names]
+
+    for idx, (reader, writer) in enumerate(connections):
+        partner = names[idx ^ 1]
+        writer.write(f'change_chat private {partner}\n'.encode())
+        await reader.readline()
+
+    async def receive(reader) -> None:
+        received = 0
+        while received < messages:
+            line = await reader.readline()
+            if line.startswith(b'message_from_srv'):
+                received += 1
+
+    started = time.perf_counter()
+    receivers = [asyncio.create_task(receive(reader)) for reader, _ in connections]
+    for idx in range(messages):
+        for _, writer in connections:
+            writer.write(f'message_from_client text {idx}\n'.encode())
+        await asyncio.sleep(0)
+    await asyncio.gather(*receivers)
+    spent = time.perf_counter() - started
+
+    for _, writer in connections:
+        writer.close()
+    return spent
+
+
+def run(workers_list, clients: int, messages: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    total = clients * messages
+    for workers in workers_list:
+        port = free_port()
+        process = context.Process(target=run_server, args=(port, workers))
+        process.start()
+        try:
+            spent = asyncio.run(chat(port, clients, messages))
+        finally:
+            # The server stops its workers on Ctrl+C
+            os.kill(process.pid, signal.SIGINT)
+            process.join()
+
+        print(f'{workers:>3} workers {clients:>6} clients '
+              f'{total / spent:12.0f} messages/s, {spent:.2f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    run(args.workers, args.clients, args.messages)
@@ -0,0 +1,395 @@
+"""
+Load test of the chat server speaking its real protocol.
+
+Simulated clients choose a name, switch to their chat, send messages at the
+given rate and acknowledge what they read. Most clients chat privately by
+pairs, `--general-share` of them stay at the general channel (a client can
+send only `AVAILABLE_MSGS` messages there, see the settings). Before the load
+`--probes` clients connect one by one to measure how long the history replay
+takes.
+
+The result is printed as JSON and may be saved with `--output`; `--compare`
+checks the run against a saved result and exits with 1 on a regression.
+
+Run: python -m benchmarks.load_test [--mode subprocess|inprocess] [--clients 1000]
+         [--rate 1] [--duration 10] [--output result.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import signal
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.bench_workers import HOST, free_port, run_server
+from services import (InfoMsgStatuses, EOS, CHANNEL, GENERAL, PRIVATE, AVAILABLE_MSGS,
+                      INIT_MSGS_CNT, READ_ACK_DELAY)
+
+LOAD_PREFIX = 'load'
+HISTORY_PREFIX = 'history'
+CONNECT_CONCURRENCY = 200
+
+# Metric: True when a bigger value is better
+COMPARED_METRICS = {
+    'messages_per_sec': True,
+    'latency_ms.p50': False,
+    'latency_ms.p95': False,
+    'latency_ms.p99': False,
+    'replay_ms.p95': False,
+    'peak_rss_kb': False,
+}
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    result = {}
+    for name, share in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        idx = min(int(len(values) * share), len(values) - 1)
+        result[name] = round(values[idx], 3) if values else None
+    result['max'] = round(values[-1], 3) if values else None
+    return result
+
+
+class SimClient:
+    """
+    One simulated client over an asyncio stream
+    """
+
+    def __init__(self, name: str, chat: Tuple[str, str]):
+        self.name = name
+        self.chat = chat
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+        self.sent = 0
+        self.received = 0
+        self.latencies: List[float] = []
+        self.read_seq = 0
+        self.ack_handle: Optional[asyncio.TimerHandle] = None
+        self.history_received = 0
+        self.history_done: Optional[asyncio.Future] = None
+        self.history_expected = 0
+
+    def write(self, text: str) -> None:
+        self.writer.write(text.encode() + EOS)
+
+    async def connect(self, port: int, history_expected: int = 0) -> float:
+        """
+        Connect and choose the name, return the time to receive the history
+        """
+
+        self.reader, self.writer = await asyncio.open_connection(HOST, port)
+        await self.reader.readline()  # choose_name
+
+        self.history_expected = history_expected
+        self.history_done = asyncio.get_running_loop().create_future()
+        if not history_expected:
+            self.history_done.set_result(None)
+
+        started = time.perf_counter()
+        self.write(self.name)
+        line = await self.reader.readline()
+        if not line.startswith(InfoMsgStatuses.NAME_ACCEPTED.msg_bts):
+            raise ConnectionError(f'The name {self.name} has not been accepted: {line!r}')
+
+        receiving = asyncio.create_task(self.receiving())
+        await self.history_done
+        spent = time.perf_counter() - started
+        receiving.cancel()
+        return spent
+
+    async def change_chat(self) -> None:
+        chat_type, chat_name = self.chat
+        if self.chat != (CHANNEL, GENERAL):
+            self.write(f'{InfoMsgStatuses.CHANGE_CHAT.value} {chat_type} {chat_name}')
+
+    def send_ack(self) -> None:
+        self.ack_handle = None
+        chat_type, chat_name = self.chat
+        ack = json.dumps({'destination_type': chat_type, 'destination_name': chat_name,
+                          'seq': self.read_seq})
+        if not self.writer.is_closing():
+            self.write(f'{InfoMsgStatuses.MESSAGES_READ.value} {ack}')
+
+    def message_received(self, msg: dict) -> None:
+        text = msg['message']
+        if text.startswith(LOAD_PREFIX):
+            self.received += 1
+            self.latencies.append((time.perf_counter() - float(text.split(' ', 2)[1])) * 1000)
+        elif text.startswith(HISTORY_PREFIX):
+            self.history_received += 1
+            if self.history_received >= self.history_expected and not self.history_done.done():
+                self.history_done.set_result(None)
+
+        if msg.get('seq', 0) > self.read_seq:
+            self.read_seq = msg['seq']
+            if self.ack_handle is None:
+                loop = asyncio.get_running_loop()
+                self.ack_handle = loop.call_later(READ_ACK_DELAY, self.send_ack)
+
+    async def receiving(self) -> None:
+        prefix = InfoMsgStatuses.MESSAGE_FROM_SRV.msg_bts + b' '
+        while line := await self.reader.readline():
+            if line.startswith(prefix):
+                self.message_received(json.loads(line[len(prefix):]))
+
+    async def sending(self, rate: float, duration: float, limit: Optional[int] = None) -> None:
+        # Clients start at random moments to avoid sending all at once
+        await asyncio.sleep(random.random() / rate)
+        finish = time.perf_counter() + duration
+        while time.perf_counter() < finish and (limit is None or self.sent < limit):
+            self.write(f'{InfoMsgStatuses.MESSAGE_FROM_CLIENT.value} '
+                       f'{LOAD_PREFIX} {time.perf_counter():.6f}')
+            self.sent += 1
+            await asyncio.sleep(min(random.expovariate(rate), finish - time.perf_counter()))
+
+    def close(self) -> None:
+        if self.ack_handle:
+            self.ack_handle.cancel()
+        self.writer.close()
+
+
+def make_clients(count: int, general_share: float) -> List[SimClient]:
+    general_cnt = int(count * general_share)
+    clients = [SimClient(f'general{idx}', (CHANNEL, GENERAL)) for idx in range(general_cnt)]
+
+    # Private chats by pairs, the odd client out stays at the general channel
+    private_cnt = (count - general_cnt) // 2 * 2
+    for idx in range(private_cnt):
+        clients.append(SimClient(f'private{idx}', (PRIVATE, f'private{idx ^ 1}')))
+    if count > general_cnt + private_cnt:
+        clients.append(SimClient(f'general{general_cnt}', (CHANNEL, GENERAL)))
+    return clients
+
+
+def expected_deliveries(clients: List[SimClient]) -> int:
+    general_cnt = sum(1 for client in clients if client.chat[0] == CHANNEL)
+    return sum(client.sent * (general_cnt - 1) if client.chat[0] == CHANNEL else client.sent
+               for client in clients)
+
+
+async def seed_history(port: int, count: int) -> int:
+    """
+    Send the messages which new clients get at connecting
+    """
+
+    sent = 0
+    idx = 0
+    while sent < count:
+        seeder = SimClient(f'seeder{idx}', (CHANNEL, GENERAL))
+        await seeder.connect(port)
+        for _ in range(min(AVAILABLE_MSGS, count - sent)):
+            seeder.write(f'{InfoMsgStatuses.MESSAGE_FROM_CLIENT.value} {HISTORY_PREFIX} {sent}')
+            sent += 1
+        await seeder.writer.drain()
+        seeder.close()
+        idx += 1
+    await asyncio.sleep(0.2)
+    return sent
+
+
+async def run_load(port: int, args) -> dict:
+    history = await seed_history(port, args.history)
+    replay_times = []
+    for idx in range(args.probes):
+        probe = SimClient(f'probe{idx}', (CHANNEL, GENERAL))
+        replay_times.append(await probe.connect(port, min(history, INIT_MSGS_CNT)) * 1000)
+        probe.close()
+
+    clients = make_clients(args.clients, args.general_share)
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client: SimClient) -> None:
+        async with semaphore:
+            await client.connect(port)
+            await client.change_chat()
+
+    connect_started = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_time = time.perf_counter() - connect_started
+
+    receivers = [asyncio.create_task(client.receiving()) for client in clients]
+    await asyncio.sleep(0.5)  # the connect replay and the chat changes
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client.sending(args.rate, args.duration,
+                       AVAILABLE_MSGS if client.chat[0] == CHANNEL else None)
+        for client in clients
+    ))
+
+    # Waiting for the messages in flight
+    expected = expected_deliveries(clients)
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline:
+        if sum(client.received for client in clients) >= expected:
+            break
+        await asyncio.sleep(0.05)
+    spent = time.perf_counter() - started
+
+    for task in receivers:
+        task.cancel()
+    for client in clients:
+        client.close()
+
+    delivered = sum(client.received for client in clients)
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        'clients': len(clients),
+        'connect_sec': round(connect_time, 3),
+        'sent': sum(client.sent for client in clients),
+        'expected_deliveries': expected,
+        'delivered': delivered,
+        'lost': expected - delivered,
+        'duration_sec': round(spent, 3),
+        'messages_per_sec': round(delivered / spent, 1),
+        'latency_ms': percentiles(latencies),
+        'replay_messages': min(history, INIT_MSGS_CNT),
+        'replay_ms': percentiles(replay_times),
+    }
+
+
+def peak_rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def run_subprocess(args) -> dict:
+    port = free_port()
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=run_server, args=(port, args.workers))
+    process.start()
+    try:
+        asyncio.run(wait_for_port(port))
+        results = asyncio.run(run_load(port, args))
+        results['peak_rss_kb'] = peak_rss_kb(process.pid)
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        process.join()
+
+    if results['peak_rss_kb'] is None:
+        results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return results
+
+
+async def wait_for_port(port: int) -> None:
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise ConnectionError(f'The server at {port} is not available')
+
+
+def run_inprocess(args) -> dict:
+    """
+    The server shares the loop with the clients, the latency includes the clients' work
+    """
+
+    from server import Server, ChatServerProtocol
+
+    async def main() -> dict:
+        port = free_port()
+        server = Server(HOST, port, data_dir=None)
+        srv = await asyncio.get_running_loop().create_server(ChatServerProtocol, HOST, port)
+        tasks = [asyncio.create_task(server.send_messages_from_queue()),
+                 asyncio.create_task(server.deleting_delivered_messages())]
+        try:
+            return await run_load(port, args)
+        finally:
+            for task in tasks:
+                task.cancel()
+            srv.close()
+
+    results = asyncio.run(main())
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def get_metric(results: dict, path: str) -> Optional[float]:
+    value = results
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Metrics which are worse than at the baseline by more than the threshold (in percent)
+    """
+
+    regressions = []
+    for path, bigger_is_better in COMPARED_METRICS.items():
+        current = get_metric(results, path)
+        previous = get_metric(baseline, path)
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous * 100
+        if (-change if bigger_is_better else change) > threshold:
+            regressions.append(f'{path}: {previous} -> {current} ({change:+.1f}%)')
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('subprocess', 'inprocess'), default='subprocess')
+    parser.add_argument('--workers', type=int, default=1, help='server workers (subprocess)')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1.0, help='messages per second by client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of the load')
+    parser.add_argument('--general-share', type=float, default=0.1,
+                        help='share of clients at the general channel')
+    parser.add_argument('--history', type=int, default=INIT_MSGS_CNT,
+                        help='messages sent before the probes connect')
+    parser.add_argument('--probes', type=int, default=20,
+                        help='clients measuring the history replay')
+    parser.add_argument('--drain-timeout', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the result to the JSON file')
+    parser.add_argument('--compare', help='the JSON result of a previous run')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='allowed regression in percent')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = run_subprocess(args) if args.mode == 'subprocess' else run_inprocess(args)
+    report = {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'results': results,
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'Regression {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
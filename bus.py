@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from services import (MessageItem, MessagePool, ConnectionPool, ConnectionItem, PoolListener,
+                      EOS, MAX_FRAME_SIZE)
+
+logger = logging.getLogger()
+
+BUS_LINE_LIMIT = 4 * MAX_FRAME_SIZE  # in bytes, one event of the bus
+
+HELLO = 'hello'
+GONE = 'gone'
+MESSAGE = 'msg'
+RECEIVED = 'recv'
+BAN = 'ban'
+COMPLAINT = 'complaint'
+PRESENCE = 'presence'
+LEFT = 'left'
+
+
+class MessageBusHub:
+    """
+    Relay between server workers over a Unix socket:
+    every event of one worker is sent to all other workers
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.server = None
+        self.__workers: Dict[asyncio.StreamWriter, Optional[int]] = {}
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path,
+                                                      limit=BUS_LINE_LIMIT)
+
+    def broadcast(self, line: bytes, sender: Optional[asyncio.StreamWriter] = None) -> None:
+        for writer in self.__workers:
+            if writer is not sender and not writer.is_closing():
+                writer.write(line)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.__workers[writer] = None
+        try:
+            while line := await reader.readline():
+                if self.__workers[writer] is None and line.startswith(b'["hello"'):
+                    self.__workers[writer] = json.loads(line)[1]
+                self.broadcast(line, writer)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.error(f'Bus connection of the worker is broken: {e}')
+        finally:
+            worker = self.__workers.pop(writer)
+            writer.close()
+            if worker is not None:
+                logger.info(f'Worker {worker} has left the bus')
+                self.broadcast(json.dumps([GONE, worker]).encode() + EOS)
+
+
+class MessageBusClient(PoolListener):
+    """
+    Connection of a worker to the bus.
+
+    Local messages, read receipts, bans and presence changes are published
+    to other workers, their events are applied to the local pools: messages
+    are added to the pool and sent to the local recipients, remote users
+    make the global roster
+    """
+
+    def __init__(self, path: str, worker: int,
+                 msg_pool: MessagePool,
+                 conn_pool: ConnectionPool,
+                 on_complaint: Callable[[ConnectionItem, str], None]):
+        self.path = path
+        self.worker = worker
+        self.msg_pool = msg_pool
+        self.conn_pool = conn_pool
+        self.on_complaint = on_complaint
+
+        self.__reader: Optional[asyncio.StreamReader] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__applying = False
+
+        # The kind of an event of other workers -> its handler
+        self.handlers: Dict[str, Callable[[list], None]] = {
+            MESSAGE: self.apply_message,
+            RECEIVED: self.apply_received,
+            PRESENCE: self.apply_presence,
+            LEFT: self.apply_left,
+            HELLO: self.apply_hello,
+            GONE: self.apply_gone,
+            BAN: self.apply_ban,
+            COMPLAINT: self.apply_complaint,
+        }
+
+    async def connect(self) -> None:
+        self.__reader, self.__writer = await asyncio.open_unix_connection(
+            self.path, limit=BUS_LINE_LIMIT)
+        self.publish([HELLO, self.worker])
+        self.msg_pool.listeners.append(self)
+        self.conn_pool.listeners.append(self)
+
+    def publish(self, event: list) -> None:
+        # Events of other workers are not sent back
+        if self.__applying or self.__writer is None or self.__writer.is_closing():
+            return
+        self.__writer.write(json.dumps(event, ensure_ascii=False).encode() + EOS)
+
+    def publish_presence(self, conn: ConnectionItem) -> None:
+        self.publish([PRESENCE, self.worker, conn.user_name,
+                      conn.current_connection_type, conn.current_connection_name])
+
+    # Local events
+
+    def message_added(self, msg: MessageItem) -> None:
+        self.publish([MESSAGE, msg.uuid, msg.ts, msg.creator, msg.destination_type,
+                      msg.destination_name, msg.message])
+
+    def message_received(self, msg: MessageItem, user: str) -> None:
+        self.publish([RECEIVED, msg.uuid, user])
+
+    def user_banned(self, user: str, ban_time: datetime) -> None:
+        self.publish([BAN, user, ban_time.timestamp()])
+
+    def user_joined(self, conn: ConnectionItem) -> None:
+        self.publish_presence(conn)
+
+    def chat_changed(self, conn: ConnectionItem) -> None:
+        self.publish_presence(conn)
+
+    def user_left(self, conn: ConnectionItem) -> None:
+        self.publish([LEFT, conn.user_name])
+
+    def user_complained(self, user: str, who_send_ban: str) -> None:
+        self.publish([COMPLAINT, user, who_send_ban])
+
+    # Events of other workers
+
+    async def receiving(self) -> None:
+        while line := await self.__reader.readline():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                logger.error(f'Broken event on the bus: {line[:100]}', extra={'category': 'bus'})
+                continue
+
+            self.__applying = True
+            try:
+                self.apply(event)
+            finally:
+                self.__applying = False
+
+        logger.error('The bus has been closed')
+
+    def apply(self, event: list) -> None:
+        handler = self.handlers.get(event[0])
+        if handler is not None:
+            handler(event)
+
+    def apply_message(self, event: list) -> None:
+        _, uuid, ts, creator, destination_type, destination_name, message = event
+        msg = MessageItem.restore(uuid, ts, creator, destination_type, destination_name,
+                                  message, seq=0)
+        self.msg_pool.add(msg)
+        self.conn_pool.send_message(msg)
+
+    def apply_received(self, event: list) -> None:
+        msg = self.msg_pool.get_message_by_uuid(event[1])
+        if msg:
+            self.msg_pool.mark_received(msg, event[2])
+
+    def apply_presence(self, event: list) -> None:
+        _, worker, user_name, chat_type, chat_name = event
+        self.conn_pool.set_remote_user(worker, user_name, chat_type, chat_name)
+
+    def apply_left(self, event: list) -> None:
+        self.conn_pool.del_remote_user(event[1])
+
+    def apply_hello(self, event: list) -> None:
+        # The new worker should know users of this one
+        self.__applying = False
+        for conn in self.conn_pool.get_all_connections():
+            if conn.user_name:
+                self.publish_presence(conn)
+
+    def apply_gone(self, event: list) -> None:
+        self.conn_pool.del_remote_worker(event[1])
+
+    def apply_ban(self, event: list) -> None:
+        self.conn_pool.bans[event[1]] = datetime.fromtimestamp(event[2])
+
+    def apply_complaint(self, event: list) -> None:
+        conn = self.conn_pool.get_by_user_name(event[1])
+        if conn:
+            self.on_complaint(conn, event[2])
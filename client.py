@@ -1,10 +1,23 @@
 import asyncio
+import base64
 import json
 import logging
+import os
+import random
 import signal
-from typing import List, Tuple
-
-from services import InfoMsgStatuses, CHANNEL, GENERAL, PRIVATE
+import zlib
+from bisect import bisect_left
+from collections import deque
+from typing import List, Tuple, Dict, Optional, Callable, Iterable
+from urllib.parse import quote
+
+from dispatch import CommandDispatcher
+from services import (InfoMsgStatuses, FrameReader, FrameTooLargeError, Roster,
+                      decode_compact_message,
+                      EOS, CHANNEL, GENERAL, PRIVATE, READ_ACK_DELAY, COMPACT_ENCODING,
+                      ZLIB_BATCHES, MAX_BATCH_SIZE, INIT_MSGS_CNT, RESUME, CLIENT_CACHE_DIR,
+                      CLIENT_CACHE_MESSAGES, RECONNECT_DELAY, RECONNECT_DELAY_MAX, HEARTBEAT,
+                      UNACKED_LIMIT)
 
 logger = logging.getLogger()
 
@@ -17,122 +30,668 @@ def raise_graceful_exit():
     raise GracefulExit()
 
 
+class NameRejectedError(Exception):
+    pass
+
+
+def recipient_chat(msg: dict) -> Tuple[str, str]:
+    """
+    The chat of the message as its recipient sees it
+    """
+
+    if msg['destination_type'] == PRIVATE:
+        return PRIVATE, msg['creator']
+    return msg['destination_type'], msg['destination_name']
+
+
+class HistoryCache:
+    """
+    The last messages shown to the user by chats, kept in a JSON file per user name.
+    Their seqs are valid only for the epoch of the server they came from
+    """
+
+    def __init__(self, directory: str, user: str, limit: int = CLIENT_CACHE_MESSAGES):
+        self.path = os.path.join(os.path.expanduser(directory), quote(user, safe='') + '.json')
+        self.limit = limit
+        self.epoch: Optional[str] = None
+        self.chats: Dict[Tuple[str, str], List[dict]] = {}
+        self.changed = False
+
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.epoch = cache['epoch']
+        self.chats = {tuple(chat.split(' ', 1)): msgs for chat, msgs in cache['chats'].items()}
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'epoch': self.epoch,
+                       'chats': {' '.join(chat): msgs for chat, msgs in self.chats.items()}}, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def start_epoch(self, epoch: Optional[str]) -> None:
+        """
+        Messages of another epoch can't be resumed, they are dropped
+        """
+
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.chats = {}
+            self.changed = True
+
+    def add(self, chat: Tuple[str, str], msg: dict) -> None:
+        # The history may come after newer messages, it is put in the order of seqs
+        msgs = self.chats.setdefault(chat, [])
+        idx = bisect_left([cached['seq'] for cached in msgs], msg['seq'])
+        if idx < len(msgs) and msgs[idx]['seq'] == msg['seq']:
+            return
+        msgs.insert(idx, msg)
+        del msgs[:-self.limit]
+        self.changed = True
+
+    def messages(self, chat: Tuple[str, str]) -> List[dict]:
+        return self.chats.get(chat, [])
+
+    def resume_token(self, user: str) -> dict:
+        return {
+            'epoch': self.epoch,
+            'user': user,
+            'chats': [[*chat, msgs[-1]['seq']] for chat, msgs in self.chats.items() if msgs],
+        }
+
+
+class SeenSeqs:
+    """
+    Seqs of the last `limit` messages received in one chat. Unlike the greatest seq,
+    they don't hide the history which arrives after newer messages
+    """
+
+    def __init__(self, limit: int = UNACKED_LIMIT):
+        self.limit = limit
+        self.__seqs = set()
+        self.__order = deque()
+
+    def add(self, seq: int) -> bool:
+        """
+        Remember the seq, return False if it has been seen
+        """
+
+        if seq in self.__seqs:
+            return False
+        self.__seqs.add(seq)
+        self.__order.append(seq)
+        if len(self.__order) > self.limit:
+            self.__seqs.discard(self.__order.popleft())
+        return True
+
+
 class ChatClientProtocol(asyncio.Protocol):
-    def __init__(self, on_con_lost, on_name_chosen):
+    """
+    The client side of the protocol shared by the console client and `AsyncChatClient`.
+    Texts for the user go to `echo`. Messages of the current chat are shown and
+    acknowledged by `message_received`, subclasses override it to handle them otherwise
+    """
+
+    dispatcher = CommandDispatcher()  # handlers of the frames from the server
+
+    def __init__(self, on_con_lost, on_name_chosen, encoding=COMPACT_ENCODING, zlib_batches=True,
+                 cache_dir=None, echo: Callable[[str], None] = print):
         self.on_con_lost = on_con_lost
         self.on_name_chosen = on_name_chosen
+        self.name_offered: Optional[asyncio.Future] = None
         self.own_name = None
         self.transport = None
+        self.frames = FrameReader(max_size=MAX_BATCH_SIZE)
+        self.echo = echo
+        self.ask_name = True  # a reconnecting client knows the name, the prompt is not shown
+
+        # The transport buffer is over its high-water mark until `resume_writing`
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+        # Messages shown to the user survive reconnects in the local cache,
+        #   the server offers to resume within its epoch of seqs
+        self.cache_dir = cache_dir
+        self.cache: Optional[HistoryCache] = None
+        self.resume_epoch: Optional[str] = None
+
+        # The encoding asked from the server, the compact one refers to names by ids.
+        # The history can come as compressed batches of frames
+        self.encoding = encoding
+        self.zlib_batches = zlib_batches
+        self.compact = False
+        self.names: Dict[int, str] = {}
+
+        # The last read seq by chats, they are sent to the server in one ack
+        self.read_seqs: Dict[Tuple[str, str], int] = {}
+        self.read_ack_handle: Optional[asyncio.TimerHandle] = None
+
+        # The local copy of the roster, the server sends its changes
+        self.roster = Roster()
+        self.roster_loaded = False
+        self.statistic_requested = False
 
         # At the start, we connect a user to the default channel
         self.current_connection_type = CHANNEL
         self.current_connection_name = GENERAL
 
     def get_statistics(self, stat: dict) -> List[Tuple]:
+        metrics = stat.get('metrics')
         stat = [
             ('Your own name', self.own_name,),
             ('All users count', len(stat['users'])),
             ('List of all users', ', '.join(stat['users'])),
             ('List of all channels', ', '.join(stat['channels']))
         ]
+
+        # Only admins get metrics of the server
+        if metrics:
+            stat.append(('Server metrics', json.dumps(metrics, indent=2)))
         return stat
 
+    def print_statistics(self, stat: dict) -> None:
+        self.statistic_requested = False
+        self.echo('-' * 30)
+        for text, value in self.get_statistics(stat):
+            self.echo(f'{text}: {value}')
+        self.echo('To change to a private channel, write `change_chat private USER_NAME`')
+        self.echo('To change to a channel, write `change_chat channel general`')
+        self.echo('-' * 30)
+
+    def print_history(self, page: dict) -> None:
+        self.echo('-' * 30)
+        for msg in page['messages']:
+            self.echo(f'#{msg["seq"]} [{msg["creator"]}] {msg["message"]}')
+        if page['before']:
+            self.echo(f'For older messages, write `history {page["destination_type"]} '
+                      f'{page["destination_name"]} before {page["before"]}`')
+        self.echo('-' * 30)
+
+    def statistic_command(self) -> str:
+        """
+        The client knowing the roster asks only for its changes
+        """
+
+        command = InfoMsgStatuses.GET_STATISTIC.value
+        if self.roster_loaded:
+            command += f' {self.roster.version}'
+        return command
+
     def connection_made(self, transport):
         self.transport = transport
+        self.name_offered = asyncio.get_running_loop().create_future()
 
-    def data_received(self, data):  # noqa C901
-        operator, *args = data.decode().strip().split(' ', 1)
+    def pause_writing(self):
+        self.writable.clear()
 
-        if operator == InfoMsgStatuses.CHOOSE_NAME.value:
-            print('Choose username')
+    def resume_writing(self):
+        self.writable.set()
 
-        elif operator == InfoMsgStatuses.NAME_REJECTED.value:
-            print('This username is already in use\nPlease choose another one')
+    async def drain(self) -> None:
+        if self.transport.is_closing():
+            raise ConnectionResetError('The connection is closed')
+        await self.writable.wait()
 
-        elif operator == InfoMsgStatuses.NAME_ACCEPTED.value:
-            self.own_name = args[0]
-            print(f'OK! Your name is {self.own_name}')
-            print('To show statistics, write `get_statistic`')
-            print('To ban a user, write `ban_user USER_NAME`')
-            print('-' * 30)
-            self.on_name_chosen.set_result(True)
+    def name_frames(self, name: str) -> bytes:
+        """
+        The chosen name, preceded by the resume token when the cache is of the server epoch
+        """
+
+        frames = name.encode() + EOS
+        if not self.cache_dir:
+            return frames
+
+        self.cache = HistoryCache(self.cache_dir, name)
+        token = self.cache.resume_token(name)
+        if self.resume_epoch and self.cache.epoch == self.resume_epoch and token['chats']:
+            frames = f'{InfoMsgStatuses.RESUME.value} {json.dumps(token)}'.encode() + EOS + frames
+        return frames
+
+    def message_read(self, chat_type: str, chat_name: str, seq: int) -> None:
+        chat = (chat_type, chat_name)
+        if seq > self.read_seqs.get(chat, 0):
+            self.read_seqs[chat] = seq
+
+        if self.read_ack_handle is None:
+            loop = asyncio.get_running_loop()
+            self.read_ack_handle = loop.call_later(READ_ACK_DELAY, self.send_read_acks)
+
+    def send_read_acks(self) -> None:
+        """
+        Tell the server that all messages of the chat up to the seq have been read
+        """
 
-        elif operator == InfoMsgStatuses.CHANGE_CHAT.value:
-            chat_type, chat_name = args[0].strip().split(' ', 1)
-            self.current_connection_type = chat_type
-            self.current_connection_name = chat_name
-            print(f'Current chat type: {self.current_connection_type}, '
+        self.read_ack_handle = None
+        command = InfoMsgStatuses.MESSAGES_READ.value
+        acks = []
+        for (chat_type, chat_name), seq in self.read_seqs.items():
+            if self.compact:
+                ack = f'{chat_type} {seq} {chat_name}'
+            else:
+                ack = json.dumps({
+                    'destination_type': chat_type,
+                    'destination_name': chat_name,
+                    'seq': seq
+                })
+            acks.append(f'{command} {ack}'.encode() + EOS)
+
+        self.read_seqs.clear()
+        if acks and not self.transport.is_closing():
+            self.transport.writelines(acks)
+        if self.cache:
+            self.cache.save()
+
+    def data_received(self, data):
+        try:
+            frames = self.frames.feed(data)
+        except FrameTooLargeError as e:
+            logger.error(f'{e}, closing the connection')
+            self.transport.close()
+            return
+
+        for frame in frames:
+            if frame.strip():
+                self.frame_received(frame)
+
+    def frame_received(self, frame: bytes) -> None:
+        self.dispatcher.dispatch(self, frame)
+
+    @dispatcher.command(InfoMsgStatuses.COMPACT_MESSAGE)
+    def compact_message(self, args: bytes) -> None:
+        self.message_received(decode_compact_message(args, self.names))
+
+    @dispatcher.command(InfoMsgStatuses.NAME_ID)
+    def name_id(self, args: bytes) -> None:
+        name_id, name = args.split(b' ', 1)
+        self.names[int(name_id)] = name.decode()
+
+    @dispatcher.command(InfoMsgStatuses.MESSAGE_BATCH)
+    def message_batch(self, args: bytes) -> None:
+        _, data = args.split(b' ', 1)
+        for batch_frame in zlib.decompress(base64.b64decode(data)).split(EOS):
+            if batch_frame:
+                self.frame_received(batch_frame)
+
+    @dispatcher.command(InfoMsgStatuses.CHOOSE_NAME)
+    def choose_name(self, args: bytes) -> None:
+        offered = args.decode().split()
+        for option in offered:
+            if option.startswith(RESUME + '='):
+                self.resume_epoch = option.split('=', 1)[1]
+        wanted = [self.encoding, HEARTBEAT] + ([ZLIB_BATCHES] if self.zlib_batches else [])
+        options = [option for option in wanted if option in offered]
+        if options:
+            self.transport.write(
+                f'{InfoMsgStatuses.ENCODING.value} {" ".join(options)}'.encode() + EOS)
+        if self.ask_name:
+            self.echo('Choose username')
+        if not self.name_offered.done():
+            self.name_offered.set_result(True)
+
+    @dispatcher.command(InfoMsgStatuses.ENCODING)
+    def encoding_accepted(self, args: bytes) -> None:
+        self.compact = COMPACT_ENCODING in args.decode().split()
+
+    @dispatcher.command(InfoMsgStatuses.NAME_REJECTED)
+    def name_rejected_frame(self, args: bytes) -> None:
+        self.name_rejected()
+
+    @dispatcher.command(InfoMsgStatuses.NAME_ACCEPTED)
+    def name_accepted(self, args: bytes) -> None:
+        self.own_name = args.decode()
+        if self.ask_name:
+            self.echo(f'OK! Your name is {self.own_name}')
+            self.echo('To show statistics, write `get_statistic`')
+            self.echo('To ban a user, write `ban_user USER_NAME`')
+            self.echo('To show older messages, write `history channel general`')
+            self.echo('-' * 30)
+        if self.cache:
+            # The server sends only messages after the cached ones
+            self.cache.start_epoch(self.resume_epoch)
+            if self.ask_name:
+                for msg in self.cache.messages((CHANNEL, GENERAL))[-INIT_MSGS_CNT:]:
+                    self.echo(f'[{msg["creator"]}] {msg["message"]}')
+        self.on_name_chosen.set_result(True)
+
+    @dispatcher.command(InfoMsgStatuses.CHANGE_CHAT)
+    def chat_changed(self, args: bytes) -> None:
+        chat_type, chat_name = args.decode().strip().split(' ', 1)
+        self.current_connection_type = chat_type
+        self.current_connection_name = chat_name
+        self.echo(f'Current chat type: {self.current_connection_type}, '
                   f'and connection name: {self.current_connection_name}')
 
-        elif operator == InfoMsgStatuses.SET_STATISTIC.value:
+    @dispatcher.command(InfoMsgStatuses.SET_STATISTIC)
+    def set_statistic(self, args: bytes) -> None:
+        stat = json.loads(args)
+        self.roster.load(stat)
+        self.roster_loaded = True
+        self.print_statistics(stat)
+
+    @dispatcher.command(InfoMsgStatuses.ROSTER_DELTA)
+    def roster_delta(self, args: bytes) -> None:
+        delta = json.loads(args)
+        if delta['version'] <= self.roster.version:
+            return
+        if not self.roster.apply_deltas(delta['from'], delta['version'], delta['deltas']):
+            # Some changes have been missed, asking the changes after the known version
+            self.transport.write(self.statistic_command().encode() + EOS)
+            return
+        if self.statistic_requested:
+            self.print_statistics(self.roster.snapshot())
+
+    @dispatcher.command(InfoMsgStatuses.HISTORY)
+    def history(self, args: bytes) -> None:
+        self.print_history(json.loads(args))
 
-            print('-' * 30)
-            for text, value in self.get_statistics(json.loads(args[0])):
-                print(f'{text}: {value}')
-            print('To change to a private channel, write `change_chat private USER_NAME`')
-            print('To change to a channel, write `change_chat channel general`')
-            print('-' * 30)
+    @dispatcher.command(InfoMsgStatuses.MESSAGE_FROM_SRV)
+    def message_from_srv(self, args: bytes) -> None:
+        if not args:
+            logger.error('Can\'t read an empty message')
+            return
 
-        elif operator == InfoMsgStatuses.MESSAGE_FROM_SRV.value:
+        self.message_received(json.loads(args))
 
-            try:
-                msg_text = args[0]
-            except IndexError:
-                logger.error(f'Can\'t read message {data.decode()}')
-                return
+    @dispatcher.command(InfoMsgStatuses.PING)
+    def ping(self, args: bytes) -> None:
+        self.transport.write(InfoMsgStatuses.PONG.msg_bts + EOS)
 
-            msg = json.loads(msg_text)
-            uuid = msg['uuid']
-            creator = msg['creator']
-            destination_type = msg['destination_type']
-            destination_name = msg['destination_name']
-
-            # If a user situating at the correct channel - printing and sending a signal
-            #   about the message has been read
-
-            if ((
-                    destination_type == CHANNEL
-                    and self.current_connection_type == destination_type
-                    and self.current_connection_name == destination_name
-            ) or (
-                    destination_type == PRIVATE
-                    and self.current_connection_type == destination_type
-                    and self.own_name == destination_name
-                    and self.current_connection_name == creator
-            )):
-                message = msg['message']
-                print(f'[{creator}] {message}')
-
-                msg_to_srv = {
-                    'uuid': uuid,
-                    'user': self.own_name
-                }
-
-                command = InfoMsgStatuses.MESSAGE_APPROVE.value
-                msg_to_srv = json.dumps(msg_to_srv)
-
-                approval_to_srv = f'{command} {msg_to_srv}'.encode()
-                self.transport.write(approval_to_srv)
+    @dispatcher.fallback()
+    def text_received(self, frame: bytes) -> None:
+        self.echo(frame.decode())
 
-        else:
-            print(data.decode())
+    def name_rejected(self) -> None:
+        self.echo('This username is already in use\nPlease choose another one')
+
+    def is_current_chat(self, msg: dict) -> bool:
+        if msg['destination_type'] == PRIVATE and msg['destination_name'] != self.own_name:
+            return False
+        return recipient_chat(msg) == (self.current_connection_type,
+                                       self.current_connection_name)
+
+    def message_received(self, msg: dict) -> None:
+        # If a user situating at the correct chat - printing and sending a signal
+        #   about the message has been read
+        if self.is_current_chat(msg):
+            self.echo(f'[{msg["creator"]}] {msg["message"]}')
+            self.mark_read(msg)
+
+    def mark_read(self, msg: dict) -> None:
+        """
+        Keep the message in the cache and acknowledge it to the server
+        """
+
+        seq = msg.get('seq')
+        if seq:
+            chat = recipient_chat(msg)
+            if self.cache:
+                self.cache.add(chat, {'seq': seq, 'creator': msg['creator'],
+                                      'message': msg['message']})
+            self.message_read(*chat, seq)
+            return
+
+        # The server doesn't send seq, approving every message
+        msg_to_srv = {
+            'uuid': msg['uuid'],
+            'user': self.own_name
+        }
+
+        command = InfoMsgStatuses.MESSAGE_APPROVE.value
+        msg_to_srv = json.dumps(msg_to_srv)
+
+        approval_to_srv = f'{command} {msg_to_srv}'.encode()
+        self.transport.write(approval_to_srv + EOS)
 
     def connection_lost(self, exc):
-        print('The server closed the connection')
+        if self.read_ack_handle:
+            self.read_ack_handle.cancel()
+        if self.cache:
+            self.cache.save()
+        self.writable.set()  # writers waiting for the buffer find the connection closed
+        self.echo('The server closed the connection')
         self.on_con_lost.set_result(True)
 
 
+class LibraryProtocol(ChatClientProtocol):
+    """
+    The protocol of `AsyncChatClient`: messages go to the client instead of the console
+    """
+
+    def __init__(self, client: 'AsyncChatClient', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = client
+
+    def name_rejected(self) -> None:
+        if not self.on_name_chosen.done():
+            self.on_name_chosen.set_exception(NameRejectedError(self.client.name))
+
+    def message_received(self, msg: dict) -> None:
+        self.client.message_arrived(self, msg)
+
+
+class AsyncChatClient:
+    """
+    The chat client for programs, one process can run thousands of them.
+
+    Messages are sent by awaitable `send` and `send_many`, the latter writes all
+    of them at once. Received messages come from `async for msg in client` and
+    are acknowledged when taken. A lost connection is restored with exponential
+    backoff, with the same name and chat; messages received before are skipped
+    by seq, the cache of the client lets the server skip them too
+    """
+
+    protocol_class = LibraryProtocol
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8000,
+                 cache_dir: Optional[str] = None,
+                 encoding: str = COMPACT_ENCODING,
+                 reconnect: bool = True,
+                 current_chat_only: bool = False,
+                 echo: Callable[[str], None] = logger.debug):
+        self.host = host
+        self.port = port
+        self.cache_dir = cache_dir
+        self.encoding = encoding
+        self.reconnect = reconnect
+        self.current_chat_only = current_chat_only  # messages of other chats wait on the server
+        self.echo = echo
+
+        self.name: Optional[str] = None
+        self.chat: Tuple[str, str] = (CHANNEL, GENERAL)
+        self.protocol: Optional[LibraryProtocol] = None
+        self.reconnects = 0
+        self.closed = False
+
+        self.__messages: Optional[asyncio.Queue] = None
+        self.__connected: Optional[asyncio.Event] = None
+        self.__watcher: Optional[asyncio.Task] = None
+        self.__epoch: Optional[str] = None
+        # Seqs received by chats, a reconnect may replay some of them
+        self.__seen: Dict[Tuple[str, str], SeenSeqs] = {}
+
+    async def open(self) -> None:
+        """
+        Connect to the server and wait until it asks for the name
+        """
+
+        loop = asyncio.get_running_loop()
+        if self.__messages is None:
+            self.__messages = asyncio.Queue()
+            self.__connected = asyncio.Event()
+
+        _, self.protocol = await loop.create_connection(
+            lambda: self.protocol_class(self, loop.create_future(), loop.create_future(),
+                                        encoding=self.encoding, cache_dir=self.cache_dir,
+                                        echo=self.echo),
+            self.host, self.port)
+        self.protocol.ask_name = self.name is None
+        await asyncio.wait([self.protocol.name_offered, self.protocol.on_con_lost],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not self.protocol.name_offered.done():
+            # The server is over its caps of connections
+            raise ConnectionRefusedError('The server has closed the connection')
+
+        if self.protocol.resume_epoch != self.__epoch:
+            # Seqs of another epoch can't be compared
+            self.__epoch = self.protocol.resume_epoch
+            self.__seen.clear()
+
+    async def login(self, name: str) -> None:
+        """
+        Choose the name, raise `NameRejectedError` if it is taken
+        """
+
+        protocol = self.protocol
+        protocol.on_name_chosen = asyncio.get_running_loop().create_future()
+        protocol.transport.write(protocol.name_frames(name))
+        await asyncio.wait([protocol.on_name_chosen, protocol.on_con_lost],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not protocol.on_name_chosen.done():
+            raise ConnectionResetError('The connection is lost during the handshake')
+        protocol.on_name_chosen.result()
+
+        self.name = name
+        if self.chat != (CHANNEL, GENERAL):
+            protocol.transport.write(self.change_chat_frame(*self.chat))
+        self.__connected.set()
+
+        if self.__watcher is None:
+            self.__watcher = asyncio.get_running_loop().create_task(self.watch())
+
+    async def connect(self, name: str) -> None:
+        await self.open()
+        await self.login(name)
+
+    async def watch(self) -> None:
+        """
+        Reconnect after the connection is lost, until the client is closed
+        """
+
+        while not self.closed:
+            await self.protocol.on_con_lost
+            self.__connected.clear()
+            if self.closed or not self.reconnect:
+                break
+            await self.restore()
+        self.__messages.put_nowait(None)
+
+    async def restore(self) -> None:
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            # The jitter spreads reconnects of many clients after a failure of the server
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            try:
+                await self.open()
+                await self.login(self.name)
+            except (OSError, NameRejectedError) as e:
+                # The server may still keep the name for the broken connection
+                logger.info(f'Can\'t reconnect {self.name}: {e!r}')
+                if self.protocol.transport:
+                    self.protocol.transport.close()
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+            else:
+                self.reconnects += 1
+                return
+
+    def message_arrived(self, protocol: LibraryProtocol, msg: dict) -> None:
+        if self.current_chat_only and not protocol.is_current_chat(msg):
+            return
+
+        seq = msg.get('seq')
+        if seq:
+            seen = self.__seen.get(recipient_chat(msg))
+            if seen is None:
+                seen = self.__seen[recipient_chat(msg)] = SeenSeqs()
+            if not seen.add(seq):
+                return  # replayed after a reconnect
+        self.__messages.put_nowait(msg)
+
+    def __aiter__(self) -> 'AsyncChatClient':
+        return self
+
+    async def __anext__(self) -> dict:
+        msg = await self.__messages.get()
+        if msg is None:
+            self.__messages.put_nowait(None)
+            raise StopAsyncIteration
+        if self.__connected.is_set():
+            self.protocol.mark_read(msg)
+        return msg
+
+    async def write(self, frames: List[bytes]) -> None:
+        """
+        Write the frames by one call when connected and wait for the buffer to drain
+        """
+
+        while True:
+            await self.__connected.wait()
+            try:
+                self.protocol.transport.writelines(frames)
+                await self.protocol.drain()
+                return
+            except ConnectionError:
+                if not self.reconnect or self.closed:
+                    raise
+
+    async def send(self, text: str) -> None:
+        await self.send_many([text])
+
+    async def send_many(self, texts: Iterable[str]) -> None:
+        """
+        Send the messages to the current chat, they are written at once
+        """
+
+        command = InfoMsgStatuses.MESSAGE_FROM_CLIENT.value
+        frames = []
+        for text in texts:
+            if '\n' in text:
+                raise ValueError('A message can\'t contain a line break')
+            frames.append(f'{command} {text}'.encode() + EOS)
+        await self.write(frames)
+
+    async def send_command(self, command: str) -> None:
+        await self.write([command.encode() + EOS])
+
+    @staticmethod
+    def change_chat_frame(chat_type: str, chat_name: str) -> bytes:
+        return f'{InfoMsgStatuses.CHANGE_CHAT.value} {chat_type} {chat_name}'.encode() + EOS
+
+    async def change_chat(self, chat_type: str, chat_name: str) -> None:
+        if chat_type not in (CHANNEL, PRIVATE):
+            raise ValueError(f'Wrong chat type {chat_type}')
+        self.chat = (chat_type, chat_name)
+        await self.write([self.change_chat_frame(chat_type, chat_name)])
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        if self.__watcher:
+            await self.__watcher
+        elif self.__messages:
+            self.__messages.put_nowait(None)
+
+
 class Client:
-    def __init__(self, server_host='127.0.0.1', server_port=8000):
+    """
+    The console client over `AsyncChatClient`
+    """
+
+    def __init__(self, server_host='127.0.0.1', server_port=8000, cache_dir=CLIENT_CACHE_DIR):
         self.server_host = server_host
         self.server_port = server_port
-        self.transport = None
-        self.name_chosen = False
+        self.chat = AsyncChatClient(server_host, server_port, cache_dir=cache_dir,
+                                    current_chat_only=True, echo=print)
+        self.lines: Optional[asyncio.Queue] = None
 
-    def send(self, message: str = ''):
-        self.transport.write(message.encode())
-
-    def input_func(self):
+    def input_func(self, loop: asyncio.AbstractEventLoop):
         """
         Функция для ввода текста в консоли
         """
@@ -142,64 +701,64 @@ class Client:
             except EOFError:
                 break
 
-            command, *args = message.strip().split(' ', 1)
+            loop.call_soon_threadsafe(self.lines.put_nowait, message)
 
-            if not self.name_chosen:
-                self.send(message)
+    async def handle_lines(self) -> None:
+        while True:
+            await self.handle_input(await self.lines.get())
 
-            elif command == InfoMsgStatuses.CHANGE_CHAT.value:
-                # Сменяем чат комнату
-                try:
-                    chat_type, chat_name = args[0].strip().split(' ', 1)
-                    assert chat_type in [CHANNEL, PRIVATE]
-                    self.send(message)
-                except (ValueError, AssertionError):
-                    print('Wrong chat type')
+    async def handle_input(self, message: str) -> None:
+        command, *args = message.strip().split(' ', 1)
 
-            elif command == InfoMsgStatuses.GET_STATISTIC.value:
-                self.send(InfoMsgStatuses.GET_STATISTIC.value)
+        if self.chat.name is None:
+            if not message.strip():
+                return
+            try:
+                await self.chat.login(message.strip())
+            except NameRejectedError:
+                print('This username is already in use\nPlease choose another one')
 
-            elif command == InfoMsgStatuses.BAN_USER.value:
-                self.send(message)
+        elif command == InfoMsgStatuses.CHANGE_CHAT.value:
+            # Сменяем чат комнату
+            try:
+                chat_type, chat_name = args[0].strip().split(' ', 1)
+                await self.chat.change_chat(chat_type, chat_name)
+            except (ValueError, IndexError):
+                print('Wrong chat type')
 
-            else:
-                message = f'{InfoMsgStatuses.MESSAGE_FROM_CLIENT.value} {message}'
-                self.send(message)
+        elif command == InfoMsgStatuses.GET_STATISTIC.value:
+            self.chat.protocol.statistic_requested = True
+            await self.chat.send_command(self.chat.protocol.statistic_command())
+
+        elif command in (InfoMsgStatuses.BAN_USER.value, InfoMsgStatuses.HISTORY.value,
+                         InfoMsgStatuses.PROFILE.value):
+            await self.chat.send_command(message)
+
+        else:
+            await self.chat.send(message)
 
     async def init_connection(self):
         loop = asyncio.get_running_loop()
 
-        on_con_lost = loop.create_future()
-        on_name_chosen = loop.create_future()
-
         try:
-            self.transport, _ = await loop.create_connection(
-                lambda: ChatClientProtocol(on_con_lost, on_name_chosen),
-                self.server_host,
-                self.server_port
-            )
-        except (ConnectionRefusedError, OSError):
+            await self.chat.open()
+        except OSError:
             print('ERROR')
             print(f'Can\'t connect to the server {self.server_host}:{self.server_port}')
             loop.stop()
             return
 
-        try:
-            await on_name_chosen
-        finally:
-            self.name_chosen = True
-
-        try:
-            await on_con_lost
-        finally:
-            self.transport.close()
+        self.lines = asyncio.Queue()
+        loop.create_task(self.handle_lines())
+        loop.run_in_executor(None, self.input_func, loop)
+        async for msg in self.chat:
+            print(f'[{msg["creator"]}] {msg["message"]}')
 
     def connect(self):
         loop = asyncio.get_event_loop()
         loop.add_signal_handler(signal.SIGINT, raise_graceful_exit)
         loop.add_signal_handler(signal.SIGTERM, raise_graceful_exit)
         loop.create_task(self.init_connection())
-        loop.run_in_executor(None, self.input_func)
 
         try:
             loop.run_forever()
@@ -0,0 +1,111 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from metrics import HistogramFamily
+from services import InfoMsgStatuses
+
+Handler = Callable[[Any, bytes], None]  # called with the protocol and the arguments of the command
+
+
+@dataclass
+class Command:
+    """
+    A registered command, middlewares read its options to decide whether to wrap it
+    """
+    label: str  # the name of the command in metrics and answers
+    handler: Handler
+    options: Dict[str, Any] = field(default_factory=dict)
+
+
+Middleware = Callable[[Command, Handler], Handler]
+
+
+class CommandDispatcher:
+    """
+    Maps the operators of frames to their handlers.
+
+    A handler gets the protocol and the arguments, the fallback gets the whole frame
+    of an unknown operator. Middlewares wrap a handler once when it is registered,
+    the first middleware is the outermost one; a middleware returns the handler
+    itself for the commands it doesn't apply to, so a frame costs one dict lookup
+    and the wrappers its command needs
+    """
+
+    def __init__(self, middlewares: Sequence[Middleware] = ()):
+        self.middlewares: List[Middleware] = list(middlewares)
+        self.commands: Dict[bytes, Command] = {}
+        self.handlers: Dict[bytes, Handler] = {}
+        self.fallback_command: Optional[Command] = None
+        self.fallback_handler: Optional[Handler] = None
+
+    def command(self, status: InfoMsgStatuses, label: Optional[str] = None,
+                **options) -> Callable[[Handler], Handler]:
+        """
+        Register the decorated function as the handler of the operator
+        """
+
+        def register(handler: Handler) -> Handler:
+            command = Command(label or status.value, handler, options)
+            self.commands[status.msg_bts] = command
+            self.handlers[status.msg_bts] = self.wrap(command)
+            return handler
+
+        return register
+
+    def fallback(self, label: str = 'unknown', **options) -> Callable[[Handler], Handler]:
+        """
+        Register the decorated function as the handler of frames with unknown operators
+        """
+
+        def register(handler: Handler) -> Handler:
+            self.fallback_command = Command(label, handler, options)
+            self.fallback_handler = self.wrap(self.fallback_command)
+            return handler
+
+        return register
+
+    def use(self, middleware: Middleware) -> None:
+        """
+        Add the innermost middleware, the registered handlers are wrapped again
+        """
+
+        self.middlewares.append(middleware)
+        self.handlers = {operator: self.wrap(command)
+                         for operator, command in self.commands.items()}
+        if self.fallback_command:
+            self.fallback_handler = self.wrap(self.fallback_command)
+
+    def wrap(self, command: Command) -> Handler:
+        handler = command.handler
+        for middleware in reversed(self.middlewares):
+            handler = middleware(command, handler)
+        return handler
+
+    def dispatch(self, protocol: Any, frame: bytes) -> None:
+        operator, _, args = frame.strip().partition(b' ')
+        handler = self.handlers.get(operator)
+        if handler is not None:
+            handler(protocol, args)
+        elif self.fallback_handler is not None:
+            self.fallback_handler(protocol, frame)
+
+
+def timed(histograms: HistogramFamily) -> Middleware:
+    """
+    The middleware observing the time of every command in the histogram of its label
+    """
+
+    def middleware(command: Command, handler: Handler) -> Handler:
+        histogram = histograms.labels(command.label)
+
+        def timed_handler(protocol: Any, args: bytes) -> None:
+            started = time.perf_counter()
+            try:
+                handler(protocol, args)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return timed_handler
+
+    return middleware
@@ -0,0 +1,254 @@
+import asyncio
+import gc
+import logging
+import os
+import pickle
+import socket
+import struct
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+from services import (MessageItem, MessagePool, ConnectionPool, ConnectionItem, RateLimiter,
+                      NAME_IDS, UNACKED_LIMIT, HANDOVER_TIMEOUT)
+
+logger = logging.getLogger()
+
+TAKEOVER = b'takeover'
+ACK = b'ok'
+HEADER = struct.Struct('!IQ')  # count of descriptors, size of the state
+PACKET_SIZE = 64 * 1024  # in bytes, the state is sent by packets of this size
+FDS_PER_PACKET = 250  # descriptors passed with one packet, the kernel allows 253 at most
+
+
+@dataclass
+class Handover:
+    """
+    Sockets and state which the new server process gets from the previous one
+    """
+    # Listening sockets by names: chat, http, metrics. A server on several addresses,
+    #   like IPv4 and IPv6 ones, has a socket for each of them
+    listeners: Dict[str, List[socket.socket]]
+    connections: List[Tuple[socket.socket, dict]]  # client sockets with `dump_connection` states
+    state: dict  # see `dump_pools`
+    names_match: bool = True  # see `load_pools`
+
+
+# The state
+
+def dump_pools(msg_pool: MessagePool, conn_pool: ConnectionPool,
+               rate_limiter: RateLimiter) -> dict:
+    """
+    The state of the pools as plain values, it is pickled for the new process
+    """
+
+    now = datetime.now()
+    messages = [(msg.seq, msg.uuid, msg.ts, msg.creator, msg.destination_type,
+                 msg.destination_name, msg.message, msg.received_users)
+                for msg in msg_pool.all_messages()]
+    messages.sort()  # spilled messages come first, resident ones may be older
+
+    return {
+        'epoch': msg_pool.epoch,
+        'last_seq': msg_pool.last_seq,
+        'messages': messages,
+        'skipped': list(msg_pool.skipped_history()),
+        'bans': {user: ban_time.timestamp() for user, ban_time in conn_pool.bans.items()
+                 if ban_time > now},
+        'roster': conn_pool.roster.snapshot(),
+        'rate_limits': rate_limiter.snapshot(),
+        'names': NAME_IDS.names,
+    }
+
+
+def load_pools(state: dict, msg_pool: MessagePool, conn_pool: ConnectionPool,
+               rate_limiter: RateLimiter) -> bool:
+    """
+    Load the state into the pools, return False if the ids of names differ from the ones
+    of the previous process, then the clients of the compact encoding should get the names again
+    """
+
+    names_match = all(NAME_IDS.get_or_create(name) == name_id
+                      for name_id, name in enumerate(state['names']))
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for seq, uuid, ts, creator, destination_type, destination_name, message, received \
+                in state['messages']:
+            msg = MessageItem.restore(uuid, ts, creator, destination_type, destination_name,
+                                      message, seq)
+            for user in received:
+                msg.mark_received(user)
+            msg_pool.add(msg)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    for skipped in state['skipped']:
+        msg_pool.skip_history(*skipped)
+    msg_pool.epoch = state['epoch']
+    msg_pool.last_seq = state['last_seq']
+
+    for user, ban_time in state['bans'].items():
+        conn_pool.bans[user] = datetime.fromtimestamp(ban_time)
+    conn_pool.roster.load(state['roster'])
+    rate_limiter.load(state['rate_limits'])
+    return names_match
+
+
+def dump_connection(conn: ConnectionItem, pending: bytes = b'',
+                    resume: Optional[dict] = None) -> dict:
+    """
+    The state of the connection, `pending` is the start of a command not received completely
+    """
+
+    state = {
+        'user_name': conn.user_name,
+        'chat': (conn.current_connection_type, conn.current_connection_name),
+        'ban_time': conn.ban_time.timestamp() if conn.ban_time else None,
+        'deferred': conn.deferred,
+        'roster_version': conn.roster_version,
+        'compact': conn.compact,
+        'zlib_batches': conn.zlib_batches,
+        'heartbeat': conn.heartbeat,
+        'known_names': list(conn.known_names),
+        'delivered': {chat: [msg.uuid for msg in msgs] for chat, msgs in conn.delivered.items()},
+        'backlog': [msg.uuid for msg in conn.backlog],
+        'pending': pending,
+        'resume': resume,
+    }
+    if 'banned_users' in vars(conn):
+        # Complaints about the user since the last ban
+        state['complaints'] = list(conn.banned_users)
+    return state
+
+
+def load_connection(state: dict, conn: ConnectionItem, msg_pool: MessagePool) -> List[MessageItem]:
+    """
+    Restore the connection from its state, return the history it still has to replay
+    """
+
+    conn.user_name = state['user_name']
+    conn.current_connection_type, conn.current_connection_name = state['chat']
+    if state['ban_time']:
+        conn.ban_time = datetime.fromtimestamp(state['ban_time'])
+    conn.deferred = state['deferred']
+    conn.roster_version = state['roster_version']
+    conn.compact = state['compact']
+    conn.zlib_batches = state['zlib_batches']
+    conn.heartbeat = state['heartbeat']
+    conn.known_names.update(state['known_names'])
+    if 'complaints' in state:
+        conn.banned_users = state['complaints']
+
+    for chat, uuids in state['delivered'].items():
+        msgs = deque(filter(None, map(msg_pool.get_message_by_uuid, uuids)))
+        # The previous process could have a greater limit, the oldest messages are forgotten
+        #   and replayed on the next join, as `ConnectionPool` does on the overflow
+        if len(msgs) > UNACKED_LIMIT:
+            logger.warning(f'{conn.user_name} has not acked {len(msgs)} messages, '
+                           f'forgetting the oldest ones', extra={'category': 'connection'})
+            conn.unacked_dropped += len(msgs) - UNACKED_LIMIT
+            msgs = deque(islice(msgs, len(msgs) - UNACKED_LIMIT, None))
+        conn.delivered[chat] = msgs
+
+    return list(filter(None, map(msg_pool.get_message_by_uuid, state['backlog'])))
+
+
+# The transfer
+
+def listen_handover(path: str) -> socket.socket:
+    """
+    The socket where a new process asks for the handover, only the same user can connect to it
+    """
+
+    if os.path.exists(path):
+        os.remove(path)  # left by the previous process
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(1)
+    sock.setblocking(False)
+    return sock
+
+
+async def wait_takeover(sock: socket.socket) -> socket.socket:
+    """
+    Wait for the takeover request, return the socket of the new process
+    """
+
+    loop = asyncio.get_running_loop()
+    while True:
+        peer, _ = await loop.sock_accept(sock)
+        try:
+            request = await asyncio.wait_for(loop.sock_recv(peer, len(TAKEOVER)),
+                                             HANDOVER_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            request = b''
+        if request == TAKEOVER:
+            return peer
+        peer.close()
+
+
+def send_handover(peer: socket.socket, fds: List[int], state: dict,
+                  timeout: float = HANDOVER_TIMEOUT) -> None:
+    """
+    Send the descriptors and the pickled state, wait until the new process confirms them.
+    The descriptors stay open here, the sockets are shared by both processes now
+    """
+
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    peer.settimeout(timeout)
+    peer.send(HEADER.pack(len(fds), len(data)))
+    for start in range(0, len(fds), FDS_PER_PACKET):
+        socket.send_fds(peer, [b'f'], fds[start:start + FDS_PER_PACKET])
+    with memoryview(data) as view:
+        for start in range(0, len(data), PACKET_SIZE):
+            peer.send(view[start:start + PACKET_SIZE])
+
+    if peer.recv(len(ACK)) != ACK:
+        raise ConnectionError('The new process has not confirmed the handover')
+
+
+def take_over(path: str, timeout: float = HANDOVER_TIMEOUT) -> Handover:
+    """
+    Ask the server process listening at the path for its sockets and state
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.send(TAKEOVER)
+
+        fds_count, size = HEADER.unpack(sock.recv(HEADER.size))
+        fds: List[int] = []
+        while len(fds) < fds_count:
+            packet, packet_fds, _, _ = socket.recv_fds(sock, 1, FDS_PER_PACKET)
+            if not packet:
+                raise ConnectionError('The previous process has closed the handover socket')
+            fds.extend(packet_fds)
+
+        data = bytearray()
+        while len(data) < size:
+            packet = sock.recv(PACKET_SIZE)
+            if not packet:
+                raise ConnectionError('The previous process has closed the handover socket')
+            data += packet
+        state = pickle.loads(data)
+        sock.send(ACK)
+
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    listeners: Dict[str, List[socket.socket]] = {}
+    for name, sock in zip(state['listeners'], sockets):
+        listeners.setdefault(name, []).append(sock)
+    listeners_count = len(state['listeners'])
+    return Handover(listeners=listeners,
+                    connections=list(zip(sockets[listeners_count:], state.pop('connections'))),
+                    state=state)
@@ -0,0 +1,493 @@
+import asyncio
+import json
+import logging
+import socket
+import uuid
+from asyncio import BaseTransport
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import islice
+from http import HTTPStatus
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from services import (ConnectionPool, InfoMsgStatuses, split_command,
+                      EOS, CHANNEL, PRIVATE, MAX_FRAME_SIZE, HTTP_KEEPALIVE_TIMEOUT,
+                      HTTP_SESSION_TIMEOUT, HTTP_EVENTS_LIMIT, LONG_POLL_TIMEOUT)
+
+logger = logging.getLogger()
+
+CRLF = b'\r\n'
+EVENTS_PER_CHUNK = 100
+
+
+class HttpError(Exception):
+    def __init__(self, status: HTTPStatus, message: str = ''):
+        super().__init__(message or status.phrase)
+        self.status = status
+        self.message = message or status.phrase
+
+
+@dataclass
+class HttpRequest:
+    method: str
+    path: str
+    version: str
+    query: Dict[str, str] = field(default_factory=dict)
+    headers: Dict[str, str] = field(default_factory=dict)
+    body: bytes = b''
+    closing: bool = False  # the response is the last one of the connection
+
+    @property
+    def keep_alive(self) -> bool:
+        if self.closing:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def json(self) -> dict:
+        try:
+            data = json.loads(self.body or b'{}')
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'The body is not JSON')
+        if not isinstance(data, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'The body should be a JSON object')
+        return data
+
+    @property
+    def token(self) -> Optional[str]:
+        scheme, _, token = self.headers.get('authorization', '').partition(' ')
+        return token.strip() if scheme.lower() == 'bearer' else None
+
+
+async def read_chunked_body(reader: asyncio.StreamReader) -> bytes:
+    body = bytearray()
+    while True:
+        size_line = await reader.readline()
+        try:
+            size = int(size_line.split(b';')[0].strip(), 16)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Broken chunk size')
+        if not size:
+            break
+        if len(body) + size > MAX_FRAME_SIZE:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body += await reader.readexactly(size)
+        await reader.readexactly(2)  # CRLF after the chunk
+
+    while (await reader.readline()).strip():
+        pass  # trailers
+    return bytes(body)
+
+
+async def read_body(reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        return await read_chunked_body(reader)
+    if 'content-length' not in headers:
+        return b''
+
+    try:
+        length = int(headers['content-length'])
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Broken Content-Length')
+    if length < 0:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Broken Content-Length')
+    if length > MAX_FRAME_SIZE:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    return await reader.readexactly(length)
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[HttpRequest]:
+    """
+    Read the next request of the connection, None when the client has closed it
+    """
+
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Broken request line')
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HttpError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+
+    url = urlsplit(target)
+    request = HttpRequest(method=method, path=url.path, version=version,
+                          query={key: values[-1] for key, values in parse_qs(url.query).items()})
+
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        request.headers[name.strip().lower()] = value.strip()
+
+    request.body = await read_body(reader, request.headers)
+    return request
+
+
+def response_head(status: HTTPStatus, keep_alive: bool, length: Optional[int] = None,
+                  content_type: str = 'application/json') -> bytes:
+    headers = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type}']
+    if length is None:
+        headers.append('Transfer-Encoding: chunked')
+    else:
+        headers.append(f'Content-Length: {length}')
+    if not keep_alive:
+        headers.append('Connection: close')
+    return ('\r\n'.join(headers)).encode() + CRLF + CRLF
+
+
+def chunk(data: bytes) -> bytes:
+    return f'{len(data):x}'.encode() + CRLF + data + CRLF
+
+
+class HttpTransport(BaseTransport):
+    """
+    Transport of an HTTP session: the frames written by the pools are kept
+    as events until the client fetches them
+    """
+
+    def __init__(self, session: 'HttpSession'):
+        super().__init__()
+        self.session = session
+        self.closing = False
+
+    def write(self, data: bytes) -> None:
+        for frame in data.split(EOS):
+            if frame:
+                self.session.add_event(frame)
+
+    def writelines(self, list_of_data) -> None:
+        for data in list_of_data:
+            self.write(data)
+
+    def set_write_buffer_limits(self, high=None, low=None) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self) -> None:
+        if not self.closing:
+            self.closing = True
+            self.session.close()
+
+    def abort(self) -> None:
+        self.close()
+
+
+class HttpSession:
+    """
+    A chat user connected over HTTP.
+
+    The session drives the same protocol as a TCP connection, its transport
+    collects server frames as numbered events, `GET /messages?since=N`
+    returns the events after N and acknowledges the read messages up to N
+    """
+
+    def __init__(self, protocol: asyncio.Protocol, on_close: Callable[['HttpSession'], None]):
+        self.token = uuid.uuid4().hex
+        self.protocol = protocol
+        self.on_close = on_close
+        self.transport = HttpTransport(self)
+
+        self.events: Deque[Tuple[int, bytes]] = deque()
+        self.last_id = 0
+        self.dropped_events = 0
+        self.new_events = asyncio.Event()
+        self.closed = False
+        self.expiry: Optional[asyncio.TimerHandle] = None
+
+        protocol.connection_made(self.transport)
+        if not self.closed:  # the server is over its caps of connections
+            self.touch()
+
+    def add_event(self, frame: bytes) -> None:
+        self.last_id += 1
+        self.events.append((self.last_id, frame))
+        if len(self.events) > HTTP_EVENTS_LIMIT:
+            self.events.popleft()
+            self.dropped_events += 1
+        self.new_events.set()
+
+    def command(self, text: str) -> List[bytes]:
+        """
+        Run the command as if it came over TCP, return the frames answered at once
+        """
+
+        if '\n' in text or '\r' in text:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Line breaks are not allowed')
+        last_id = self.last_id
+        self.protocol.data_received(text.encode() + EOS)
+        answered = islice(reversed(self.events), min(self.last_id - last_id, len(self.events)))
+        return [frame for _, frame in reversed(list(answered))]
+
+    def events_after(self, since: int) -> List[Tuple[int, bytes]]:
+        return [(event_id, frame) for event_id, frame in self.events if event_id > since]
+
+    def acknowledge(self, since: int) -> None:
+        """
+        Forget the events up to `since`, the messages among them have been read
+        """
+
+        read_seqs: Dict[Tuple[str, str], int] = {}
+        prefix = InfoMsgStatuses.MESSAGE_FROM_SRV.msg_bts + b' '
+        while self.events and self.events[0][0] <= since:
+            _, frame = self.events.popleft()
+            if frame.startswith(prefix):
+                msg = json.loads(frame[len(prefix):])
+                chat = (msg['destination_type'], msg['destination_name'])
+                if msg['destination_type'] == PRIVATE:
+                    chat = (PRIVATE, msg['creator'])
+                read_seqs[chat] = max(read_seqs.get(chat, 0), msg['seq'])
+
+        for (chat_type, chat_name), seq in read_seqs.items():
+            ack = json.dumps({'destination_type': chat_type, 'destination_name': chat_name,
+                              'seq': seq})
+            self.command(f'{InfoMsgStatuses.MESSAGES_READ.value} {ack}')
+
+    async def wait_events(self, since: int, timeout: float) -> None:
+        if (self.events and self.events[-1][0] > since) or self.closed:
+            return
+        self.new_events.clear()
+        try:
+            await asyncio.wait_for(self.new_events.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def touch(self) -> None:
+        if self.expiry:
+            self.expiry.cancel()
+        loop = asyncio.get_running_loop()
+        self.expiry = loop.call_later(HTTP_SESSION_TIMEOUT, self.transport.close)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.transport.closing = True
+        if self.expiry:
+            self.expiry.cancel()
+        self.protocol.connection_lost(None)
+        self.new_events.set()
+        self.on_close(self)
+
+
+def encode_event(event_id: int, frame: bytes) -> bytes:
+    operator, args = split_command(frame)
+    if operator is None:
+        kind, data = 'text', json.dumps(frame.decode(), ensure_ascii=False).encode()
+    elif args.startswith((b'{', b'[')):
+        kind, data = operator.value, args
+    else:
+        kind, data = operator.value, json.dumps(args.decode(), ensure_ascii=False).encode()
+    return b'{"id": %d, "type": "%s", "data": %s}' % (event_id, kind.encode(), data)
+
+
+class HttpFrontend:
+    """
+    HTTP/1.1 API of the chat on asyncio streams.
+
+    Connections are persistent and pipelined requests are answered in order.
+    Sessions share the pools with the TCP clients:
+
+    - `POST /connect {"name": ...}` -> `{"token": ...}`, the token is sent as
+      `Authorization: Bearer <token>` with the other requests
+    - `GET /status` -> users and channels
+    - `POST /send {"text": ..., "chat": {"type": ..., "name": ...}}`
+    - `POST /chat {"type": ..., "name": ...}` switches the current chat
+    - `GET /messages?since=N&timeout=T` -> events after N as a chunked response
+      (with Content-Length for HTTP/1.0), the request waits up to T seconds until
+      there are events
+    - `POST /disconnect`
+    """
+
+    def __init__(self, protocol_factory: Callable[[], asyncio.Protocol], conn_pool: ConnectionPool,
+                 keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT):
+        self.protocol_factory = protocol_factory
+        self.conn_pool = conn_pool
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions: Dict[str, HttpSession] = {}
+        self.servers: List[asyncio.AbstractServer] = []
+        self.requests_count = 0
+
+        self.routes = {
+            ('POST', '/connect'): self.connect,
+            ('GET', '/status'): self.status,
+            ('POST', '/send'): self.send,
+            ('POST', '/chat'): self.change_chat,
+            ('GET', '/messages'): self.messages,
+            ('POST', '/disconnect'): self.disconnect,
+        }
+
+    async def start(self, host: str, port: int, socks: Sequence[socket.socket] = ()) -> None:
+        if socks:
+            # The listening sockets of the previous server process, see `handover`
+            self.servers = [await asyncio.start_server(self.handle, sock=sock,
+                                                       limit=MAX_FRAME_SIZE) for sock in socks]
+        else:
+            self.servers = [await asyncio.start_server(self.handle, host, port,
+                                                       limit=MAX_FRAME_SIZE)]
+        logger.info(f'HTTP API is available at http://{host}:{port}')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await self.serve(reader, writer)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass  # an idle or broken connection
+        except Exception as e:
+            logger.error(f'The HTTP request has failed: {e!r}', exc_info=True)
+            try:
+                await self.write_json(writer, HTTPStatus.INTERNAL_SERVER_ERROR,
+                                      {'error': HTTPStatus.INTERNAL_SERVER_ERROR.phrase}, False)
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), self.keepalive_timeout)
+            except HttpError as e:
+                await self.write_json(writer, e.status, {'error': e.message}, False)
+                return
+            except ValueError:  # a line over the limit of the stream reader
+                await self.write_json(writer, HTTPStatus.BAD_REQUEST,
+                                      {'error': 'The request line is too long'}, False)
+                return
+            if request is None:
+                return
+
+            self.requests_count += 1
+            await self.respond(request, writer)
+            if not request.keep_alive:
+                return
+
+    async def respond(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        handler = self.routes.get((request.method, request.path))
+        try:
+            if handler is None:
+                if any(path == request.path for _, path in self.routes):
+                    raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
+                raise HttpError(HTTPStatus.NOT_FOUND)
+            await handler(request, writer)
+        except HttpError as e:
+            await self.write_json(writer, e.status, {'error': e.message}, request.keep_alive)
+
+    @staticmethod
+    async def write_json(writer: asyncio.StreamWriter, status: HTTPStatus, data: dict,
+                         keep_alive: bool) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        writer.write(response_head(status, keep_alive, len(body)) + body)
+        await writer.drain()
+
+    def get_session(self, request: HttpRequest) -> HttpSession:
+        session = self.sessions.get(request.token or '')
+        if session is None:
+            raise HttpError(HTTPStatus.UNAUTHORIZED, 'Unknown session, connect first')
+        session.touch()
+        return session
+
+    def session_closed(self, session: HttpSession) -> None:
+        self.sessions.pop(session.token, None)
+
+    # Endpoints
+
+    async def connect(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        name = str(request.json().get('name', '')).strip()
+        if not name:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'The name is required')
+
+        session = HttpSession(self.protocol_factory(), self.session_closed)
+        if session.closed:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, 'Too many connections')
+        answer = session.command(name)
+        if not any(frame.startswith(InfoMsgStatuses.NAME_ACCEPTED.msg_bts) for frame in answer):
+            session.close()
+            errors = [frame.decode() for frame in answer if split_command(frame)[0] is None]
+            if errors:
+                raise HttpError(HTTPStatus.BAD_REQUEST, errors[0])
+            raise HttpError(HTTPStatus.CONFLICT, 'This username is already in use')
+
+        # The handshake frames are answered here, the history follows as events
+        session.events.clear()
+        self.sessions[session.token] = session
+        await self.write_json(writer, HTTPStatus.OK,
+                              {'token': session.token, 'name': name, 'last': session.last_id},
+                              request.keep_alive)
+
+    async def status(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        await self.write_json(writer, HTTPStatus.OK, self.conn_pool.roster.snapshot(),
+                              request.keep_alive)
+
+    async def send(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        session = self.get_session(request)
+        data = request.json()
+        text = str(data.get('text', ''))
+        if not text:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'The text is required')
+
+        if data.get('chat'):
+            self.switch_chat(session, data['chat'])
+        answer = session.command(f'{InfoMsgStatuses.MESSAGE_FROM_CLIENT.value} {text}')
+
+        # The protocol answers a rejected message with a plain text
+        errors = [frame.decode() for frame in answer if split_command(frame)[0] is None]
+        if errors:
+            raise HttpError(HTTPStatus.FORBIDDEN, errors[0])
+        await self.write_json(writer, HTTPStatus.ACCEPTED, {'sent': True}, request.keep_alive)
+
+    @staticmethod
+    def switch_chat(session: HttpSession, chat: dict) -> None:
+        chat_type = chat.get('type') if isinstance(chat, dict) else None
+        chat_name = str(chat.get('name', '')).strip() if chat_type else ''
+        if chat_type not in (CHANNEL, PRIVATE) or not chat_name:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Wrong chat')
+        session.command(f'{InfoMsgStatuses.CHANGE_CHAT.value} {chat_type} {chat_name}')
+
+    async def change_chat(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        session = self.get_session(request)
+        self.switch_chat(session, request.json())
+        await self.write_json(writer, HTTPStatus.OK, {'changed': True}, request.keep_alive)
+
+    async def messages(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        session = self.get_session(request)
+        try:
+            since = int(request.query.get('since', 0))
+            timeout = min(float(request.query.get('timeout', LONG_POLL_TIMEOUT)),
+                          LONG_POLL_TIMEOUT)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Wrong `since` or `timeout`')
+
+        session.acknowledge(since)
+        await session.wait_events(since, timeout)
+        events = session.events_after(since)
+        session.touch()
+
+        parts = [b'{"events": [']
+        for start in range(0, len(events), EVENTS_PER_CHUNK):
+            batch = [encode_event(event_id, frame)
+                     for event_id, frame in events[start:start + EVENTS_PER_CHUNK]]
+            parts.append((b', ' if start else b'') + b', '.join(batch))
+        last_id = events[-1][0] if events else max(since, session.last_id)
+        parts.append(f'], "last": {last_id}, "dropped": {session.dropped_events}}}'.encode())
+
+        if request.version == 'HTTP/1.0':
+            # No chunked encoding before HTTP/1.1
+            request.closing = True
+            body = b''.join(parts)
+            writer.write(response_head(HTTPStatus.OK, False, len(body)) + body)
+        else:
+            writer.write(response_head(HTTPStatus.OK, request.keep_alive))
+            writer.writelines([chunk(part) for part in parts] + [chunk(b'')])
+        await writer.drain()
+
+    async def disconnect(self, request: HttpRequest, writer: asyncio.StreamWriter) -> None:
+        self.get_session(request).close()
+        await self.write_json(writer, HTTPStatus.OK, {'disconnected': True}, request.keep_alive)
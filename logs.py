@@ -0,0 +1,162 @@
+import json
+import logging
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, TextIO
+
+from services import LOG_FORMAT, LOG_QUEUE, LOG_QUEUE_SIZE, LOG_JSON, LOG_SAMPLING
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    A record as one JSON object: time, level, logger, message and the extra fields
+    of the pipeline — category, the sample rate and the count of dropped records before it
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in ('category', 'sample_rate', 'dropped'):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes one of N records of every category from `rates`, records of other
+    categories and without a category pass. A passed record gets `sample_rate`,
+    so readers can estimate the count of the events
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = rates
+        self.seen: Dict[str, int] = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, 'category', None)
+        rate = self.rates.get(category, 1) if category else 1
+        if rate <= 1:
+            return True
+
+        seen = self.seen.get(category, 0)
+        self.seen[category] = seen + 1
+        if seen % rate:
+            self.sampled_out += 1
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records into the bounded queue without waiting, the records which don't fit
+    are counted and the next queued record tells how many of them were dropped before it
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message is merged with its arguments while they are not changed,
+        #   the formatting is left to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.unreported:
+            record.dropped = self.unreported
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+        else:
+            self.unreported = 0
+
+
+class DrainingQueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # The queue may be full, the writer thread frees it
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """
+    Logging which never blocks the event loop.
+
+    The handlers of the root logger are replaced by a handler which only puts
+    records into a bounded queue, a thread formats and writes them, so a slow
+    pipe or a busy disk doesn't delay the delivery. Frequent records are sampled
+    by their `category` (`logger.info(..., extra={'category': 'expiry'})`) before
+    they are queued, records which don't fit into the queue are dropped and counted
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None, json_format: bool = LOG_JSON,
+                 queue_size: int = LOG_QUEUE_SIZE, sampling: Optional[Dict[str, int]] = None):
+        writer = logging.StreamHandler(stream or sys.stderr)
+        writer.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+
+        self.records: queue.Queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.records)
+        self.sampling = SamplingFilter(LOG_SAMPLING if sampling is None else sampling)
+        self.handler.addFilter(self.sampling)
+        self.listener = DrainingQueueListener(self.records, writer, respect_handler_level=True)
+        self.replaced_handlers: List[logging.Handler] = []
+
+    @classmethod
+    def from_settings(cls) -> Optional['LogPipeline']:
+        """
+        The started pipeline if `LOG_QUEUE` is on
+        """
+
+        if not LOG_QUEUE:
+            return None
+        pipeline = cls()
+        pipeline.start()
+        return pipeline
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+    @property
+    def sampled_out(self) -> int:
+        return self.sampling.sampled_out
+
+    @property
+    def queued(self) -> int:
+        return self.records.qsize()
+
+    def start(self) -> None:
+        root = logging.getLogger()
+        self.replaced_handlers = root.handlers[:]
+        for handler in self.replaced_handlers:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self) -> None:
+        """
+        Write the queued records and give the logger its handlers back
+        """
+
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        for handler in self.replaced_handlers:
+            root.addHandler(handler)
+        self.listener.stop()
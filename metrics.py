@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import socket
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from services import METRICS_REQUEST_TIMEOUT
+
+logger = logging.getLogger()
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # the relative error of a histogram is under 1/16
+MAX_BUCKET_BITS = 48  # values up to 2 ** 48 units are counted, greater ones in the last bucket
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # in seconds
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """
+    Log-linear histogram in the manner of HdrHistogram.
+
+    A value is counted as an integer of `unit`s. Values below `2 * SUB_BUCKETS`
+    have their own buckets, every next power of two is split into `SUB_BUCKETS`
+    equal buckets, so recording is one `bit_length` and a list increment
+    """
+
+    __slots__ = ('unit', 'counts', 'count', 'total')
+
+    def __init__(self, unit: float = 1e-6):
+        self.unit = unit
+        self.counts: List[int] = [0] * (self.bucket_index((1 << MAX_BUCKET_BITS) - 1) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    @staticmethod
+    def bucket_index(units: int) -> int:
+        if units < 2 * SUB_BUCKETS:
+            return units
+        exponent = units.bit_length() - SUB_BUCKET_BITS - 1
+        return exponent * SUB_BUCKETS + (units >> exponent)
+
+    @staticmethod
+    def bucket_bounds(idx: int) -> Tuple[int, int]:
+        """
+        The lowest and the highest value of the bucket in units
+        """
+
+        if idx < 2 * SUB_BUCKETS:
+            return idx, idx
+        exponent = idx // SUB_BUCKETS - 1
+        mantissa = idx - exponent * SUB_BUCKETS
+        return mantissa << exponent, ((mantissa + 1) << exponent) - 1
+
+    def observe(self, value: float) -> None:
+        units = int(value / self.unit)
+        if units < 2 * SUB_BUCKETS:
+            idx = units if units > 0 else 0
+        else:
+            exponent = units.bit_length() - SUB_BUCKET_BITS - 1
+            idx = min(exponent * SUB_BUCKETS + (units >> exponent), len(self.counts) - 1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        The highest value of the bucket where the quantile falls
+        """
+
+        if not self.count:
+            return None
+        rank = max(int(q * self.count + 0.5), 1)
+        seen = 0
+        for idx, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank:
+                return self.bucket_bounds(idx)[1] * self.unit
+        return None
+
+    def cumulative(self, bounds: Tuple[float, ...]) -> List[int]:
+        """
+        Counts of values not greater than each bound, as Prometheus buckets
+        """
+
+        result = []
+        seen = 0
+        idx = 0
+        for bound in bounds:
+            while idx < len(self.counts) and self.bucket_bounds(idx)[0] * self.unit <= bound:
+                seen += self.counts[idx]
+                idx += 1
+            result.append(seen)
+        return result
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class HistogramFamily:
+    """
+    Histograms of one metric by the values of its label
+    """
+
+    def __init__(self, name: str, help_text: str, label: Optional[str],
+                 unit: float, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.unit = unit
+        self.buckets = buckets
+        self.children: Dict[str, Histogram] = {}
+
+    def labels(self, value: str = '') -> Histogram:
+        histogram = self.children.get(value)
+        if histogram is None:
+            histogram = self.children[value] = Histogram(self.unit)
+        return histogram
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for value, histogram in self.children.items():
+            label = f'{self.label}="{value}",' if self.label else ''
+            for bound, cnt in zip(self.buckets, histogram.cumulative(self.buckets)):
+                lines.append(f'{self.name}_bucket{{{label}le="{bound}"}} {cnt}')
+            lines.append(f'{self.name}_bucket{{{label}le="+Inf"}} {histogram.count}')
+            label = f'{{{label[:-1]}}}' if label else ''
+            lines.append(f'{self.name}_sum{label} {histogram.total}')
+            lines.append(f'{self.name}_count{label} {histogram.count}')
+        return lines
+
+    def snapshot(self) -> dict:
+        if not self.label:
+            return self.labels().summary()
+        return {value: histogram.summary() for value, histogram in self.children.items()}
+
+
+class MetricsRegistry:
+    """
+    Metrics of the server.
+
+    Counters and gauges are callbacks reading the counters which the pools keep
+    anyway, so they cost nothing until a scrape. Histograms record every value
+    """
+
+    def __init__(self):
+        self.__values: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+        self.__histograms: Dict[str, HistogramFamily] = {}
+
+    def counter(self, name: str, help_text: str, collect: Callable[[], float]) -> None:
+        self.__values[name] = ('counter', help_text, collect)
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], float]) -> None:
+        self.__values[name] = ('gauge', help_text, collect)
+
+    def histogram(self, name: str, help_text: str,
+                  label: Optional[str] = None,
+                  unit: float = 1e-6,
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> HistogramFamily:
+        family = self.__histograms.get(name)
+        if family is None:
+            family = self.__histograms[name] = HistogramFamily(name, help_text, label,
+                                                               unit, buckets)
+        return family
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text format
+        """
+
+        lines = []
+        for name, (kind, help_text, collect) in self.__values.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {collect()}']
+        for family in self.__histograms.values():
+            lines += family.render()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        result = {name: collect() for name, (_, _, collect) in self.__values.items()}
+        for name, family in self.__histograms.items():
+            result[name] = family.snapshot()
+        return result
+
+
+METRICS = MetricsRegistry()
+
+
+class MetricsEndpoint:
+    """
+    HTTP endpoint answering `GET /metrics` for Prometheus
+    """
+
+    def __init__(self, registry: MetricsRegistry = METRICS,
+                 request_timeout: float = METRICS_REQUEST_TIMEOUT):
+        self.registry = registry
+        self.request_timeout = request_timeout
+        self.servers: List[asyncio.AbstractServer] = []
+
+    async def start(self, host: str, port: int, socks: Sequence[socket.socket] = ()) -> None:
+        if socks:
+            # The listening sockets of the previous server process, see `handover`
+            self.servers = [await asyncio.start_server(self.handle, sock=sock) for sock in socks]
+        else:
+            self.servers = [await asyncio.start_server(self.handle, host, port)]
+        logger.info(f'Metrics are available at http://{host}:{port}/metrics')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(self.read_request(reader), self.request_timeout)
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] == b'/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass  # an idle or broken scraper
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> bytes:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers
+        return request
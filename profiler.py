@@ -0,0 +1,125 @@
+import asyncio
+import cProfile
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import CodeType
+from typing import Dict, Optional
+
+from services import PROFILE_DIR, PROFILE_SAMPLE_INTERVAL
+
+logger = logging.getLogger()
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+PROFILE_MODES = (CPROFILE, SAMPLE)
+PROFILE_SECONDS = 10  # the length of a profile when the command doesn't give it
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+class StackSampler(threading.Thread):
+    """
+    Takes the stack of the thread every `interval` seconds from a daemon thread.
+    Stacks are counted in the folded format of flame graphs: `outer;inner count`
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+        self.labels: Dict[CodeType, str] = {}
+
+    def label(self, code: CodeType) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            self.labels[code] = label
+        return label
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    """
+    Profiles the thread of the event loop for some seconds while the server runs.
+
+    `cprofile` counts every call and its time, the `.prof` file is read by `pstats`
+    or snakeviz. `sample` takes the stack every `PROFILE_SAMPLE_INTERVAL` and costs
+    much less, the `.folded` file is read by flamegraph.pl or speedscope
+    """
+
+    def __init__(self, directory: Optional[str] = PROFILE_DIR,
+                 sample_interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.directory = directory or tempfile.gettempdir()
+        self.sample_interval = sample_interval
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def recording(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, mode: str, seconds: float) -> asyncio.Task:
+        """
+        Start profiling, the task returns the path of the written profile
+        """
+
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode}')
+        if self.recording:
+            raise ProfilerBusyError('The server is being profiled already')
+        self.task = asyncio.get_running_loop().create_task(self.record(mode, seconds))
+        return self.task
+
+    async def record(self, mode: str, seconds: float) -> str:
+        loop = asyncio.get_running_loop()
+        name = f'chat-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}'
+        logger.info(f'Profiling the server by {mode} for {seconds} s')
+
+        if mode == CPROFILE:
+            path = os.path.join(self.directory, f'{name}.prof')
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            await loop.run_in_executor(None, profile.dump_stats, path)
+
+        else:
+            path = os.path.join(self.directory, f'{name}.folded')
+            sampler = StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                sampler.stop()
+            await loop.run_in_executor(None, sampler.write, path)
+
+        logger.info(f'The profile is written to {path}')
+        return path
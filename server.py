@@ -1,221 +1,991 @@
+import argparse
 import asyncio
 import json
 import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
 import uuid
 from datetime import datetime
+from functools import partial
+from typing import Optional, Dict, Tuple, List
 
 from services import (MessageItem, MessagePool, ConnectionPool, ConnectionItem, InfoMsgStatuses,
-                      EOS, CHANNEL, PRIVATE, INIT_MSGS_CNT, BLOCK_INTERVAL, GENERAL)
+                      ReplayScheduler, RATE_LIMITER, HANDOVER_PATH, HANDOVER_DRAIN_TIMEOUT,
+                      FrameReader, FrameTooLargeError, PROFILE_MAX_SECONDS,
+                      AdmissionControl, TimerWheel, HEARTBEAT, HEARTBEAT_INTERVAL,
+                      HEARTBEAT_TIMEOUT, NAME_TIMEOUT,
+                      EOS, CHANNEL, PRIVATE, GENERAL, INIT_MSGS_CNT, HISTORY_PAGE_LIMIT,
+                      WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW, PERSISTENCE_DIR, COMPACTION_INTERVAL,
+                      METRICS_HOST, METRICS_PORT, ADMIN_USERS, ROSTER_PUSH_DELAY,
+                      HTTP_PORT, JSON_ENCODING, COMPACT_ENCODING, ZLIB_BATCHES, SPILL_DIR, RESUME,
+                      new_epoch, split_command)
+from storage import MessageLog, open_message_log, open_spill_store
+from handover import (Handover, dump_pools, load_pools, dump_connection, load_connection,
+                      listen_handover, wait_takeover, send_handover, take_over)
+from dispatch import CommandDispatcher, Command, Handler, timed
+from profiler import Profiler, ProfilerBusyError, CPROFILE, SAMPLE, PROFILE_SECONDS
+from logs import LogPipeline
+from bus import MessageBusHub, MessageBusClient
+from metrics import METRICS, MetricsEndpoint, COUNT_BUCKETS
+from http_server import HttpFrontend
 
 logger = logging.getLogger()
 
-QUEUE = asyncio.Queue()
+REPLAY_EVENT = asyncio.Event()  # is set when some connections have history to replay
+EXPIRY_EVENT = asyncio.Event()  # is set when a message should be deleted earlier than expected
 
 MSG_POOL = MessagePool()
 CONNECTION_POOL = ConnectionPool()
+REPLAY = ReplayScheduler(CONNECTION_POOL)
+PROFILER = Profiler()
+ADMISSION = AdmissionControl()
+WHEEL = TimerWheel(lambda protocol: protocol.check_liveness())
+
+COMMAND_SECONDS = METRICS.histogram('chat_command_seconds', 'Time of handling a client command',
+                                    label='command')
+TASK_SECONDS = METRICS.histogram('chat_task_seconds', 'Time of one run of a background task',
+                                 label='task')
+FANOUT = METRICS.histogram('chat_fanout_recipients', 'Recipients of one message',
+                           unit=1, buckets=COUNT_BUCKETS)
+
+
+def push_roster() -> None:
+    """
+    Send the roster changes to the clients which have got the roster,
+    clients with the same version share one encoded frame
+    """
+
+    roster = CONNECTION_POOL.roster
+    for conn in CONNECTION_POOL.get_all_connections():
+        if conn.roster_version is not None and conn.roster_version != roster.version:
+            CONNECTION_POOL.write(conn, roster.delta_frame(conn.roster_version)
+                                  or roster.snapshot_frame())
+            conn.roster_version = roster.version
+
+
+def choose_name_frame() -> bytes:
+    """
+    The server offers the compact encoding, compressed history, heartbeats and resuming
+    within the epoch of the message pool, old clients ignore the options
+    """
+
+    return (f'{InfoMsgStatuses.CHOOSE_NAME.value} {COMPACT_ENCODING} {ZLIB_BATCHES} '
+            f'{HEARTBEAT} {RESUME}={MSG_POOL.epoch}').encode() + EOS
+
+
+def apply_complaint(ban_conn: ConnectionItem, who_send_ban: str) -> None:
+    """
+    Count the complaint to the user, ban it after enough complaints
+    """
+
+    if ban_conn.make_user_baned(who_send_ban):
+        CONNECTION_POOL.ban(ban_conn)
+        ban_msg = f'You has been baned until `{ban_conn.ban_time.ctime()}` '
+        ban_msg += 'and you can\'t send messages'
+        CONNECTION_POOL.write(ban_conn, ban_msg.encode() + EOS)
+
+
+def admins_only(command: Command, handler: Handler) -> Handler:
+    """
+    Commands registered with `admin=True` are run only for `ADMIN_USERS`
+    """
+
+    if not command.options.get('admin'):
+        return handler
+
+    def admin_handler(protocol: 'ChatServerProtocol', args: bytes) -> None:
+        if protocol.conn.user_name in ADMIN_USERS:
+            handler(protocol, args)
+        else:
+            protocol.write_text(f'Only admins can use `{command.label}`')
+
+    return admin_handler
+
+
+def rate_limited(command: Command, handler: Handler) -> Handler:
+    """
+    Commands registered with `rate_limited=True` are refused to banned users
+    and take a token of the rate limit of the current channel
+    """
+
+    if not command.options.get('rate_limited'):
+        return handler
+
+    def limited_handler(protocol: 'ChatServerProtocol', args: bytes) -> None:
+        conn = protocol.conn
+        channel = conn.current_connection_name if conn.current_connection_type == CHANNEL else None
+        can_send, error_text = conn.can_send_message(channel=channel)
+        if can_send:
+            handler(protocol, args)
+        else:
+            protocol.write_text(error_text)
+
+    return limited_handler
+
+
+def peer_ip(transport: asyncio.BaseTransport) -> Optional[str]:
+    peer = transport.get_extra_info('peername')
+    return peer[0] if isinstance(peer, tuple) else None
 
 
 class ChatServerProtocol(asyncio.Protocol):
+    resumed_count = 0
+    name_timeouts = 0
+    dead_peers = 0
+    # Data received while the connections of the previous process are adopted,
+    #   it is handled when all of them are in the pool
+    held_data: Optional[List[Tuple['ChatServerProtocol', bytes]]] = None
+
+    # Commands before the name set the options of the connection, other frames are the name
+    naming = CommandDispatcher([timed(COMMAND_SECONDS)])
+    commands = CommandDispatcher([timed(COMMAND_SECONDS), admins_only, rate_limited])
+
+    def __init__(self, handed_over: Optional[dict] = None):
+        self.transport = None
+        self.conn = None
+        self.frames = FrameReader()
+        self.resume: Optional[dict] = None  # the resume token sent before the name
+        self.handed_over = handed_over  # the state from the previous server process
+        self.ip: Optional[str] = None
+        self.admitted = False
+        self.last_seen = 0  # the tick of `WHEEL` when the client has sent data last time
+        self.pinged = False
 
     @staticmethod
-    def make_statistic_str() -> str:
-        usr_names_lst = CONNECTION_POOL.get_all_user_names()
-        channels_names_lst = CONNECTION_POOL.get_all_channel_names()
-
-        srv_stat = dict()
-        srv_stat['users'] = usr_names_lst
-        srv_stat['channels'] = channels_names_lst
+    def make_statistic_str(with_metrics: bool = False) -> str:
+        srv_stat = CONNECTION_POOL.roster.snapshot()
+        if with_metrics:
+            srv_stat['metrics'] = METRICS.snapshot()
 
         srv_stat_str = json.dumps(srv_stat, ensure_ascii=False)
         message = f'{InfoMsgStatuses.SET_STATISTIC.value} {srv_stat_str}'
 
         return message
 
-    def send_srv_stat(self, except_trs=None):
-        message = self.make_statistic_str()
-        for transport in CONNECTION_POOL.get_all_transports():
-            if not except_trs or transport != except_trs:
-                transport.write(message.encode())
+    def send_srv_stat(self, version: Optional[int] = None) -> None:
+        """
+        Send the roster changes after the version known by the client,
+        the whole roster if the version is unknown or too old
+        """
+
+        roster = CONNECTION_POOL.roster
+        frame = roster.delta_frame(version) if version is not None else None
+        self.write(frame or roster.snapshot_frame())
+        self.conn.roster_version = roster.version
+
+    def apply_resume(self, conn: ConnectionItem) -> Dict[Tuple[str, str], int]:
+        """
+        The client has cached the chats up to the seqs: the messages up to them are read.
+        The token is valid for the user and the epoch of the pool, return the cached seqs
+        """
+
+        resume, self.resume = self.resume, None
+        if not resume or resume.get('user') != conn.user_name \
+                or resume.get('epoch') != MSG_POOL.epoch:
+            return {}
+
+        cached = {}
+        for chat_type, chat_name, seq in resume.get('chats', []):
+            if chat_type in (CHANNEL, PRIVATE):
+                cached[(chat_type, chat_name)] = seq
+                MSG_POOL.mark_read_until(chat_type, chat_name, conn.user_name, seq)
+        ChatServerProtocol.resumed_count += 1
+        return cached
+
+    @commands.command(InfoMsgStatuses.HISTORY)
+    def send_history(self, args: bytes) -> None:
+        """
+        `history TYPE NAME [before SEQ] [limit N]`: a page of the chat history
+        before the seq, the answer has the seq to ask the next page with
+        """
+
+        try:
+            chat_type, chat_name, *options = args.decode().split()
+            options = dict(zip(options[::2], map(int, options[1::2])))
+            if chat_type not in (CHANNEL, PRIVATE):
+                raise ValueError(chat_type)
+        except ValueError:
+            self.write_text('Wrong command, write `history TYPE NAME [before SEQ] [limit N]`')
+            return
+
+        limit = min(options.get('limit', INIT_MSGS_CNT), HISTORY_PAGE_LIMIT)
+        msgs = MSG_POOL.history_page(chat_type, chat_name, self.conn.user_name,
+                                     before=options.get('before'), limit=limit)
+        before = msgs[0].seq if len(msgs) == limit else None
+
+        # The messages are taken from their cached frames
+        prefix_len = len(InfoMsgStatuses.MESSAGE_FROM_SRV.msg_bts) + 1
+        page = b', '.join(msg.frame()[prefix_len:-1] for msg in msgs)
+        header = json.dumps({'destination_type': chat_type, 'destination_name': chat_name,
+                             'before': before})
+        self.write(InfoMsgStatuses.HISTORY.msg_bts + b' ' + header[:-1].encode()
+                   + b', "messages": [' + page + b']}' + EOS)
+
+    def write(self, data: bytes) -> None:
+        CONNECTION_POOL.write(self.conn, data)
+
+    def write_text(self, text: str) -> None:
+        self.write(text.encode() + EOS)
 
     def connection_made(self, transport):
 
-        transport.write(InfoMsgStatuses.CHOOSE_NAME.msg_bts)
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
         self.transport = transport
-        conn = ConnectionItem(transport=transport, user_name=None)
-        CONNECTION_POOL.add(conn)
+        self.ip = peer_ip(transport)
+        # The connections of the previous process have been admitted there
+        if not ADMISSION.admit(self.ip, force=self.handed_over is not None):
+            transport.write(b'Too many connections, try again later' + EOS)
+            transport.close()
+            return
 
-    def data_received(self, data):  # noqa C901
+        self.admitted = True
+        self.last_seen = WHEEL.current
+        WHEEL.schedule(self, NAME_TIMEOUT)
+        self.conn = ConnectionItem(transport=transport, user_name=None)
+        if self.handed_over:
+            self.adopt(self.handed_over)
+            return
 
-        conn = CONNECTION_POOL.get_by_transport(self.transport)
-        text = data.decode().strip()
+        transport.write(choose_name_frame())
+        CONNECTION_POOL.add(self.conn)
 
-        if not conn.user_name:
+    def adopt(self, state: dict) -> None:
+        """
+        Continue the connection of the previous server process, the client doesn't notice it
+        """
 
-            if text in CONNECTION_POOL.get_all_user_names():
-                self.transport.write(InfoMsgStatuses.NAME_REJECTED.msg_bts + EOS)
-                return
+        backlog = load_connection(state, self.conn, MSG_POOL)
+        self.frames.buffer += state['pending']
+        self.resume = state['resume']
+        self.handed_over = None
+        CONNECTION_POOL.add(self.conn)
 
-            conn.user_name = text
-            self.transport.write(InfoMsgStatuses.NAME_ACCEPTED.msg_bts + b' ' + data + EOS)
+        if self.conn.deferred:
+            self.conn.deferred = False
+            self.replay_unread(self.conn)
+        REPLAY.schedule(self.conn, backlog)
 
-            # At the first connection sending all messages to the user
-            if MSG_POOL.count:
-                msgs = MSG_POOL.get_messages()
+    def pause_writing(self):
+        CONNECTION_POOL.pause_writing(self.conn)
 
-                msg_to_client = msgs
-                msgs_len = len(msgs)
-                if msgs_len > INIT_MSGS_CNT:
+    def resume_writing(self):
+        if CONNECTION_POOL.resume_writing(self.conn):
+            # Some messages have not been delivered, they are still unread
+            self.replay_unread(self.conn)
+        REPLAY.wake(self.conn)
 
-                    # Send to the client only `INIT_MSGS_CNT` last messages
-                    msg_to_client = msgs[msgs_len - INIT_MSGS_CNT:]
-                    lost_messages = msgs[:msgs_len - INIT_MSGS_CNT]
-                    for msg in lost_messages:
-                        msg.received_users.append(conn.user_name)
+    def replay_unread(self, conn: ConnectionItem) -> None:
+        """
+        Send to the connection all unread messages of its current chat
+        """
 
-                for msg in msg_to_client:
-                    QUEUE.put_nowait((msg, self.transport))
+        if conn.current_connection_type == CHANNEL:
+            msgs = MSG_POOL.get_messages(
+                destination_type=CHANNEL,
+                destination_name=conn.current_connection_name,
+                not_received_user=conn.user_name,
+                not_from_creator=conn.user_name
+            )
+
+        else:  # elif conn.current_connection_type == PRIVATE:
+            msgs = MSG_POOL.get_messages(
+                destination_type=PRIVATE,
+                destination_name=conn.user_name,
+                not_received_user=conn.user_name,
+                creator=conn.current_connection_name,
+                not_from_creator=conn.user_name
+            )
+
+        REPLAY.schedule(conn, msgs)
+
+    def data_received(self, data):
+        self.last_seen = WHEEL.current
+        if ChatServerProtocol.held_data is not None:
+            ChatServerProtocol.held_data.append((self, data))
             return
 
-        operator, *args = data.decode().strip().split(' ', 1)
+        try:
+            frames = self.frames.feed(data)
+        except FrameTooLargeError as e:
+            logger.error(f'{e}, closing the connection', extra={'category': 'connection'})
+            self.transport.close()
+            return
 
-        if operator == InfoMsgStatuses.GET_STATISTIC.value:
-            message = self.make_statistic_str().encode()
-            self.transport.write(message)
+        for frame in frames:
+            if frame.strip():
+                dispatcher = self.commands if self.conn.user_name else self.naming
+                dispatcher.dispatch(self, frame)
+
+    @naming.command(InfoMsgStatuses.ENCODING, label=InfoMsgStatuses.CHOOSE_NAME.value)
+    def choose_encoding(self, args: bytes) -> None:
+        # The client chooses the encoding and the options before its name,
+        #   a frame without any known option is a name
+        conn = self.conn
+        options = args.decode().split()
+        if not {JSON_ENCODING, COMPACT_ENCODING, ZLIB_BATCHES, HEARTBEAT}.intersection(options):
+            self.choose_name(InfoMsgStatuses.ENCODING.msg_bts + b' ' + args)
             return
+        conn.compact = COMPACT_ENCODING in options
+        conn.zlib_batches = ZLIB_BATCHES in options
+        conn.heartbeat = HEARTBEAT in options
+        accepted = [COMPACT_ENCODING if conn.compact else JSON_ENCODING]
+        if conn.zlib_batches:
+            accepted.append(ZLIB_BATCHES)
+        if conn.heartbeat:
+            accepted.append(HEARTBEAT)
+        self.write_text(f'{InfoMsgStatuses.ENCODING.value} {" ".join(accepted)}')
+
+    @naming.command(InfoMsgStatuses.RESUME, label=InfoMsgStatuses.CHOOSE_NAME.value)
+    def take_resume_token(self, args: bytes) -> None:
+        # A frame which is not a token is a name starting with `resume`
+        self.resume = self.parse_resume_token(args)
+        if self.resume is None:
+            self.choose_name(InfoMsgStatuses.RESUME.msg_bts + b' ' + args)
 
-        elif operator == InfoMsgStatuses.MESSAGE_APPROVE.value:
-            msg = json.loads(args[0])
-            id = msg['uuid']
-            user = msg['user']
-            message = MSG_POOL.get_message_by_uuid(id)
-            if message:
-                message.received_users.append(user)
+    @staticmethod
+    def parse_resume_token(args: bytes) -> Optional[dict]:
+        """
+        The token `{"epoch": ..., "user": ..., "chats": [[TYPE, NAME, SEQ], ...]}`,
+        None if it is malformed
+        """
+
+        try:
+            token = json.loads(args)
+        except ValueError:
+            return None
+        if not isinstance(token, dict) or not isinstance(token.get('chats', []), list):
+            return None
+        for chat in token.get('chats', []):
+            if not (isinstance(chat, list) and len(chat) == 3
+                    and all(isinstance(item, str) for item in chat[:2])
+                    and isinstance(chat[2], int)):
+                return None
+        return token
+
+    @naming.fallback(label=InfoMsgStatuses.CHOOSE_NAME.value)
+    def choose_name(self, frame: bytes) -> None:
+        conn = self.conn
+        name = frame.strip()
+        text = name.decode()
+
+        # Such names would be taken for the commands before the name
+        operator, _ = split_command(name)
+        if operator in (InfoMsgStatuses.ENCODING, InfoMsgStatuses.RESUME):
+            self.write_text(f'The name can\'t start with `{operator.value}`')
+            self.write(InfoMsgStatuses.NAME_REJECTED.msg_bts + EOS)
             return
 
-        elif operator == InfoMsgStatuses.CHANGE_CHAT.value:
-            chat_type, chat_name = args[0].strip().split(' ', 1)
-            conn = CONNECTION_POOL.get_by_transport(self.transport)
-            if conn:
-                conn.current_connection_type = chat_type
-                conn.current_connection_name = chat_name
-                self.transport.write(data)
-
-                if chat_type == CHANNEL:
-                    msgs = MSG_POOL.get_messages(
-                        destination_type=CHANNEL,
-                        destination_name=chat_name,
-                        not_received_user=conn.user_name,
-                        not_from_creator=conn.user_name
-                    )
-
-                else:  # elif chat_type == PRIVATE:
-                    msgs = MSG_POOL.get_messages(
-                        destination_type=PRIVATE,
-                        destination_name=conn.user_name,
-                        not_received_user=conn.user_name,
-                        creator=chat_name,
-                        not_from_creator=conn.user_name
-                    )
-
-                for msg in msgs:
-                    QUEUE.put_nowait((msg, self.transport))
-
-        elif operator == InfoMsgStatuses.BAN_USER.value:
-            who_send_ban = conn.user_name
-            banned_user = args[0]
-            ban_conn = CONNECTION_POOL.get_by_user_name(banned_user)
-            if ban_conn:
-                if ban_conn.make_user_baned(who_send_ban):
-                    ban_msg = f'You has been baned until `{ban_conn.ban_time.ctime()}` '
-                    ban_msg += 'and you can\'t send messages'
-                    ban_conn.transport.write(ban_msg.encode())
-            else:
-                logger.error(f'Can\'t find connection for user {banned_user}')
-
-        elif operator == InfoMsgStatuses.MESSAGE_FROM_CLIENT.value:
-
-            sending_to_general_channel = False
-            if conn.current_connection_type == CHANNEL and conn.current_connection_name == GENERAL:
-                sending_to_general_channel = True
-
-            can_send, error_text = conn.can_send_message(sending_to_general_channel)
-            if not can_send:
-                self.transport.write(error_text.encode())
-                return
+        if CONNECTION_POOL.has_user_name(text):
+            self.write(InfoMsgStatuses.NAME_REJECTED.msg_bts + EOS)
+            return
 
-            if sending_to_general_channel:
-                conn.increment_msgs_sent()
+        CONNECTION_POOL.set_user_name(conn, text)
+        self.write(InfoMsgStatuses.NAME_ACCEPTED.msg_bts + b' ' + name + EOS)
+
+        # At the first connection sending `INIT_MSGS_CNT` last messages of the general
+        #   channel to the user, the older ones can be fetched by `history`.
+        #   A resuming client already has the messages up to the cached seq
+        cached_seq = self.apply_resume(conn).get((CHANNEL, GENERAL), 0)
+        msgs = MSG_POOL.history_page(CHANNEL, GENERAL, limit=INIT_MSGS_CNT)
+        msgs = [msg for msg in msgs if msg.seq > cached_seq]
+        if msgs:
+            MSG_POOL.skip_history(CHANNEL, GENERAL, conn.user_name, msgs[0].seq)
+            REPLAY.schedule(conn, msgs)
+
+    @commands.command(InfoMsgStatuses.GET_STATISTIC)
+    def get_statistic(self, args: bytes) -> None:
+        if self.conn.user_name in ADMIN_USERS:
+            self.write_text(self.make_statistic_str(with_metrics=True))
+            self.conn.roster_version = CONNECTION_POOL.roster.version
+        else:
+            self.send_srv_stat(int(args) if args.isdigit() else None)
+
+    @commands.command(InfoMsgStatuses.MESSAGE_APPROVE)
+    def approve_message(self, args: bytes) -> None:
+        msg = json.loads(args)
+        message = MSG_POOL.get_message_by_uuid(msg['uuid'])
+        if message:
+            MSG_POOL.mark_received(message, msg['user'])
+
+    @commands.command(InfoMsgStatuses.MESSAGES_READ)
+    def read_messages(self, args: bytes) -> None:
+        # The client has read all messages of the chat up to the seq
+        if args.startswith(b'{'):
+            ack = json.loads(args)
+            chat_type, chat_name, seq = (ack['destination_type'], ack['destination_name'],
+                                         ack['seq'])
+        else:
+            # The compact form: `messages_read TYPE SEQ NAME`
+            chat_type, seq, chat_name = args.decode().split(' ', 2)
+            seq = int(seq)
+        msgs = CONNECTION_POOL.pop_delivered(self.conn, chat_type, chat_name, seq)
+        for message in msgs:
+            MSG_POOL.mark_received(message, self.conn.user_name)
+
+    @commands.command(InfoMsgStatuses.CHANGE_CHAT)
+    def change_chat(self, args: bytes) -> None:
+        chat_type, chat_name = args.decode().strip().split(' ', 1)
+        CONNECTION_POOL.change_chat(self.conn, chat_type, chat_name)
+        self.write(InfoMsgStatuses.CHANGE_CHAT.msg_bts + b' ' + args.strip() + EOS)
+        self.replay_unread(self.conn)
+
+    @commands.command(InfoMsgStatuses.BAN_USER)
+    def ban_user(self, args: bytes) -> None:
+        who_send_ban = self.conn.user_name
+        banned_user = args.decode()
+        ban_conn = CONNECTION_POOL.get_by_user_name(banned_user)
+        if ban_conn:
+            apply_complaint(ban_conn, who_send_ban)
+        elif banned_user in CONNECTION_POOL.remote_users:
+            # The user is connected to another worker
+            CONNECTION_POOL.forward_complaint(banned_user, who_send_ban)
+        else:
+            logger.error(f'Can\'t find connection for user {banned_user}',
+                         extra={'category': 'command'})
+
+    @commands.command(InfoMsgStatuses.MESSAGE_FROM_CLIENT, rate_limited=True)
+    def add_message(self, args: bytes) -> None:
+        if not args:
+            logger.info('Can\'t read the message text', extra={'category': 'command'})
+            return
 
-            try:
-                msg_text = args[0]
-            except IndexError:
-                logger.info('Can\'t read the message text')
-                return
+        conn = self.conn
+        msg = MessageItem(uuid=str(uuid.uuid4()), dt=datetime.now(), creator=conn.user_name,
+                          destination_type=conn.current_connection_type,
+                          destination_name=conn.current_connection_name,
+                          message=args.decode(), received_users=[]
+                          )
+
+        MSG_POOL.add(msg)
+
+        FANOUT.observe(CONNECTION_POOL.send_message(msg))
+
+    @commands.command(InfoMsgStatuses.PROFILE, admin=True)
+    def profile(self, args: bytes) -> None:
+        """
+        `profile [cprofile|sample] [SECONDS]`: profile the server for some seconds,
+        the path of the file is sent when it is written
+        """
 
-            msg = MessageItem(uuid=str(uuid.uuid4()), dt=datetime.now(), creator=conn.user_name,
-                              destination_type=conn.current_connection_type,
-                              destination_name=conn.current_connection_name,
-                              message=msg_text, received_users=[]
-                              )
+        options = args.decode().split()
+        try:
+            mode = options[0] if options else SAMPLE
+            seconds = float(options[1]) if len(options) > 1 else PROFILE_SECONDS
+            if len(options) > 2 or not 0 < seconds <= PROFILE_MAX_SECONDS:
+                raise ValueError(options)
+            task = PROFILER.start(mode, seconds)
+        except ValueError:
+            self.write_text(f'Wrong command, write `profile [{CPROFILE}|{SAMPLE}] [SECONDS]`, '
+                            f'{PROFILE_MAX_SECONDS} seconds at most')
+            return
+        except ProfilerBusyError as e:
+            self.write_text(str(e))
+            return
+
+        self.write_text(f'Profiling the server by {mode} for {seconds:g} s')
+        task.add_done_callback(self.profile_written)
+
+    def profile_written(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error:
+            logger.error(f'Can\'t write the profile: {error}')
+        if CONNECTION_POOL.get_by_transport(self.transport) is self.conn:
+            self.write_text(f'Can\'t write the profile: {error}' if error
+                            else f'The profile is written to {task.result()}')
+
+    @commands.command(InfoMsgStatuses.PONG)
+    def pong(self, args: bytes) -> None:
+        # Any data of the client proves it is alive, see `data_received`
+        pass
+
+    def check_liveness(self) -> None:
+        """
+        The timer of the connection has expired: a connection without a name is closed
+        after `NAME_TIMEOUT`, a silent client is pinged and disconnected if it doesn't answer
+        """
 
-            MSG_POOL.add(msg)
+        if self.transport.is_closing():
+            return
 
-            CONNECTION_POOL.send_message(msg)
+        if not self.conn.user_name:
+            ChatServerProtocol.name_timeouts += 1
+            self.write_text('The name has not been chosen in time')
+            self.transport.close()
+            return
+        if not self.conn.heartbeat:
             return
 
+        silent = WHEEL.elapsed(self.last_seen)
+        if silent < HEARTBEAT_INTERVAL:
+            self.pinged = False
+            WHEEL.schedule(self, HEARTBEAT_INTERVAL - silent)
+        elif not self.pinged:
+            self.pinged = True
+            self.write(InfoMsgStatuses.PING.msg_bts + EOS)
+            WHEEL.schedule(self, HEARTBEAT_TIMEOUT)
+        else:
+            ChatServerProtocol.dead_peers += 1
+            logger.info(f'{self.conn.user_name} has not answered the ping, disconnecting',
+                        extra={'category': 'connection'})
+            self.transport.abort()
+
+    @commands.fallback()
+    def ignore_unknown(self, frame: bytes) -> None:
+        # Unknown commands are only counted in the metrics
+        pass
+
     def connection_lost(self, exc):
-        CONNECTION_POOL.del_by_transport(self.transport)
+        if self.admitted:
+            ADMISSION.release(self.ip)
+            WHEEL.cancel(self)
+            CONNECTION_POOL.del_by_transport(self.transport)
 
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, data_dir=PERSISTENCE_DIR, workers=1, http_port=HTTP_PORT,
+                 handover_path=HANDOVER_PATH, takeover=False):
         self.host = host
         self.port = port
+        self.data_dir = data_dir
+        self.workers = workers
+        self.http_port = http_port
+        self.http = None
+        self.message_log = None
+        self.log_pipeline: Optional[LogPipeline] = None
+        self.roster_push = None
+        self.handover_path = handover_path
+        self.takeover = takeover
+        # Listening servers by names, one for every address
+        self.servers: Dict[str, List[asyncio.AbstractServer]] = {}
 
     async def send_messages_from_queue(self):
-
-        while True:
-            msg_item, transport = await QUEUE.get()
-            await asyncio.sleep(0.001)
-            message = f'{InfoMsgStatuses.MESSAGE_FROM_SRV.value} {msg_item.serialize()}\n'.encode()
-            transport.write(message)
-
-    async def clear_interval_limits(self):
         """
-        Clearing the history of count messages sent to the general channel
+        Replaying the history to connections, see `ReplayScheduler`
         """
 
+        REPLAY.wakeup_listener = REPLAY_EVENT.set
+
         while True:
-            await asyncio.sleep(BLOCK_INTERVAL * 60)
-            CONNECTION_POOL.clear_all_msgs_sent()
-            logger.info('Cleared the history of messages sent at the general channel')
+            await REPLAY_EVENT.wait()
+            started = time.perf_counter()
+            REPLAY.send_round()
+            TASK_SECONDS.labels('replay').observe(time.perf_counter() - started)
+            if not REPLAY.has_ready:
+                REPLAY_EVENT.clear()
+
+            # Letting other connections be served between the rounds
+            await asyncio.sleep(0)
 
     async def deleting_delivered_messages(self):
+        """
+        Deleting delivered messages, the task sleeps until the nearest message expires
+        """
+
+        MSG_POOL.expiry_listener = lambda _: EXPIRY_EVENT.set()
 
         while True:
+            started = time.perf_counter()
             del_msgs_count = MSG_POOL.delete_delivered_messages()
+            TASK_SECONDS.labels('expiry').observe(time.perf_counter() - started)
             if del_msgs_count:
-                logger.info(f'Has been deleted delivered messages ({del_msgs_count})')
-            await asyncio.sleep(0.001)
+                logger.info(f'Has been deleted delivered messages ({del_msgs_count}), '
+                            f'total {MSG_POOL.expired_count} in {MSG_POOL.expiry_time:.3f} s',
+                            extra={'category': 'expiry'})
+
+            timeout = None
+            next_expiry = MSG_POOL.next_expiry()
+            if next_expiry:
+                timeout = max((next_expiry - datetime.now()).total_seconds(), 0)
+
+            EXPIRY_EVENT.clear()
+            try:
+                await asyncio.wait_for(EXPIRY_EVENT.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def turning_wheel(self):
+        """
+        Advance the timer wheel of the connection timeouts every tick, late ticks catch up
+        """
+
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += WHEEL.tick
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
+            started = time.perf_counter()
+            WHEEL.advance()
+            TASK_SECONDS.labels('timers').observe(time.perf_counter() - started)
+
+    async def compacting_message_log(self):
+        """
+        Replacing the message log with a snapshot of the messages
+        """
+
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL * 60)
+            started = time.perf_counter()
+            await self.message_log.compact(MSG_POOL, CONNECTION_POOL)
+            TASK_SECONDS.labels('compaction').observe(time.perf_counter() - started)
+
+    def schedule_roster_push(self):
+        """
+        Roster changes are collected for `ROSTER_PUSH_DELAY` and pushed at once
+        """
+
+        if self.roster_push is None:
+            loop = asyncio.get_event_loop()
+            self.roster_push = loop.call_later(ROSTER_PUSH_DELAY, self.send_roster_changes)
+
+    def send_roster_changes(self):
+        self.roster_push = None
+        push_roster()
+
+    async def start_servers(self, worker: int, bus_path: Optional[str],
+                            listeners: Dict[str, List[socket.socket]]):
+        """
+        Start listening, on the sockets of the previous server process if it has handed them over
+        """
+
+        loop = asyncio.get_running_loop()
+        if METRICS_PORT:
+            endpoint = MetricsEndpoint()
+            await endpoint.start(METRICS_HOST, METRICS_PORT + worker,
+                                 socks=listeners.get('metrics', ()))
+            self.servers['metrics'] = endpoint.servers
+
+        if self.http_port and worker == 0:
+            # HTTP sessions live in one process, so only the first worker serves them
+            self.http = HttpFrontend(ChatServerProtocol, CONNECTION_POOL)
+            await self.http.start(self.host, self.http_port, socks=listeners.get('http', ()))
+            self.servers['http'] = self.http.servers
+            METRICS.counter('chat_http_requests_total', 'Requests to the HTTP API',
+                            lambda: self.http.requests_count)
+            METRICS.gauge('chat_http_sessions', 'Users connected over HTTP',
+                          lambda: len(self.http.sessions))
+
+        if 'chat' in listeners:
+            self.servers['chat'] = [await loop.create_server(ChatServerProtocol, sock=sock)
+                                    for sock in listeners['chat']]
+        else:
+            self.servers['chat'] = [await loop.create_server(
+                lambda: ChatServerProtocol(), self.host, self.port, reuse_port=bool(bus_path))]
+
+        for name in listeners.keys() - self.servers.keys():
+            for listener in listeners[name]:
+                listener.close()  # the server is disabled in this process
+
+    @staticmethod
+    def socket_connections() -> List[ConnectionItem]:
+        # Connections of HTTP sessions have no sockets of their own
+        return [conn for conn in CONNECTION_POOL.get_all_connections()
+                if conn.transport.get_extra_info('socket') is not None]
+
+    async def handing_over(self):
+        """
+        Wait for a new server process and hand the listening sockets, the connections
+        and the state of the pools over to it, then stop, see `handover`
+        """
+
+        loop = asyncio.get_running_loop()
+        sock = listen_handover(self.handover_path)
+        while True:
+            peer = await wait_takeover(sock)
+            logger.info('A new server process takes over')
+
+            # Commands are not read anymore, what is written is flushed to the clients.
+            #   New connections are still accepted meanwhile
+            conns = self.socket_connections()
+            for conn in conns:
+                conn.transport.pause_reading()
+            deadline = loop.time() + HANDOVER_DRAIN_TIMEOUT
+            while loop.time() < deadline and any(
+                    conn.transport.get_write_buffer_size() or conn.outbox for conn in conns
+                    if not conn.transport.is_closing()):
+                await asyncio.sleep(0.01)
+            if self.message_log:
+                await self.message_log.flush()
+
+            # Nothing below awaits, so the state doesn't change until it is sent
+            if self.hand_over(peer):
+                sock.close()
+                loop.stop()
+                return
+
+            for conn in self.socket_connections():
+                conn.transport.resume_reading()
+            peer.close()
+
+    def drained_connections(self) -> Tuple[List[ConnectionItem], int]:
+        """
+        Connections with all output flushed, the other ones are closed.
+        Return the drained connections and the count of the closed ones
+        """
+
+        conns, slow_count = [], 0
+        for conn in self.socket_connections():
+            if conn.transport.is_closing():
+                continue
+            if conn.transport.get_write_buffer_size() or conn.outbox:
+                # The client will reconnect and resume
+                conn.transport.abort()
+                slow_count += 1
+                continue
+            conn.transport.pause_reading()
+            conns.append(conn)
+        return conns, slow_count
+
+    def hand_over(self, peer: socket.socket) -> bool:
+        paused_at = time.time()
+        # One (name, descriptor) pair for every listening socket
+        listeners = [(name, listener.fileno()) for name, servers in self.servers.items()
+                     for srv in servers for listener in srv.sockets]
+        fds = [fd for _, fd in listeners]
+
+        conns, slow_count = self.drained_connections()
+        state = dump_pools(MSG_POOL, CONNECTION_POOL, RATE_LIMITER)
+        state['paused_at'] = paused_at
+        state['listeners'] = [name for name, _ in listeners]
+        state['connections'] = []
+        for conn in conns:
+            protocol = conn.transport.get_protocol()
+            state['connections'].append(
+                dump_connection(conn, bytes(protocol.frames.buffer), protocol.resume))
+            fds.append(conn.transport.get_extra_info('socket').fileno())
+
+        if self.message_log:
+            # The log is reopened by the next write if the handover fails
+            self.message_log.close()
+
+        try:
+            send_handover(peer, fds, state)
+        except OSError as e:
+            logger.error(f'The handover has failed, serving on: {e!r}')
+            return False
+
+        for servers in self.servers.values():
+            for srv in servers:
+                srv.close()
+        logger.info(f'Handed over {len(conns)} connections and {len(state["messages"])} messages '
+                    f'in {time.time() - paused_at:.3f} s, {slow_count} slow connections closed')
+        return True
+
+    def take_over(self) -> Handover:
+        handover = take_over(self.handover_path)
+        handover.names_match = load_pools(handover.state, MSG_POOL, CONNECTION_POOL,
+                                          RATE_LIMITER)
+        logger.info(f'Took over {len(handover.connections)} connections and '
+                    f'{MSG_POOL.count} messages')
+        return handover
+
+    async def adopt_connections(self, handover: Handover):
+        """
+        Serve the connections of the previous server process
+        """
+
+        logger.info(f'Accepts were paused for {time.time() - handover.state["paused_at"]:.3f} s')
+        loop = asyncio.get_running_loop()
+        ChatServerProtocol.held_data = []
+        try:
+            for sock, state in handover.connections:
+                if not handover.names_match:
+                    state['known_names'] = []  # the client gets the names again
+                await loop.connect_accepted_socket(partial(ChatServerProtocol, state), sock)
+        finally:
+            held_data, ChatServerProtocol.held_data = ChatServerProtocol.held_data, None
+        for protocol, data in held_data:
+            if not protocol.transport.is_closing():
+                protocol.data_received(data)
+
+        # Users of the previous process who have not been handed over, like HTTP ones, have left
+        for user_name in CONNECTION_POOL.roster.users:
+            if not CONNECTION_POOL.has_user_name(user_name):
+                CONNECTION_POOL.roster.remove(user_name)
+
+    def register_metrics(self):
+        METRICS.gauge('chat_messages', 'Messages in the pool', lambda: MSG_POOL.count)
+        METRICS.gauge('chat_resident_messages', 'Messages of the pool kept in memory',
+                      lambda: MSG_POOL.resident_count)
+        METRICS.gauge('chat_resident_bytes', 'Estimated memory of the resident messages',
+                      lambda: MSG_POOL.resident_bytes)
+        METRICS.counter('chat_spilled_messages_total', 'Messages moved to the spill store',
+                        lambda: MSG_POOL.spilled_total)
+        METRICS.gauge('chat_connections', 'Connections of the worker',
+                      lambda: CONNECTION_POOL.pool_len)
+        METRICS.gauge('chat_users', 'Users of all workers',
+                      lambda: len(CONNECTION_POOL.get_all_user_names()))
+        METRICS.gauge('chat_roster_version', 'Version of the roster',
+                      lambda: CONNECTION_POOL.roster.version)
+        METRICS.gauge('chat_paused_connections', 'Connections with a full write buffer',
+                      lambda: CONNECTION_POOL.paused_count)
+        METRICS.gauge('chat_outbox_frames', 'Frames waiting for paused connections',
+                      lambda: sum(len(conn.outbox)
+                                  for conn in CONNECTION_POOL.get_all_connections()))
+        METRICS.gauge('chat_replay_connections', 'Connections replaying the history',
+                      lambda: REPLAY.ready_count)
+        METRICS.gauge('chat_replay_backlog', 'Messages of the history waiting to be sent',
+                      lambda: sum(len(conn.backlog)
+                                  for conn in CONNECTION_POOL.get_all_connections()))
+        METRICS.counter('chat_frames_written_total', 'Frames written to the transports',
+                        lambda: CONNECTION_POOL.frames_written)
+        METRICS.counter('chat_bytes_written_total', 'Bytes written to the transports',
+                        lambda: CONNECTION_POOL.bytes_written)
+        METRICS.counter('chat_dropped_frames_total', 'Frames dropped for slow consumers',
+                        lambda: CONNECTION_POOL.dropped_frames)
+        METRICS.counter('chat_slow_disconnects_total', 'Slow consumers disconnected',
+                        lambda: CONNECTION_POOL.slow_disconnects)
+        METRICS.counter('chat_unacked_dropped_total',
+                        'Delivered messages forgotten without the read ack',
+                        lambda: CONNECTION_POOL.unacked_dropped)
+        METRICS.gauge('chat_rate_limit_entries', 'Token buckets of the rate limiter',
+                      lambda: RATE_LIMITER.entries_count)
+        METRICS.counter('chat_rate_limited_total', 'Messages rejected by the rate limiter',
+                        lambda: RATE_LIMITER.limited_count)
+        METRICS.counter('chat_expired_messages_total', 'Delivered messages deleted',
+                        lambda: MSG_POOL.expired_count)
+        METRICS.counter('chat_resumed_connections_total',
+                        'Connections resumed from the cache of the client',
+                        lambda: ChatServerProtocol.resumed_count)
+        METRICS.counter('chat_refused_connections_total', 'Connections above the caps',
+                        lambda: ADMISSION.refused)
+        METRICS.counter('chat_name_timeouts_total', 'Connections closed without a name',
+                        lambda: ChatServerProtocol.name_timeouts)
+        METRICS.counter('chat_dead_peers_total', 'Clients which have not answered the ping',
+                        lambda: ChatServerProtocol.dead_peers)
+        METRICS.gauge('chat_timers', 'Connection timeouts on the timer wheel', lambda: len(WHEEL))
+        if self.log_pipeline:
+            METRICS.counter('chat_logging_dropped_total', 'Log records dropped by the full queue',
+                            lambda: self.log_pipeline.dropped)
+            METRICS.counter('chat_logging_sampled_out_total', 'Log records skipped by sampling',
+                            lambda: self.log_pipeline.sampled_out)
+            METRICS.gauge('chat_logging_queued', 'Log records waiting for the writer thread',
+                          lambda: self.log_pipeline.queued)
+        if self.message_log:
+            METRICS.counter('chat_log_records_total', 'Records written to the message log',
+                            lambda: self.message_log.written_records)
+            METRICS.counter('chat_log_fsyncs_total', 'Syncs of the message log',
+                            lambda: self.message_log.fsync_count)
+            METRICS.gauge('chat_log_pending_records', 'Records waiting to be written',
+                          lambda: self.message_log.pending_count)
 
     def listen(self):
+        if self.workers > 1:
+            if self.handover_path:
+                logger.warning('The handover works with one server process, it is disabled')
+            self.run_workers()
+        else:
+            self.serve()
+
+    def run_workers(self):
+        """
+        Start the bus and the workers, they share the port with SO_REUSEPORT
+        """
+
         loop = asyncio.get_event_loop()
+        bus_path = os.path.join(tempfile.mkdtemp(prefix='chat-'), 'bus.sock')
+        hub = MessageBusHub(bus_path)
+        loop.run_until_complete(hub.start())
+
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=run_worker, daemon=True,
+                            args=(self.host, self.port, self.data_dir, worker, bus_path,
+                                  self.http_port))
+            for worker in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            os.remove(bus_path)
+
+    def serve(self, worker=0, bus_path=None):
+        loop = asyncio.get_event_loop()
+        self.log_pipeline = LogPipeline.from_settings()
+
+        # Restored messages over the memory budget go straight to the spill store
+        spill_store = open_spill_store(SPILL_DIR, MSG_POOL)
 
-        srv = loop.create_server(lambda: ChatServerProtocol(), self.host, self.port)
+        handover = self.take_over() if self.takeover else None
+
+        if worker == 0:
+            self.message_log = open_message_log(self.data_dir, MSG_POOL, CONNECTION_POOL,
+                                                restore=handover is None)
+        elif self.data_dir:
+            # Only the first worker writes the log, the others just read it.
+            #   Their seqs differ from the ones of the first worker after the restore
+            MessageLog(self.data_dir).restore(MSG_POOL, CONNECTION_POOL)
+            MSG_POOL.epoch = new_epoch()
+
+        if self.message_log:
+            loop.create_task(self.message_log.flushing())
+            loop.create_task(self.compacting_message_log())
+
+        CONNECTION_POOL.roster.change_listener = self.schedule_roster_push
+        self.register_metrics()
+
+        if bus_path:
+            bus = MessageBusClient(bus_path, worker, MSG_POOL, CONNECTION_POOL, apply_complaint)
+            loop.run_until_complete(bus.connect())
+            loop.create_task(bus.receiving())
 
         loop.create_task(self.send_messages_from_queue())
-        loop.create_task(self.clear_interval_limits())
         loop.create_task(self.deleting_delivered_messages())
-        loop.run_until_complete(srv)
+        loop.create_task(self.turning_wheel())
+        loop.run_until_complete(self.start_servers(worker, bus_path,
+                                                   handover.listeners if handover else {}))
+
+        if handover:
+            loop.run_until_complete(self.adopt_connections(handover))
+        if self.handover_path and not bus_path:
+            loop.create_task(self.handing_over())
 
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
+        finally:
+            if self.message_log:
+                self.message_log.close()
+            if spill_store:
+                spill_store.close()
+            if self.log_pipeline:
+                self.log_pipeline.stop()
+
+
+def run_worker(host, port, data_dir, worker, bus_path, http_port=None):
+    logger.info(f'Worker {worker} started')
+    Server(host, port, data_dir, http_port=http_port).serve(worker, bus_path)
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='count of server processes sharing the port')
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT,
+                        help='port of the HTTP API, it is disabled by default')
+    parser.add_argument('--handover', default=HANDOVER_PATH,
+                        help='Unix socket where a new server process takes this one over, '
+                             'it is disabled by default')
+    parser.add_argument('--takeover', action='store_true',
+                        help='take the sockets and the state over from the server at --handover')
+    cli_args = parser.parse_args()
+    if cli_args.takeover and not cli_args.handover:
+        parser.error('--takeover requires --handover')
+
     print('Choose server host (by default 127.0.0.1)')
     server_host = input()
     print('Choose server port (by default 8000)')
@@ -229,7 +999,9 @@ if __name__ == '__main__':
     else:
         server_port = int(server_port)
 
-    server = Server(host=server_host, port=server_port)
+    server = Server(host=server_host, port=server_port, workers=cli_args.workers,
+                    http_port=cli_args.http_port, handover_path=cli_args.handover,
+                    takeover=cli_args.takeover)
 
     print(f'Server started at host {server_host}:{server_port}')
 
@@ -1,59 +1,370 @@
+import asyncio
+import base64
+import heapq
 import json
 import logging
+import math
+import sys
+import time
+import zlib
+from array import array
 from asyncio import BaseTransport
-from dataclasses import dataclass
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from itertools import islice, chain, takewhile
+from secrets import token_hex
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Optional, List
+from typing import (Optional, List, Dict, Tuple, Iterator, Callable, Deque, Iterable, Union,
+                    Set, Hashable, TYPE_CHECKING)
+
+if TYPE_CHECKING:
+    from storage import SpillStore
+
+# Logging, see `logs.LogPipeline`
+LOG_FORMAT = '%(asctime)s %(name)-30s %(levelname)-8s %(message)s'
+LOG_QUEUE = False  # the server only queues records, a thread writes them, the loop never waits
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread, new ones above it are dropped
+LOG_JSON = False  # the writer thread writes records as JSON lines
+LOG_SAMPLING: Dict[str, int] = {}  # categories of frequent records: 1 of N is written
 
 logging.basicConfig(
     level='INFO',
-    format='%(asctime)s %(name)-30s %(levelname)-8s %(message)s'
+    format=LOG_FORMAT
 )
+logger = logging.getLogger()
 
 BLOCK_INTERVAL = 60  # in minutes
 AVAILABLE_MSGS = 20
 COUNT_COMPLAINT_FOR_BAN = 3
 BAN_TIME = 4 * 60  # in minutes
 INIT_MSGS_CNT = 20  # count of initial messages for the new users
+HISTORY_PAGE_LIMIT = 100  # messages of the history sent at most for one `history` command
 TIME_OF_LIFE_DELIVERED_MESSAGES = 60  # in minutes
 
 EOS = b'\n'
+MAX_FRAME_SIZE = 64 * 1024  # in bytes, a longer command without EOS closes the connection
+
+# Flow control of the server transports
+WRITE_BUFFER_HIGH = 256 * 1024  # in bytes, the transport pauses writing above it
+WRITE_BUFFER_LOW = 64 * 1024  # in bytes, the transport resumes writing below it
+OUTBOX_LIMIT = 1000  # frames waiting for a paused connection
+REPLAY_BATCH = 100  # messages of history written to a connection at once
+REPLAY_ZLIB_THRESHOLD = 200  # messages, a longer backlog is replayed by compressed batches
+REPLAY_ZLIB_BATCH = 1000  # messages of history packed into one compressed batch
+REPLAY_ZLIB_LEVEL = 6  # zlib compression level of batches, from 1 (fast) to 9 (small)
+MAX_BATCH_SIZE = 1024 * 1024  # in bytes, a larger batch frame is sent as separate frames
+UNACKED_LIMIT = 10000  # messages per chat written to a connection and waiting for the read ack
+READ_ACK_DELAY = 0.2  # in seconds, the client collects read messages into one ack
+
+# Admission and liveness of the server connections, timeouts run on `TimerWheel`
+MAX_CONNECTIONS = None  # connections of a worker, new ones above it are refused, None is unlimited
+MAX_CONNECTIONS_PER_IP = None  # connections from one IP address, None is unlimited
+NAME_TIMEOUT = 30  # in seconds, a connection which hasn't chosen a name is closed after it
+HEARTBEAT = 'heartbeat'  # the option of the handshake: the client answers `ping` by `pong`
+HEARTBEAT_INTERVAL = 30  # in seconds, a silent client is pinged after it
+HEARTBEAT_TIMEOUT = 10  # in seconds, a pinged client which stays silent is disconnected after it
+TIMER_TICK = 1  # in seconds, the precision of the timeouts
+TIMER_SLOTS = 512  # slots of the timer wheel, one turn is `TIMER_TICK * TIMER_SLOTS` seconds
+
+# Persistence, see `storage.MessageLog`
+PERSISTENCE_DIR = None  # a directory for the message log, None keeps all messages only in memory
+FSYNC_INTERVAL = 0.05  # in seconds, log records are written and synced by batches
+SEGMENT_SIZE = 64 * 1024 * 1024  # in bytes, the size of one log file
+COMPACTION_INTERVAL = 60  # in minutes, how often the log is replaced by a snapshot
+
+# Memory of the message pool, see `MessagePool.spill`
+MEMORY_BUDGET = None  # in bytes, older unread messages above it go to disk, None keeps them all
+SPILL_DIR = None  # a directory for the spilled messages, None uses the temporary one
+SPILL_BATCH = 5000  # messages moved to disk at once
+MESSAGE_OVERHEAD = 550  # in bytes, the estimated memory of a message besides its text
+
+HANDOVER_PATH = None  # a Unix socket where a new server process takes over, None disables it
+HANDOVER_DRAIN_TIMEOUT = 5  # in seconds, outbound buffers are flushed before the handover at most
+HANDOVER_TIMEOUT = 60  # in seconds, the new process waits for the sockets and the state at most
+
+# Profiling of the running server by the `profile` command of admins, see `profiler.Profiler`
+PROFILE_DIR = None  # a directory for the profile files, None uses the temporary one
+PROFILE_SAMPLE_INTERVAL = 0.005  # in seconds, how often the sampling profiler takes the stack
+PROFILE_MAX_SECONDS = 600  # the longest profile an admin can ask for
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None  # a port for Prometheus metrics, None disables the endpoint
+METRICS_REQUEST_TIMEOUT = 5  # in seconds, a scraper which doesn't send the request is dropped
+ADMIN_USERS: Tuple[str, ...] = ()  # users who get metrics by `get_statistic` and can `profile`
+
+HTTP_PORT = None  # a port for the HTTP API, None disables it
+HTTP_KEEPALIVE_TIMEOUT = 15  # in seconds, an idle HTTP connection is closed after it
+HTTP_SESSION_TIMEOUT = 60  # in seconds, an HTTP user not asking for messages is disconnected
+HTTP_EVENTS_LIMIT = 1000  # events kept for an HTTP user until they are fetched
+LONG_POLL_TIMEOUT = 30  # in seconds, the longest wait of `GET /messages`
 
 CHANNEL = 'channel'
 PRIVATE = 'private'
 GENERAL = 'general'
 
+# Encodings of messages from the server, a client asks for the compact one during the handshake
+JSON_ENCODING = 'json'
+COMPACT_ENCODING = 'compact'
+ZLIB_BATCHES = 'zlib'  # the client accepts the history as compressed batches
+COMPACT_TYPES = {CHANNEL: 'c', PRIVATE: 'p'}
+
+# Messages a user can send to a channel: channel -> (messages, minutes). Every channel
+# has a token bucket of `messages` tokens per user which refills completely in `minutes`
+RATE_LIMITS: Dict[str, Tuple[int, float]] = {GENERAL: (AVAILABLE_MSGS, BLOCK_INTERVAL)}
+RATE_LIMIT_ENTRIES = 100_000  # buckets kept by a worker at most, only full ones are evicted
+
+# The client keeps the messages it has shown in a local cache and tells the server
+# the last seqs of the cached chats on reconnect, so only newer messages are sent
+CLIENT_CACHE_DIR = '~/.chat-client'  # None disables the cache
+CLIENT_CACHE_MESSAGES = 200  # messages kept per chat
+RESUME = 'resume'  # the option of `choose_name` carrying the epoch of seqs
+RECONNECT_DELAY = 0.5  # in seconds, the first delay of `AsyncChatClient` before reconnecting
+RECONNECT_DELAY_MAX = 30  # in seconds, the delay doubles after every failed attempt up to it
+
+ROSTER_HISTORY = 1000  # roster changes kept for clients which know an older version
+ROSTER_PUSH_DELAY = 0.1  # in seconds, roster changes are collected and sent to clients at once
+
 
 class InfoMsgStatuses(Enum):
     CHOOSE_NAME = 'choose_name'
     NAME_ACCEPTED = 'name_accepted'
     NAME_REJECTED = 'name_rejected'
     GET_STATISTIC = 'get_statistic'
+    HISTORY = 'history'
     SET_STATISTIC = 'set_statistic'
     MESSAGE_FROM_SRV = 'message_from_srv'
     MESSAGE_FROM_CLIENT = 'message_from_client'
     MESSAGE_APPROVE = 'message_approve'
+    MESSAGES_READ = 'messages_read'
     CHANGE_CHAT = 'change_chat'
     BAN_USER = 'ban_user'
+    ROSTER_DELTA = 'roster_delta'
+    ENCODING = 'encoding'
+    MESSAGE_BATCH = 'message_batch'
+    COMPACT_MESSAGE = 'm'
+    NAME_ID = 'n'
+    RESUME = 'resume'
+    PROFILE = 'profile'
+    PING = 'ping'
+    PONG = 'pong'
 
     @property
     def msg_bts(self) -> bytes:
         return self.value.encode()
 
+    @classmethod
+    def from_bts(cls, operator: bytes) -> Optional['InfoMsgStatuses']:
+        return _STATUSES_BY_BTS.get(operator)
+
+
+_STATUSES_BY_BTS = {status.msg_bts: status for status in InfoMsgStatuses}
+
+
+class SlowConsumerPolicy(Enum):
+    """
+    What to do when the outbox of a paused connection is full
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+    DEFER = 'defer'  # drop new messages, they are replayed when the connection resumes
+
+
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy.DROP_OLDEST
+
+
+class FrameTooLargeError(ValueError):
+    pass
+
+
+class FrameReader:
+    """
+    Reassembly of EOS delimited commands from the stream:
+    one chunk can hold several commands and one command can come in several chunks
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        Return all commands completed by the data, without EOS
+        """
+
+        if not self.buffer:
+            frames = data.split(EOS)
+            rest = frames.pop()
+        else:
+            self.buffer += data
+            frames = []
+            start = 0
+            with memoryview(self.buffer) as view:
+                while (end := self.buffer.find(EOS, start)) >= 0:
+                    frames.append(bytes(view[start:end]))
+                    start = end + 1
+                rest = bytes(view[start:])
+            self.buffer.clear()
+
+        if len(rest) > self.max_size:
+            raise FrameTooLargeError(f'Command is longer than {self.max_size} bytes')
+
+        self.buffer += rest
+        return frames
+
+
+def split_command(frame: bytes) -> Tuple[Optional[InfoMsgStatuses], bytes]:
+    """
+    Split the command to the operator and its arguments
+    """
+
+    operator, _, args = frame.strip().partition(b' ')
+    return InfoMsgStatuses.from_bts(operator), args
+
+
+class UserIds:
+    """
+    Registry of user names: every name gets a small integer id, names are interned
+    """
+
+    def __init__(self):
+        self.__ids: Dict[str, int] = {}
+        self.__names: List[str] = []
+
+    def get_or_create(self, name: str) -> int:
+        user_id = self.__ids.get(name)
+        if user_id is None:
+            user_id = len(self.__names)
+            name = sys.intern(name)
+            self.__ids[name] = user_id
+            self.__names.append(name)
+        return user_id
+
+    def get(self, name: str) -> Optional[int]:
+        return self.__ids.get(name)
+
+    def name(self, user_id: int) -> str:
+        return self.__names[user_id]
+
+    @property
+    def names(self) -> List[str]:
+        """
+        All names in the order of their ids
+        """
+
+        return list(self.__names)
+
+
+USER_IDS = UserIds()
+NAME_IDS = UserIds()  # user and channel names referenced by ids in compact frames
+
+RECEIPTS_TUPLE_LIMIT = 8  # up to this count read receipts are kept in a tuple, then in an array
+
 
-@dataclass
 class MessageItem:
     """
     Объект одного сообщения
+
+    Read receipts are ids from `USER_IDS`: a tuple while there are a few of them,
+    then a sorted `array('I')`, so their size follows the count of readers and not
+    their ids. The frames for the client are encoded once, on first use
     """
-    uuid: str
-    dt: datetime
-    creator: str
-    destination_type: str
-    destination_name: str
-    message: str
-    received_users: List
+
+    __slots__ = ('uuid', 'ts', 'creator', 'destination_type', 'destination_name', 'message',
+                 'seq', '_receipts', '_frame', '_compact_frame')
+
+    def __init__(self,
+                 uuid: str,
+                 dt: datetime,
+                 creator: str,
+                 destination_type: str,
+                 destination_name: str,
+                 message: str,
+                 received_users: Iterable[str] = (),
+                 seq: int = 0):
+        self.uuid = uuid
+        self.ts = dt.timestamp()
+        self.creator = sys.intern(creator)
+        self.destination_type = sys.intern(destination_type)
+        self.destination_name = sys.intern(destination_name)
+        self.message = message
+        self.seq = seq  # position in the message pool, assigned by `MessagePool.add`
+        self._receipts: Union[Tuple[int, ...], array] = ()
+        self._frame: Optional[bytes] = None
+        self._compact_frame: Optional[bytes] = None
+
+        for user in received_users:
+            self.mark_received(user)
+
+    @classmethod
+    def restore(cls, uuid: str, ts: float, creator: str, destination_type: str,
+                destination_name: str, message: str, seq: int) -> 'MessageItem':
+        """
+        Create the message from stored fields without conversions
+        """
+
+        msg = cls.__new__(cls)
+        msg.uuid = uuid
+        msg.ts = ts
+        msg.creator = sys.intern(creator)
+        msg.destination_type = sys.intern(destination_type)
+        msg.destination_name = sys.intern(destination_name)
+        msg.message = message
+        msg.seq = seq
+        msg._receipts = ()
+        msg._frame = None
+        msg._compact_frame = None
+        return msg
+
+    def __repr__(self) -> str:
+        return f'MessageItem(uuid={self.uuid!r}, creator={self.creator!r}, ' \
+               f'destination={self.destination_type}:{self.destination_name})'
+
+    @property
+    def dt(self) -> datetime:
+        return datetime.fromtimestamp(self.ts)
+
+    @property
+    def received_users(self) -> List[str]:
+        return [USER_IDS.name(user_id) for user_id in self._receipts]
+
+    @property
+    def received_count(self) -> int:
+        return len(self._receipts)
+
+    def is_received_by(self, user: str) -> bool:
+        user_id = USER_IDS.get(user)
+        if user_id is None:
+            return False
+
+        receipts = self._receipts
+        if isinstance(receipts, tuple):
+            return user_id in receipts
+        idx = bisect_left(receipts, user_id)
+        return idx < len(receipts) and receipts[idx] == user_id
+
+    def mark_received(self, user: str) -> bool:
+        """
+        Add the read receipt of the user, return False if it is already there
+        """
+
+        user_id = USER_IDS.get_or_create(user)
+        receipts = self._receipts
+
+        if isinstance(receipts, tuple):
+            if user_id in receipts:
+                return False
+            if len(receipts) < RECEIPTS_TUPLE_LIMIT:
+                self._receipts = receipts + (user_id,)
+                return True
+            receipts = self._receipts = array('I', sorted(receipts))
+
+        idx = bisect_left(receipts, user_id)
+        if idx < len(receipts) and receipts[idx] == user_id:
+            return False
+        receipts.insert(idx, user_id)
+        return True
 
     def serialize(self) -> str:
         msg = {
@@ -61,11 +372,50 @@ class MessageItem:
             'creator': self.creator,
             'destination_type': self.destination_type,
             'destination_name': self.destination_name,
-            'message': self.message
+            'message': self.message,
+            'seq': self.seq
         }
 
         return json.dumps(msg)
 
+    def recipient_chat(self) -> Tuple[str, str]:
+        """
+        The chat of the message as a recipient sees it
+        """
+
+        if self.destination_type == PRIVATE:
+            return PRIVATE, self.creator
+        return self.destination_type, self.destination_name
+
+    def memory_size(self) -> int:
+        """
+        Estimated bytes of the message in the pool, the text is also kept in both frames
+        """
+
+        return MESSAGE_OVERHEAD + 3 * len(self.message)
+
+    def frame(self) -> bytes:
+        if self._frame is None:
+            self._frame = f'{InfoMsgStatuses.MESSAGE_FROM_SRV.value} {self.serialize()}\n'.encode()
+        return self._frame
+
+    def name_ids(self) -> Tuple[int, int]:
+        return NAME_IDS.get_or_create(self.creator), NAME_IDS.get_or_create(self.destination_name)
+
+    def compact_frame(self) -> bytes:
+        """
+        `m TYPE CREATOR_ID DESTINATION_ID SEQ TEXT`: no field names and no uuid,
+        the names are ids from `NAME_IDS` defined for the connection by `name_frame`
+        """
+
+        if self._compact_frame is None:
+            creator_id, destination_id = self.name_ids()
+            self._compact_frame = (
+                f'{InfoMsgStatuses.COMPACT_MESSAGE.value} {COMPACT_TYPES[self.destination_type]} '
+                f'{creator_id} {destination_id} {self.seq} {self.message}\n'
+            ).encode()
+        return self._compact_frame
+
     def target(self, destination_type: str, destination_name: str, user_name: str) -> bool:
         """
         Check, if the connection fits with the message
@@ -81,41 +431,620 @@ class MessageItem:
         return False
 
 
+def name_frame(name_id: int) -> bytes:
+    """
+    Definition of the name id for a client using the compact encoding
+    """
+
+    return f'{InfoMsgStatuses.NAME_ID.value} {name_id} {NAME_IDS.name(name_id)}\n'.encode()
+
+
+_TYPES_BY_COMPACT = {compact: chat_type for chat_type, compact in COMPACT_TYPES.items()}
+
+
+def decode_compact_message(args: bytes, names: Dict[int, str]) -> dict:
+    """
+    The message of a compact frame in the shape of the JSON one, without uuid
+    """
+
+    chat_type, creator_id, destination_id, seq, text = args.split(b' ', 4)
+    return {
+        'uuid': None,
+        'creator': names.get(int(creator_id), creator_id.decode()),
+        'destination_type': _TYPES_BY_COMPACT[chat_type.decode()],
+        'destination_name': names.get(int(destination_id), destination_id.decode()),
+        'message': text.decode(),
+        'seq': int(seq),
+    }
+
+
+class PoolListener:
+    """
+    Receiver of the pools events, e.g. the message log or the bus between workers
+    """
+
+    def message_added(self, msg: MessageItem) -> None:
+        pass
+
+    def message_received(self, msg: MessageItem, user: str) -> None:
+        pass
+
+    def user_banned(self, user: str, ban_time: datetime) -> None:
+        pass
+
+    def user_joined(self, conn: 'ConnectionItem') -> None:
+        pass
+
+    def chat_changed(self, conn: 'ConnectionItem') -> None:
+        pass
+
+    def user_left(self, conn: 'ConnectionItem') -> None:
+        pass
+
+    def user_complained(self, user: str, who_send_ban: str) -> None:
+        pass
+
+    def history_skipped(self, destination_type: str, destination_name: str, user: str,
+                        seq: int) -> None:
+        pass
+
+
+def new_epoch() -> str:
+    return token_hex(6)
+
+
+def _message_seq(msg: MessageItem) -> int:
+    return msg.seq
+
+
+class MessageBucket:
+    """
+    Messages of one index key in order of arrival.
+    Removed messages leave a hole which is compacted lazily
+    """
+
+    __slots__ = ('seqs', 'items', 'holes')
+
+    def __init__(self):
+        self.seqs: List[int] = []
+        self.items: List[Optional[MessageItem]] = []
+        self.holes = 0
+
+    def __len__(self) -> int:
+        return len(self.items) - self.holes
+
+    def append(self, msg: MessageItem) -> None:
+        self.seqs.append(msg.seq)
+        self.items.append(msg)
+
+    def remove(self, msg: MessageItem) -> None:
+        idx = bisect_left(self.seqs, msg.seq)
+        if idx < len(self.items) and self.items[idx] is msg:
+            self.items[idx] = None
+            self.holes += 1
+            if self.holes > 32 and self.holes * 2 > len(self.items):
+                self.compact()
+
+    def compact(self) -> None:
+        alive = [(seq, msg) for seq, msg in zip(self.seqs, self.items) if msg is not None]
+        self.seqs = [seq for seq, _ in alive]
+        self.items = [msg for _, msg in alive]
+        self.holes = 0
+
+    def get(self, seq: int) -> Optional[MessageItem]:
+        idx = bisect_left(self.seqs, seq)
+        if idx < len(self.seqs) and self.seqs[idx] == seq:
+            return self.items[idx]
+        return None
+
+    def iter_from(self, seq: int = 0) -> Iterator[MessageItem]:
+        for idx in range(bisect_left(self.seqs, seq), len(self.items)):
+            msg = self.items[idx]
+            if msg is not None:
+                yield msg
+
+    def iter_before(self, seq: Optional[int] = None) -> Iterator[MessageItem]:
+        """
+        Messages with the seq lower than the given one, the newest first
+        """
+
+        end = len(self.items) if seq is None else bisect_left(self.seqs, seq)
+        for idx in range(end - 1, -1, -1):
+            msg = self.items[idx]
+            if msg is not None:
+                yield msg
+
+
+class ReadCursor:
+    """
+    Unread messages of one user in one index key: every message with the seq lower
+    than `seq` has been scanned, the unread ones among them are in `gaps`
+    """
+
+    __slots__ = ('seq', 'gaps')
+
+    def __init__(self, seq: int = 0):
+        self.seq = seq
+        self.gaps: List[int] = []
+
+    @property
+    def read_until(self) -> int:
+        """
+        The seq below which the user has received (or written) every message
+        """
+
+        return self.gaps[0] if self.gaps else self.seq
+
+    def skip(self, seq: int) -> None:
+        self.seq = max(self.seq, seq)
+        self.gaps = self.gaps[bisect_left(self.gaps, seq):]
+
+
 class MessagePool:
-    __pool = []
+    """
+    Storage of all messages.
+
+    Messages are kept in a uuid -> message dict and additionally indexed by
+    destination (`destination_type`, `destination_name`) and, for private
+    messages, by (recipient, creator). For every index key and user the pool
+    remembers a read cursor: the seq up to which the messages have been scanned and
+    the seqs of the unread ones, so unread queries cost the count of unread messages.
+
+    Delivered messages are expired from a min-heap ordered by the expiry time,
+    a message gets there when the first user receives it.
+
+    With a spill store and a memory budget the oldest messages nobody has received
+    leave memory when the budget is exceeded, a bucket without resident messages is
+    dropped. In the running loop the store is written from an executor thread and
+    the messages stay resident until the write is done. Queries read the spilled
+    messages back from the store by pages merged with the resident ones, the read
+    cursors are kept for them
+    """
+
+    def __init__(self, memory_budget: Optional[int] = MEMORY_BUDGET):
+        # Seqs are comparable only within one epoch: a pool restored from the log keeps
+        # the epoch of the log, a fresh pool starts a new one
+        self.epoch = new_epoch()
+
+        self.__items: Dict[str, MessageItem] = {}
+        self.__by_destination: Dict[Tuple, MessageBucket] = {}
+        self.__by_private: Dict[Tuple, MessageBucket] = {}
+        self.__cursors: Dict[Tuple, Dict[str, ReadCursor]] = {}
+        self.__last_seq = 0
+        self.__expiry: List[Tuple[float, int, MessageItem]] = []
+        self.__expired_count = 0
+        self.__expiry_time = 0.0
+        self.__resident_bytes = 0
+        self.__spilled_total = 0
+
+        # Resident messages nobody has received in order of arrival, the next ones to spill
+        self.__spill_candidates: 'OrderedDict[str, MessageItem]' = OrderedDict()
+        self.__spilling = False
+        # Messages being written to the store and stale copies being deleted from it,
+        #   their stored copies are hidden from queries
+        self.__unsynced: Set[str] = set()
+
+        self.memory_budget = memory_budget
+        self.spill_store: Optional['SpillStore'] = None
+
+        # Called with the new nearest expiry time when it moves earlier
+        self.expiry_listener: Optional[Callable[[datetime], None]] = None
+
+        self.listeners: List[PoolListener] = []
+
+    @staticmethod
+    def _destination_key(destination_type: str, destination_name: str) -> Tuple:
+        return destination_type, destination_name
+
+    @staticmethod
+    def _private_key(recipient: str, creator: str) -> Tuple:
+        return PRIVATE, recipient, creator
 
     def add(self, msg: MessageItem):
-        self.__pool.append(msg)
+        # A restored message keeps its seq
+        if msg.seq > self.__last_seq:
+            self.__last_seq = msg.seq
+        else:
+            self.__last_seq += 1
+            msg.seq = self.__last_seq
+        self.__items[msg.uuid] = msg
+        self.__resident_bytes += msg.memory_size()
+
+        for index, key in self._index_keys(msg):
+            self._add_to_index(index, key, msg)
+
+        if msg.received_count:
+            self._schedule_expiry(msg)
+        else:
+            self.__spill_candidates[msg.uuid] = msg
+
+        for listener in self.listeners:
+            listener.message_added(msg)
+
+        # Without candidates a pass would find nothing, received messages expire anyway
+        if self.spill_store and self.memory_budget and self.__spill_candidates \
+                and not self.__spilling and self.__resident_bytes > self.memory_budget:
+            self.spill()
+
+    def _index_keys(self, msg: MessageItem) -> Iterator[Tuple[Dict[Tuple, MessageBucket], Tuple]]:
+        yield self.__by_destination, self._destination_key(msg.destination_type,
+                                                           msg.destination_name)
+        if msg.destination_type == PRIVATE:
+            yield self.__by_private, self._private_key(msg.destination_name, msg.creator)
+
+    def spill(self) -> int:
+        """
+        Move up to `SPILL_BATCH` oldest messages nobody has received to the spill store,
+        return the count of moved messages. Received messages stay, they expire soon anyway
+        """
+
+        excess = self.__resident_bytes - (self.memory_budget or 0)
+        batch = []
+        while self.__spill_candidates and excess > 0 and len(batch) < SPILL_BATCH:
+            _, msg = self.__spill_candidates.popitem(last=False)
+            batch.append(msg)
+            excess -= msg.memory_size()
+
+        if not batch:
+            return 0
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # the pool is restored before the loop runs
+            self.spill_store.put(batch)
+            self._evict(batch)
+            return len(batch)
+
+        self.__spilling = True
+        self.__unsynced.update(msg.uuid for msg in batch)
+        written = loop.run_in_executor(None, self.spill_store.put, batch)
+        written.add_done_callback(lambda future: self._spilled(batch, future))
+        return len(batch)
+
+    def _spilled(self, batch: List[MessageItem], future: asyncio.Future) -> None:
+        self.__spilling = False
+        error = future.exception() if not future.cancelled() else asyncio.CancelledError()
+        if error is not None:
+            # The messages stay resident, they are not offered again
+            logger.error(f'Can\'t spill {len(batch)} messages: {error!r}')
+            self.__unsynced.difference_update(msg.uuid for msg in batch)
+            return
+
+        stale = {msg.uuid for msg in self._evict(batch)}
+        self.__unsynced.difference_update(msg.uuid for msg in batch if msg.uuid not in stale)
+        if stale:
+            uuids = list(stale)
+            deleted = asyncio.get_running_loop().run_in_executor(
+                None, self.spill_store.delete_many, uuids)
+            deleted.add_done_callback(lambda _: self.__unsynced.difference_update(uuids))
+
+        if self.__spill_candidates and self.__resident_bytes > (self.memory_budget or 0):
+            self.spill()
+
+    def _evict(self, batch: List[MessageItem]) -> List[MessageItem]:
+        """
+        Drop the written messages from memory, return the ones which have been received
+        or deleted while they were written, their stored copies are stale
+        """
+
+        stale = []
+        for msg in batch:
+            if not self._is_resident(msg) or msg.received_count:
+                stale.append(msg)
+                continue
+            del self.__items[msg.uuid]
+            self.__resident_bytes -= msg.memory_size()
+            for index, key in self._index_keys(msg):
+                self._remove_from_index(index, key, msg)
+
+        self.__spilled_total += len(batch) - len(stale)
+        return stale
+
+    def _stored(self, msgs: Iterator[MessageItem]) -> Iterator[MessageItem]:
+        # The resident copies of unsynced messages are the actual ones
+        if self.__unsynced:
+            unsynced = self.__unsynced
+            return (msg for msg in msgs if msg.uuid not in unsynced)
+        return msgs
+
+    def _is_resident(self, msg: MessageItem) -> bool:
+        return self.__items.get(msg.uuid) is msg
+
+    def mark_received(self, msg: MessageItem, user: str) -> None:
+        """
+        Remember that the user has received the message
+        """
+
+        if self.spill_store and not self._is_resident(msg):
+            # A copy read from the spill store, the receipt goes to the stored message
+            msg = self.spill_store.mark_received(msg.uuid, user)
+            if msg is None:
+                return
+        elif not msg.mark_received(user):
+            return
+
+        if msg.received_count == 1:
+            self.__spill_candidates.pop(msg.uuid, None)
+            self._schedule_expiry(msg)
+
+        for listener in self.listeners:
+            listener.message_received(msg, user)
+
+    def _schedule_expiry(self, msg: MessageItem) -> None:
+        expire_at = msg.ts + TIME_OF_LIFE_DELIVERED_MESSAGES * 60
+        heapq.heappush(self.__expiry, (expire_at, msg.seq, msg))
+
+        if self.__expiry[0][2] is msg and self.expiry_listener:
+            self.expiry_listener(datetime.fromtimestamp(expire_at))
+
+    def remove(self, msg: MessageItem) -> bool:
+        resident = self.__items.pop(msg.uuid, None)
+        if resident is not None:
+            self.__spill_candidates.pop(msg.uuid, None)
+            self.__resident_bytes -= resident.memory_size()
+            for index, key in self._index_keys(resident):
+                self._remove_from_index(index, key, resident)
+            return True
+
+        return bool(self.spill_store and self.spill_store.delete(msg.uuid))
+
+    @staticmethod
+    def _add_to_index(index: Dict[Tuple, MessageBucket], key: Tuple, msg: MessageItem) -> None:
+        bucket = index.get(key)
+        if bucket is None:
+            bucket = index[key] = MessageBucket()
+        bucket.append(msg)
+
+    def _remove_from_index(self, index: Dict[Tuple, MessageBucket], key: Tuple,
+                           msg: MessageItem) -> None:
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket.remove(msg)
+        if not bucket:
+            del index[key]
+            if not self.has_spilled:
+                self.__cursors.pop(key, None)
+
+    @property
+    def last_seq(self) -> int:
+        return self.__last_seq
+
+    @last_seq.setter
+    def last_seq(self, seq: int) -> None:
+        # Seqs are never reused within the epoch, even of deleted messages
+        self.__last_seq = max(self.__last_seq, seq)
 
     @property
     def count(self) -> int:
-        return len(self.__pool)
+        return len(self.__items) + self.spilled_count
+
+    @property
+    def resident_count(self) -> int:
+        return len(self.__items)
+
+    @property
+    def resident_bytes(self) -> int:
+        """
+        Estimated memory of the resident messages, see `MessageItem.memory_size`
+        """
+
+        return self.__resident_bytes
+
+    @property
+    def spilled_count(self) -> int:
+        return self.spill_store.count if self.spill_store else 0
+
+    @property
+    def has_spilled(self) -> bool:
+        return bool(self.spill_store and self.spill_store.count)
+
+    @property
+    def spilled_total(self) -> int:
+        return self.__spilled_total
+
+    def all_messages(self) -> Iterator[MessageItem]:
+        if self.spill_store:
+            return chain(self._stored(self.spill_store.iter_all()), self.__items.values())
+        return iter(self.__items.values())
 
     def serialize(self):
-        return json.dumps([item.message for item in self.__pool], ensure_ascii=False).encode()
+        return json.dumps([item.message for item in self.__items.values()],
+                          ensure_ascii=False).encode()
 
     def get_message_by_uuid(self, uuid: str) -> Optional[MessageItem]:
-        msgs = filter(lambda msg: msg.uuid == uuid, self.__pool)
-        try:
-            item = next(msgs)
-        except StopIteration:
-            item = None
-        return item
+        msg = self.__items.get(uuid)
+        if msg is None and self.spill_store and uuid not in self.__unsynced:
+            msg = self.spill_store.get(uuid)
+        return msg
+
+    def _iter_from(self, key: Tuple, bucket: MessageBucket, seq: int = 0) -> Iterator[MessageItem]:
+        """
+        Messages of the bucket from the seq in order of arrival, with the spilled ones
+        """
 
-    def get_messages(self,
-                     destination_type: str = CHANNEL,
-                     destination_name: str = GENERAL,
-                     not_received_user: Optional[str] = None,
-                     creator: Optional[str] = None,
-                     not_from_creator: Optional[str] = None,
-                     ) -> List[MessageItem]:
+        msgs = bucket.iter_from(seq)
+        if self.has_spilled:
+            msgs = heapq.merge(self._stored(self.spill_store.iter_chat(*key, since=seq)), msgs,
+                               key=_message_seq)
+        return msgs
 
+    def _iter_before(self, key: Tuple, bucket: MessageBucket,
+                     seq: Optional[int] = None) -> Iterator[MessageItem]:
         """
-        Get all messages with given parameters
+        Messages of the bucket with the seq lower than the given one, the newest first,
+        with the spilled ones
         """
 
-        now = datetime.now()
-        msgs = filter(lambda msg: msg.dt < now, self.__pool)
+        msgs = bucket.iter_before(seq)
+        if self.has_spilled:
+            spilled = self.spill_store.iter_chat(*key, before=seq, descending=True)
+            msgs = heapq.merge(msgs, self._stored(spilled), key=_message_seq, reverse=True)
+        return msgs
+
+    def _choose_index(self,
+                      destination_type: Optional[str],
+                      destination_name: Optional[str],
+                      creator: Optional[str],
+                      ) -> Tuple[Optional[Tuple], Optional[MessageBucket]]:
+        """
+        Find the narrowest index for the query, (None, None) means a full scan
+        """
+
+        if destination_type == PRIVATE and destination_name and creator:
+            key = self._private_key(destination_name, creator)
+            return key, self.__by_private.get(key, MessageBucket())
+
+        if destination_type and destination_name:
+            key = self._destination_key(destination_type, destination_name)
+            return key, self.__by_destination.get(key, MessageBucket())
+
+        return None, None
+
+    def _message_at(self, bucket: MessageBucket, seq: int) -> Optional[MessageItem]:
+        msg = bucket.get(seq)
+        if msg is None and self.has_spilled:
+            msg = self.spill_store.get_by_seq(seq)
+            if msg is not None and msg.uuid in self.__unsynced:
+                return None
+        return msg
+
+    def _cursor(self, key: Tuple, user: str) -> ReadCursor:
+        cursors = self.__cursors.setdefault(key, {})
+        cursor = cursors.get(user)
+        if cursor is None:
+            cursor = cursors[user] = ReadCursor()
+        return cursor
+
+    def _iter_unread(self, key: Tuple, bucket: MessageBucket, user: str) -> Iterator[MessageItem]:
+        """
+        Yield messages of the bucket which were neither received nor written by the user:
+        the still unread gaps of the user's read cursor, then the messages after it
+        """
+
+        cursor = self._cursor(key, user)
+
+        gaps = []
+        for seq in cursor.gaps:
+            msg = self._message_at(bucket, seq)
+            if msg is not None and not msg.is_received_by(user):
+                gaps.append(msg)
+        cursor.gaps = [msg.seq for msg in gaps]
+        yield from gaps
+
+        for msg in self._iter_from(key, bucket, cursor.seq):
+            cursor.seq = msg.seq + 1
+            if msg.creator != user and not msg.is_received_by(user):
+                cursor.gaps.append(msg.seq)
+                yield msg
+
+    def skip_history(self, destination_type: str, destination_name: str, user: str,
+                     seq: int) -> None:
+        """
+        Treat the messages of the chat with the seq lower than the given one as read
+        by the user, without marking every one of them
+        """
+
+        key = self._destination_key(destination_type, destination_name)
+        cursor = self._cursor(key, user)
+        if seq > cursor.read_until:
+            cursor.skip(seq)
+            for listener in self.listeners:
+                listener.history_skipped(destination_type, destination_name, user, seq)
+
+    def skipped_history(self) -> Iterator[Tuple[str, str, str, int]]:
+        """
+        Read cursors of the chats: (destination type, destination name, user, seq)
+        """
+
+        for key, cursors in self.__cursors.items():
+            if len(key) == 2:
+                for user, cursor in cursors.items():
+                    yield key[0], key[1], user, cursor.read_until
+
+    def mark_read_until(self, chat_type: str, chat_name: str, user: str, seq: int) -> int:
+        """
+        Mark the unread messages of the chat, as the user sees it, up to the seq
+        as received by the user. Return the count of marked messages
+        """
+
+        if chat_type == PRIVATE:
+            msgs = self.iter_messages(PRIVATE, user, not_received_user=user, creator=chat_name,
+                                      not_from_creator=user)
+        else:
+            msgs = self.iter_messages(chat_type, chat_name, not_received_user=user,
+                                      not_from_creator=user)
+
+        read = list(takewhile(lambda msg: msg.seq <= seq, msgs))
+        for msg in read:
+            self.mark_received(msg, user)
+        return len(read)
+
+    def iter_history(self, destination_type: str, destination_name: str,
+                     user: Optional[str] = None,
+                     before: Optional[int] = None) -> Iterator[MessageItem]:
+        """
+        Lazily yield messages of the chat with the seq lower than `before`, the newest first.
+        The private chat of the user with `destination_name` has the messages of both sides
+        """
+
+        if destination_type == PRIVATE:
+            keys = [self._private_key(user, destination_name),
+                    self._private_key(destination_name, user)]
+            sides = [self._iter_before(key, self.__by_private.get(key, MessageBucket()), before)
+                     for key in keys]
+            return heapq.merge(*sides, key=_message_seq, reverse=True)
+
+        key = self._destination_key(destination_type, destination_name)
+        return self._iter_before(key, self.__by_destination.get(key, MessageBucket()), before)
+
+    def history_page(self, destination_type: str, destination_name: str,
+                     user: Optional[str] = None,
+                     before: Optional[int] = None,
+                     limit: int = INIT_MSGS_CNT) -> List[MessageItem]:
+        """
+        Up to `limit` messages before the seq in order of arrival, see `iter_history`
+        """
+
+        page = list(islice(self.iter_history(destination_type, destination_name, user, before),
+                           limit))
+        page.reverse()
+        return page
+
+    def get_messages(self, *args, **kwargs) -> List[MessageItem]:
+        """
+        Get all messages with given parameters, see `iter_messages`
+        """
+
+        return list(self.iter_messages(*args, **kwargs))
+
+    def iter_messages(self,
+                      destination_type: str = CHANNEL,
+                      destination_name: str = GENERAL,
+                      not_received_user: Optional[str] = None,
+                      creator: Optional[str] = None,
+                      not_from_creator: Optional[str] = None,
+                      ) -> Iterator[MessageItem]:
+
+        """
+        Lazily yield messages with given parameters in order of arrival
+        """
+
+        key, bucket = self._choose_index(destination_type, destination_name, creator)
+
+        msgs: Iterator[MessageItem]
+        if bucket is not None and not bucket and not self.has_spilled:
+            return iter(())
+        elif bucket is None:
+            msgs = self.all_messages()
+        elif not_received_user and not_received_user == not_from_creator:
+            # The most frequent query: unread messages of a chat, they start from the cursor
+            msgs = self._iter_unread(key, bucket, not_received_user)
+        else:
+            msgs = self._iter_from(key, bucket)
+
+        now = time.time()
+        msgs = filter(lambda msg: msg.ts < now, msgs)
 
         if creator:
             msgs = filter(lambda msg: msg.creator == creator, msgs)
@@ -127,30 +1056,162 @@ class MessagePool:
             msgs = filter(lambda msg: msg.destination_name == destination_name, msgs)
 
         if not_received_user:
-            msgs = filter(lambda msg: not_received_user not in msg.received_users, msgs)
+            msgs = filter(lambda msg: not msg.is_received_by(not_received_user), msgs)
 
         if not_from_creator:
             msgs = filter(lambda msg: not_from_creator != msg.creator, msgs)
 
-        return list(msgs)
+        return msgs
+
+    def next_expiry(self) -> Optional[datetime]:
+        """
+        The time when the nearest delivered message should be deleted
+        """
+
+        return datetime.fromtimestamp(self.__expiry[0][0]) if self.__expiry else None
+
+    @property
+    def expired_count(self) -> int:
+        return self.__expired_count
+
+    @property
+    def expiry_time(self) -> float:
+        """
+        Seconds spent on deleting of delivered messages
+        """
+
+        return self.__expiry_time
 
     def delete_delivered_messages(self) -> int:
-        now = datetime.now()
-        msgs = filter(lambda msg:
-                      msg.dt + timedelta(minutes=TIME_OF_LIFE_DELIVERED_MESSAGES) < now
-                      and len(msg.received_users) > 0,
-                      self.__pool)
+        started = time.perf_counter()
+        now = time.time()
+        msgs_cnt = 0
 
-        msgs_lst = list(msgs)
-        msgs_cnt = len(msgs_lst)
+        while self.__expiry and self.__expiry[0][0] < now:
+            _, _, msg = heapq.heappop(self.__expiry)
+            if self._is_resident(msg) or (self.spill_store and msg.uuid not in self.__items):
+                if self.remove(msg):
+                    msgs_cnt += 1
 
-        for msg in msgs_lst:
-            self.__pool.remove(msg)
-            del msg
+        self.__expired_count += msgs_cnt
+        self.__expiry_time += time.perf_counter() - started
 
         return msgs_cnt
 
 
+class RateLimiter:
+    """
+    Token buckets of users by channels.
+
+    A bucket is refilled lazily at every send, so there is no periodic reset and
+    the check is O(1). Buckets are keyed by the user name and survive reconnects.
+    They are kept in the order of use, the least recently used ones are evicted
+    when they are full again and so do not differ from new ones. A bucket which
+    is not full is never evicted: while all `max_entries` buckets are in use,
+    new senders are limited.
+
+    Every worker process has its own limiter, the buckets are not shared between workers
+    """
+
+    def __init__(self,
+                 limits: Dict[str, Tuple[int, float]] = RATE_LIMITS,
+                 max_entries: int = RATE_LIMIT_ENTRIES):
+        # channel -> (capacity, tokens per second)
+        self.config = dict(limits)
+        self.limits = {channel: (messages, messages / (minutes * 60))
+                       for channel, (messages, minutes) in limits.items()}
+        self.max_entries = max_entries
+        self.limited_count = 0
+
+        # (user name, channel) -> [tokens, monotonic time of the update]
+        self.__buckets: OrderedDict[Tuple[str, str], List[float]] = OrderedDict()
+
+    @property
+    def entries_count(self) -> int:
+        return len(self.__buckets)
+
+    def _lru_full_after(self, now: float) -> float:
+        """
+        Seconds until the least recently used bucket is full again
+        """
+
+        (_, channel), (tokens, updated_at) = next(iter(self.__buckets.items()))
+        capacity, rate = self.limits[channel]
+        return max(capacity - tokens - (now - updated_at) * rate, 0) / rate
+
+    def _evict(self, now: float) -> None:
+        while self.__buckets and not self._lru_full_after(now):
+            self.__buckets.popitem(last=False)
+
+    def _has_room(self, user_name: str, channel: str) -> bool:
+        return (user_name, channel) in self.__buckets or len(self.__buckets) < self.max_entries
+
+    def _refill(self, user_name: str, channel: str, now: float) -> List[float]:
+        capacity, rate = self.limits[channel]
+        key = (user_name, channel)
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            bucket = self.__buckets[key] = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self.__buckets.move_to_end(key)
+        return bucket
+
+    def acquire(self, user_name: str, channel: str, now: Optional[float] = None) -> bool:
+        """
+        Take a token for one message, False means the limit is reached
+        """
+
+        if channel not in self.limits:
+            return True
+
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        # Evicting a bucket in use would let its sender start over with a full one
+        bucket = self._refill(user_name, channel, now) \
+            if self._has_room(user_name, channel) else [0]
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+
+        self.limited_count += 1
+        return False
+
+    def retry_after(self, user_name: str, channel: str, now: Optional[float] = None) -> float:
+        """
+        Seconds until the user can send a message to the channel
+        """
+
+        if channel not in self.limits:
+            return 0
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        if not self._has_room(user_name, channel):
+            return self._lru_full_after(now)
+        tokens, _ = self._refill(user_name, channel, now)
+        return max(1 - tokens, 0) / self.limits[channel][1]
+
+    def snapshot(self, now: Optional[float] = None) -> List[Tuple[str, str, float, float]]:
+        """
+        Buckets as (user name, channel, tokens, seconds since the update), the least recent first
+        """
+
+        now = time.monotonic() if now is None else now
+        return [(user_name, channel, tokens, now - updated_at)
+                for (user_name, channel), (tokens, updated_at) in self.__buckets.items()]
+
+    def load(self, entries: Iterable[Tuple[str, str, float, float]],
+             now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        for user_name, channel, tokens, age in entries:
+            if channel in self.limits:
+                self.__buckets[(user_name, channel)] = [tokens, now - age]
+
+
+RATE_LIMITER = RateLimiter()
+
+
 @dataclass
 class ConnectionItem:
     """
@@ -161,11 +1222,21 @@ class ConnectionItem:
     current_connection_type = CHANNEL
     current_connection_name = GENERAL
     ban_time: Optional[datetime] = None
+    paused: bool = False  # the transport buffer is above the high-water mark
+    deferred: bool = False  # frames have been dropped, the chat should be replayed
+    outbox: Deque[Tuple[bytes, Optional[MessageItem]]] = field(default_factory=deque)
+    # Messages written to the transport by chats, they wait for the read ack
+    delivered: Dict[Tuple[str, str], Deque[MessageItem]] = field(default_factory=dict)
+    unacked_dropped: int = 0  # delivered messages forgotten above `UNACKED_LIMIT`
+    backlog: Deque[MessageItem] = field(default_factory=deque)  # history to replay
+    replaying: bool = False  # the connection waits in the replay round
+    rate_limiter: RateLimiter = field(default=RATE_LIMITER, repr=False)
+    roster_version: Optional[int] = None  # the roster version known by the client
+    compact: bool = False  # the client has chosen the compact encoding
+    zlib_batches: bool = False  # the client accepts compressed batches of history
+    known_names: Set[int] = field(default_factory=set)  # name ids defined for the client
+    heartbeat: bool = False  # the client answers `ping`
     banned_users = []  # Users who banned current user
-    msgs_sent = 0  # A count of messages sent in the default period
-
-    def increment_msgs_sent(self):
-        self.msgs_sent += 1
 
     def make_user_baned(self, who_send_ban: str) -> bool:
         banned = False
@@ -179,7 +1250,14 @@ class ConnectionItem:
 
         return banned
 
-    def can_send_message(self, is_general_channel: bool) -> (bool, Optional[str]):
+    def can_send_message(self, is_general_channel: bool = False,
+                         channel: Optional[str] = None) -> (bool, Optional[str]):
+        """
+        Check the ban and take a token of the channel limit, see `RateLimiter`
+        """
+
+        if is_general_channel:
+            channel = GENERAL
 
         now = datetime.now()
         answer = (True, None)
@@ -187,74 +1265,708 @@ class ConnectionItem:
             answer = (False,
                       f'You has been baned until `{self.ban_time.ctime()}` '
                       f'and you can\'t send messages')
-        elif is_general_channel and self.msgs_sent >= AVAILABLE_MSGS:
-            error_msg = f'You have reached the limit of messages per {BLOCK_INTERVAL} minutes'
+        elif channel and not self.rate_limiter.acquire(self.user_name, channel):
+            messages, minutes = self.rate_limiter.config[channel]
+            retry_after = self.rate_limiter.retry_after(self.user_name, channel)
+            error_msg = f'You have reached the limit of {messages} messages per {minutes} ' \
+                        f'minutes, try again in {retry_after:.0f} seconds'
             answer = (False, error_msg)
 
         return answer
 
 
+class Roster:
+    """
+    Versioned list of users and their chats.
+
+    Every change increases the version and is kept as a delta, so a client which
+    knows some version gets only the later changes. Encoded frames are cached
+    until the next change. The client keeps its own copy and applies the deltas
+    """
+
+    JOIN = 'join'
+    LEAVE = 'leave'
+    CHAT = 'chat'
+
+    def __init__(self, history: int = ROSTER_HISTORY):
+        self.version = 0
+        self.__users: Dict[str, Tuple[str, str]] = {}
+        self.__channels: Dict[str, int] = {}  # channel -> count of its users
+        self.__deltas: Deque[Tuple[int, list]] = deque(maxlen=history)
+
+        self.__snapshot_frame: Optional[bytes] = None
+        self.__delta_frames: Dict[int, bytes] = {}  # by the version of the client
+
+        # Called after every change
+        self.change_listener: Optional[Callable[[], None]] = None
+
+    @property
+    def users(self) -> List[str]:
+        return list(self.__users)
+
+    @property
+    def channels(self) -> List[str]:
+        return list(self.__channels)
+
+    def chat_of(self, user_name: str) -> Optional[Tuple[str, str]]:
+        return self.__users.get(user_name)
+
+    def update(self, user_name: str, chat_type: str, chat_name: str) -> None:
+        previous = self.__users.get(user_name)
+        if previous == (chat_type, chat_name):
+            return
+        self._changed([self.JOIN if previous is None else self.CHAT,
+                       user_name, chat_type, chat_name])
+
+    def remove(self, user_name: str) -> None:
+        if user_name in self.__users:
+            self._changed([self.LEAVE, user_name])
+
+    def _apply(self, delta: list) -> None:
+        user_name = delta[1]
+        previous = self.__users.pop(user_name, None)
+        if previous and previous[0] == CHANNEL:
+            self.__channels[previous[1]] -= 1
+            if not self.__channels[previous[1]]:
+                del self.__channels[previous[1]]
+
+        if delta[0] != self.LEAVE:
+            chat_type, chat_name = delta[2], delta[3]
+            self.__users[user_name] = (chat_type, chat_name)
+            if chat_type == CHANNEL:
+                self.__channels[chat_name] = self.__channels.get(chat_name, 0) + 1
+
+    def _changed(self, delta: list) -> None:
+        self._apply(delta)
+        self.version += 1
+        self.__deltas.append((self.version, delta))
+        self.__snapshot_frame = None
+        self.__delta_frames.clear()
+        if self.change_listener:
+            self.change_listener()
+
+    def snapshot(self) -> dict:
+        return {
+            'version': self.version,
+            'users': self.users,
+            'channels': self.channels,
+            'chats': {user_name: list(chat) for user_name, chat in self.__users.items()},
+        }
+
+    def load(self, snapshot: dict) -> None:
+        self.__users.clear()
+        self.__channels.clear()
+        self.__deltas.clear()
+        for user_name, (chat_type, chat_name) in snapshot.get('chats', {}).items():
+            self._apply([self.JOIN, user_name, chat_type, chat_name])
+        self.version = snapshot.get('version', 0)
+
+    def deltas_since(self, version: int) -> Optional[List[list]]:
+        """
+        Changes after the version, None if they are not kept any more
+        """
+
+        if version == self.version:
+            return []
+        if version > self.version or not self.__deltas or self.__deltas[0][0] > version + 1:
+            return None
+        return [delta for _, delta in islice(self.__deltas, version + 1 - self.__deltas[0][0],
+                                             None)]
+
+    def apply_deltas(self, from_version: int, version: int, deltas: List[list]) -> bool:
+        """
+        Apply changes received from the server, False means the roster has missed some
+        """
+
+        if from_version != self.version:
+            return False
+        for delta in deltas:
+            self._apply(delta)
+        self.version = version
+        return True
+
+    def snapshot_frame(self) -> bytes:
+        if self.__snapshot_frame is None:
+            self.__snapshot_frame = (f'{InfoMsgStatuses.SET_STATISTIC.value} '
+                                     f'{json.dumps(self.snapshot(), ensure_ascii=False)}'
+                                     ).encode() + EOS
+        return self.__snapshot_frame
+
+    def delta_frame(self, version: int) -> Optional[bytes]:
+        frame = self.__delta_frames.get(version)
+        if frame is None:
+            deltas = self.deltas_since(version)
+            if deltas is None:
+                return None
+            data = {'from': version, 'version': self.version, 'deltas': deltas}
+            frame = self.__delta_frames[version] = (
+                f'{InfoMsgStatuses.ROSTER_DELTA.value} {json.dumps(data, ensure_ascii=False)}'
+            ).encode() + EOS
+        return frame
+
+
 class ConnectionPool:
-    __pool = []
+    """
+    Storage of all connections.
+
+    Connections are indexed by transport and by user name, besides the pool
+    keeps subscribers of every chat: (`current_connection_type`,
+    `current_connection_name`) -> connections, so sending a message touches
+    only the connections which should get it.
+
+    All writes go through `write`: while a transport is paused the frames wait
+    in the bounded outbox of the connection, on overflow the `policy` is applied
+    """
+
+    def __init__(self,
+                 outbox_limit: int = OUTBOX_LIMIT,
+                 policy: SlowConsumerPolicy = SLOW_CONSUMER_POLICY):
+        self.__by_transport: Dict[BaseTransport, ConnectionItem] = {}
+        self.__by_user_name: Dict[str, ConnectionItem] = {}
+        self.__subscribers: Dict[Tuple[str, str], Dict[BaseTransport, ConnectionItem]] = {}
+
+        self.outbox_limit = outbox_limit
+        self.policy = policy
+        self.__paused_count = 0
+        self.__dropped_frames = 0
+        self.__slow_disconnects = 0
+        self.__unacked_dropped = 0
+        self.__frames_written = 0
+        self.__bytes_written = 0
+
+        # Bans by user names, they are applied again when the user reconnects
+        self.bans: Dict[str, datetime] = {}
+        self.listeners: List[PoolListener] = []
+
+        # Users of other server workers: user name -> (worker, chat type, chat name)
+        self.remote_users: Dict[str, Tuple[int, str, str]] = {}
+
+        # Named users of all workers with their chats
+        self.roster = Roster()
 
     def add(self, con: ConnectionItem) -> None:
-        self.__pool.append(con)
+        self.__by_transport[con.transport] = con
+        if con.user_name:
+            # A connection without a name gets no messages
+            self.__by_user_name[con.user_name] = con
+            self.roster.update(con.user_name, con.current_connection_type,
+                               con.current_connection_name)
+            self._subscribe(con)
+
+    def _subscribe(self, con: ConnectionItem) -> None:
+        key = (con.current_connection_type, con.current_connection_name)
+        self.__subscribers.setdefault(key, {})[con.transport] = con
+
+    def _unsubscribe(self, con: ConnectionItem) -> None:
+        key = (con.current_connection_type, con.current_connection_name)
+        subscribers = self.__subscribers.get(key)
+        if subscribers is not None:
+            subscribers.pop(con.transport, None)
+            if not subscribers:
+                del self.__subscribers[key]
+
+    def set_user_name(self, con: ConnectionItem, user_name: str) -> None:
+        if con.user_name:
+            self.__by_user_name.pop(con.user_name, None)
+        con.user_name = user_name
+        self.__by_user_name[user_name] = con
+        self._subscribe(con)
+
+        ban_time = self.bans.get(user_name)
+        if ban_time:
+            if ban_time > datetime.now():
+                con.ban_time = ban_time
+            else:
+                del self.bans[user_name]
+
+        self.roster.update(user_name, con.current_connection_type, con.current_connection_name)
+        for listener in self.listeners:
+            listener.user_joined(con)
+
+    def ban(self, con: ConnectionItem) -> None:
+        """
+        Remember the ban of the connection for its user name
+        """
+
+        self.bans[con.user_name] = con.ban_time
+        for listener in self.listeners:
+            listener.user_banned(con.user_name, con.ban_time)
+
+    def change_chat(self, con: ConnectionItem, chat_type: str, chat_name: str) -> None:
+        self._unsubscribe(con)
+        con.current_connection_type = chat_type
+        con.current_connection_name = chat_name
+
+        if con.user_name:
+            self._subscribe(con)
+            self.roster.update(con.user_name, chat_type, chat_name)
+            for listener in self.listeners:
+                listener.chat_changed(con)
+
+    def forward_complaint(self, user_name: str, who_send_ban: str) -> None:
+        """
+        The complaint to a user of another worker
+        """
+
+        for listener in self.listeners:
+            listener.user_complained(user_name, who_send_ban)
+
+    def set_remote_user(self, worker: int, user_name: str, chat_type: str, chat_name: str) -> None:
+        self.remote_users[user_name] = (worker, chat_type, chat_name)
+        self.roster.update(user_name, chat_type, chat_name)
+
+    def del_remote_user(self, user_name: str) -> None:
+        if self.remote_users.pop(user_name, None):
+            self.roster.remove(user_name)
+
+    def del_remote_worker(self, worker: int) -> None:
+        for user_name, (user_worker, _, _) in list(self.remote_users.items()):
+            if user_worker == worker:
+                del self.remote_users[user_name]
+                self.roster.remove(user_name)
 
     @property
     def pool_len(self) -> int:
-        return len(self.__pool)
+        return len(self.__by_transport)
 
     def get_all_user_names(self) -> List[str]:
-        return [item.user_name for item in self.__pool]
+        return self.roster.users
+
+    def has_user_name(self, user_name: str) -> bool:
+        return user_name in self.__by_user_name or user_name in self.remote_users
 
     def get_all_channel_names(self) -> List:
-        # For future, now channels are not maintain
-        return list(
-            set(
-                item.current_connection_name for item in self.__pool
-                if item.current_connection_type == CHANNEL
-            ))
+        return self.roster.channels
+
+    def get_all_connections(self) -> List[ConnectionItem]:
+        return list(self.__by_transport.values())
 
     def get_all_transports(self) -> List[BaseTransport]:
-        return [item.transport for item in self.__pool]
+        return list(self.__by_transport)
 
     def get_all_transports_with_name(self) -> List[BaseTransport]:
-        return [item.transport for item in self.__pool if item.user_name]
+        return [item.transport for item in self.__by_user_name.values()]
 
     def get_by_transport(self, transport: BaseTransport) -> Optional[ConnectionItem]:
-        item_gen = filter(lambda x: x.transport == transport, self.__pool)
-        try:
-            item = next(item_gen)
-        except StopIteration:
-            item = None
-        return item
+        return self.__by_transport.get(transport)
 
     def get_by_user_name(self, user_name: str) -> Optional[ConnectionItem]:
-        item_gen = filter(lambda x: x.user_name == user_name, self.__pool)
-        try:
-            item = next(item_gen)
-        except StopIteration:
-            item = None
-        return item
+        return self.__by_user_name.get(user_name)
 
     def del_by_transport(self, transport: BaseTransport) -> None:
-        item = self.get_by_transport(transport)
-        self.__pool.remove(item)
+        item = self.__by_transport.pop(transport, None)
+        if item is None:
+            return
+
+        if item.user_name and self.__by_user_name.get(item.user_name) is item:
+            del self.__by_user_name[item.user_name]
+            self.roster.remove(item.user_name)
+            for listener in self.listeners:
+                listener.user_left(item)
+        self._unsubscribe(item)
+
+        if item.paused:
+            self.__paused_count -= 1
+        item.outbox.clear()
+        item.backlog.clear()
+        item.delivered.clear()
+
+    @property
+    def paused_count(self) -> int:
+        return self.__paused_count
+
+    @property
+    def dropped_frames(self) -> int:
+        return self.__dropped_frames
+
+    @property
+    def slow_disconnects(self) -> int:
+        return self.__slow_disconnects
+
+    @property
+    def unacked_dropped(self) -> int:
+        return self.__unacked_dropped
+
+    @property
+    def frames_written(self) -> int:
+        return self.__frames_written
+
+    @property
+    def bytes_written(self) -> int:
+        return self.__bytes_written
+
+    def _delivered(self, conn: ConnectionItem, msg: MessageItem) -> None:
+        chat = msg.recipient_chat()
+        delivered = conn.delivered.get(chat)
+        if delivered is None:
+            delivered = conn.delivered[chat] = deque()
+        elif len(delivered) >= UNACKED_LIMIT:
+            self._unacked_overflow(conn, delivered)
+        delivered.append(msg)
+        if conn.compact:
+            conn.known_names.update(msg.name_ids())
+
+    def _unacked_overflow(self, conn: ConnectionItem, delivered: Deque[MessageItem]) -> None:
+        """
+        The client doesn't ack what it reads, so it is treated as a slow consumer:
+        it is disconnected or the oldest message of the chat is forgotten.
+        A forgotten message stays unread in the pool and is replayed on the next join
+        """
+
+        self.__unacked_dropped += 1
+        conn.unacked_dropped += 1
+        if self.policy == SlowConsumerPolicy.DISCONNECT:
+            logger.warning(f'{conn.user_name} has not acked {len(delivered)} messages, '
+                           f'disconnecting', extra={'category': 'connection'})
+            self.__slow_disconnects += 1
+            delivered.clear()
+            conn.transport.abort()
+            return
+
+        if conn.unacked_dropped == 1:
+            logger.warning(f'{conn.user_name} has not acked {len(delivered)} messages, '
+                           f'forgetting the oldest ones', extra={'category': 'connection'})
+        delivered.popleft()
+
+    @staticmethod
+    def _compact_frame(conn: ConnectionItem, msg: MessageItem) -> bytes:
+        """
+        The compact frame of the message preceded by the names which the client doesn't know.
+        The names become known when the frame reaches the transport
+        """
+
+        frame = msg.compact_frame()
+        unknown = [name_id for name_id in dict.fromkeys(msg.name_ids())
+                   if name_id not in conn.known_names]
+        if not unknown:
+            return frame
+        return b''.join(map(name_frame, unknown)) + frame
+
+    def write(self, conn: ConnectionItem, data: bytes, msg: Optional[MessageItem] = None) -> None:
+        """
+        Write the frame to the connection, respecting its flow control.
+        The message of the frame is remembered as delivered when it reaches the transport
+        """
+
+        if msg is not None and conn.compact:
+            data = self._compact_frame(conn, msg)
+
+        if not conn.paused:
+            conn.transport.write(data)
+            self.__frames_written += 1
+            self.__bytes_written += len(data)
+            if msg:
+                self._delivered(conn, msg)
+            return
+
+        if len(conn.outbox) < self.outbox_limit:
+            conn.outbox.append((data, msg))
+            return
+
+        if self.policy == SlowConsumerPolicy.DROP_OLDEST:
+            conn.outbox.popleft()
+            conn.outbox.append((data, msg))
+            self.__dropped_frames += 1
+
+        elif self.policy == SlowConsumerPolicy.DISCONNECT:
+            self.__dropped_frames += len(conn.outbox) + 1
+            self.__slow_disconnects += 1
+            conn.outbox.clear()
+            conn.transport.abort()
+
+        elif msg is None:  # and self.policy == SlowConsumerPolicy.DEFER
+            # Only messages can be replayed, so control frames like the chat switch
+            #   wait in the outbox over its limit
+            conn.outbox.append((data, msg))
+
+        else:  # elif self.policy == SlowConsumerPolicy.DEFER:
+            conn.deferred = True
+            self.__dropped_frames += 1
+
+    def write_messages(self, conn: ConnectionItem, msgs: List[MessageItem]) -> None:
+        if not conn.paused:
+            if conn.compact:
+                frames = []
+                for msg in msgs:
+                    frames.append(self._compact_frame(conn, msg))
+                    self._delivered(conn, msg)
+            else:
+                frames = [msg.frame() for msg in msgs]
+                for msg in msgs:
+                    self._delivered(conn, msg)
+            conn.transport.writelines(frames)
+            self.__frames_written += len(frames)
+            self.__bytes_written += sum(map(len, frames))
+            return
+
+        for msg in msgs:
+            self.write(conn, msg.frame(), msg)
+
+    def write_batch(self, conn: ConnectionItem, msgs: List[MessageItem],
+                    level: int = REPLAY_ZLIB_LEVEL) -> None:
+        """
+        Write the messages as one `message_batch COUNT DATA` frame, DATA is
+        the base64 of the zlib compressed frames which the client would get one by one
+        """
+
+        known_names = set(conn.known_names)
+        frames = []
+        for msg in msgs:
+            frames.append(self._compact_frame(conn, msg) if conn.compact else msg.frame())
+            if conn.compact:
+                conn.known_names.update(msg.name_ids())
+
+        data = base64.b64encode(zlib.compress(b''.join(frames), level))
+        batch = b'%s %d %s\n' % (InfoMsgStatuses.MESSAGE_BATCH.msg_bts, len(msgs), data)
+        # The reader of the client bounds the whole frame, not only the data
+        if conn.paused or len(batch) > MAX_BATCH_SIZE:
+            conn.known_names = known_names
+            self.write_messages(conn, msgs)
+            return
+
+        conn.transport.write(batch)
+        self.__frames_written += 1
+        self.__bytes_written += len(batch)
+        for msg in msgs:
+            self._delivered(conn, msg)
+
+    @staticmethod
+    def pop_delivered(conn: ConnectionItem, chat_type: str, chat_name: str,
+                      seq: int) -> List[MessageItem]:
+        """
+        Messages of the chat delivered to the connection with the seq up to the given one
+        """
 
-    def clear_all_msgs_sent(self):
-        for conn in self.__pool:
-            conn.msgs_sent = 0
+        delivered = conn.delivered.get((chat_type, chat_name))
+        if not delivered:
+            return []
 
-    def send_message(self, msg_item: MessageItem) -> None:
+        read = [msg for msg in delivered if msg.seq <= seq]
+        if len(read) == len(delivered):
+            del conn.delivered[(chat_type, chat_name)]
+        elif read:
+            conn.delivered[(chat_type, chat_name)] = deque(
+                msg for msg in delivered if msg.seq > seq)
+        return read
+
+    def pause_writing(self, conn: ConnectionItem) -> None:
+        if not conn.paused:
+            conn.paused = True
+            self.__paused_count += 1
+
+    def resume_writing(self, conn: ConnectionItem) -> bool:
+        """
+        Flush the outbox of the connection,
+        return True if the connection has lost frames and the chat should be replayed
+        """
+
+        if conn.paused:
+            conn.paused = False
+            self.__paused_count -= 1
+
+        while conn.outbox and not conn.paused:
+            data, msg = conn.outbox.popleft()
+            conn.transport.write(data)
+            self.__frames_written += 1
+            self.__bytes_written += len(data)
+            if msg:
+                self._delivered(conn, msg)
+
+        deferred = conn.deferred and not conn.paused and not conn.outbox
+        if deferred:
+            conn.deferred = False
+        return deferred
+
+    def get_recipients(self, msg_item: MessageItem) -> List[ConnectionItem]:
         """
-        Send the text message to all chat participants
+        Connections which fit with the message, see `MessageItem.target`
+        """
+
+        if msg_item.destination_type == CHANNEL:
+            subscribers = self.__subscribers.get((CHANNEL, msg_item.destination_name), {})
+            return list(subscribers.values())
+
+        if msg_item.destination_type == PRIVATE:
+            conn = self.__by_user_name.get(msg_item.destination_name)
+            if conn and conn.current_connection_type == PRIVATE:
+                return [conn]
+
+        return []
+
+    def send_message(self, msg_item: MessageItem) -> int:
+        """
+        Send the text message to all chat participants, return the count of recipients.
+        A connection which still replays the history gets the message after its backlog,
+        so the messages of the chat arrive in the order of their seq
         """
         sender = self.get_by_user_name(msg_item.creator)
-        message = f'{InfoMsgStatuses.MESSAGE_FROM_SRV.value} {msg_item.serialize()}\n'.encode()
-
-        for conn in self.__pool:
-            if conn != sender:
-                if msg_item.target(conn.current_connection_type,
-                                   conn.current_connection_name,
-                                   conn.user_name):
-                    conn.transport.write(message)
+        message = msg_item.frame()
+
+        recipients = 0
+        for conn in self.get_recipients(msg_item):
+            if conn is not sender:
+                if conn.backlog:
+                    conn.backlog.append(msg_item)
+                else:
+                    self.write(conn, message, msg_item)
+                recipients += 1
+        return recipients
+
+
+class AdmissionControl:
+    """
+    Caps of the connections of the worker in total and per IP address,
+    the connections above them are refused before they get into the pool
+    """
+
+    def __init__(self, max_connections: Optional[int] = MAX_CONNECTIONS,
+                 max_per_ip: Optional[int] = MAX_CONNECTIONS_PER_IP):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.total = 0
+        self.by_ip: Dict[str, int] = {}
+        self.refused = 0
+
+    def admit(self, ip: Optional[str], force: bool = False) -> bool:
+        """
+        Count the connection from the address, return False if it is above a cap.
+        Forced connections are counted anyway
+        """
+
+        if not force and (
+                (self.max_connections is not None and self.total >= self.max_connections)
+                or (ip and self.max_per_ip is not None
+                    and self.by_ip.get(ip, 0) >= self.max_per_ip)):
+            self.refused += 1
+            return False
+
+        self.total += 1
+        if ip:
+            self.by_ip[ip] = self.by_ip.get(ip, 0) + 1
+        return True
+
+    def release(self, ip: Optional[str]) -> None:
+        self.total -= 1
+        if ip:
+            count = self.by_ip[ip] - 1
+            if count:
+                self.by_ip[ip] = count
+            else:
+                del self.by_ip[ip]
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: timeouts of many connections on one periodic timer.
+
+    A key waits in the slot of its deadline tick, `advance` moves to the next tick
+    and fires the keys of its slot, keys of later turns stay there. A key has one
+    timer, scheduling it again moves the key, so scheduling and cancelling are O(1)
+    and idle keys cost nothing between the ticks. The owner calls `advance` every `tick`
+    """
+
+    def __init__(self, on_expired: Callable[[Hashable], None], tick: float = TIMER_TICK,
+                 slots: int = TIMER_SLOTS):
+        self.on_expired = on_expired
+        self.tick = tick
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self.deadlines: Dict[Hashable, int] = {}
+        self.current = 0  # ticks since the start
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def elapsed(self, since: int) -> float:
+        """
+        Seconds since the tick
+        """
+
+        return (self.current - since) * self.tick
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        self.cancel(key)
+        deadline = self.current + max(1, math.ceil(delay / self.tick))
+        self.slots[deadline % len(self.slots)][key] = deadline
+        self.deadlines[key] = deadline
+
+    def cancel(self, key: Hashable) -> None:
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            del self.slots[deadline % len(self.slots)][key]
+
+    def advance(self) -> int:
+        """
+        Move to the next tick, fire the expired keys, return their count
+        """
+
+        self.current += 1
+        slot = self.slots[self.current % len(self.slots)]
+        expired = [key for key, deadline in slot.items() if deadline <= self.current]
+        for key in expired:
+            del slot[key]
+            del self.deadlines[key]
+        for key in expired:
+            self.on_expired(key)
+        return len(expired)
+
+
+class ReplayScheduler:
+    """
+    Replay of the history: every connection has its own backlog of messages.
+    Backlogs are sent concurrently, round-robin by batches of `batch_size` messages,
+    a paused connection leaves the round until its transport resumes writing
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = REPLAY_BATCH,
+                 zlib_threshold: int = REPLAY_ZLIB_THRESHOLD, zlib_batch: int = REPLAY_ZLIB_BATCH):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.zlib_threshold = zlib_threshold  # see `ConnectionPool.write_batch`
+        self.zlib_batch = zlib_batch
+        self.__ready: Deque[ConnectionItem] = deque()
+
+        # Called when a connection joins the round
+        self.wakeup_listener: Optional[Callable[[], None]] = None
+
+    @property
+    def has_ready(self) -> bool:
+        return bool(self.__ready)
+
+    @property
+    def ready_count(self) -> int:
+        return len(self.__ready)
+
+    def schedule(self, conn: ConnectionItem, msgs: List[MessageItem]) -> None:
+        conn.backlog.extend(msgs)
+        self.wake(conn)
+
+    def wake(self, conn: ConnectionItem) -> None:
+        if conn.backlog and not conn.paused and not conn.replaying:
+            conn.replaying = True
+            self.__ready.append(conn)
+            if self.wakeup_listener:
+                self.wakeup_listener()
+
+    def send_round(self) -> int:
+        """
+        Send one batch to every ready connection, return the count of sent messages
+        """
+
+        sent = 0
+        for _ in range(len(self.__ready)):
+            conn = self.__ready.popleft()
+            conn.replaying = False
+            if conn.paused or not conn.backlog:
+                continue
+
+            if conn.zlib_batches and len(conn.backlog) >= self.zlib_threshold:
+                batch_len = min(self.zlib_batch, len(conn.backlog))
+                self.pool.write_batch(conn, [conn.backlog.popleft() for _ in range(batch_len)])
+            else:
+                batch_len = min(self.batch_size, len(conn.backlog))
+                self.pool.write_messages(conn,
+                                         [conn.backlog.popleft() for _ in range(batch_len)])
+            sent += batch_len
+            self.wake(conn)
+
+        return sent
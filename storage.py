@@ -0,0 +1,499 @@
+import asyncio
+import gc
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from typing import List, Optional, Iterator, Tuple
+
+from services import (MessageItem, MessagePool, ConnectionPool, PoolListener,
+                      FSYNC_INTERVAL, SEGMENT_SIZE)
+
+logger = logging.getLogger()
+
+MESSAGE = 'm'
+RECEIVED = 'r'
+BAN = 'b'
+SKIPPED = 's'
+EPOCH = 'e'
+
+SEGMENT_SUFFIX = '.log'
+SNAPSHOT_PREFIX = 'snapshot-'
+READ_CHUNK_SIZE = 4 * 1024 * 1024  # in bytes, the log is parsed by chunks of this size
+SPILL_PAGE_SIZE = 500  # spilled messages read by one query
+
+
+class MessageLog(PoolListener):
+    """
+    Append-only log of messages, read receipts, skipped history, bans
+    and the epoch of seqs, see `MessagePool.epoch`.
+
+    Records are JSON arrays, one per line. They are collected in memory and
+    written by batches with one fsync from an executor thread (group commit),
+    so the event loop never waits for the disk. The log is split into segments
+    `<number>.log`; a compaction writes the state to `snapshot-<number>.log`
+    and deletes the older segments. On start the latest snapshot and the
+    following segments are read through mmap
+    """
+
+    def __init__(self, path: str,
+                 fsync_interval: float = FSYNC_INTERVAL,
+                 segment_size: int = SEGMENT_SIZE):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+
+        self.__pending: List[bytes] = []
+        self.__lock: Optional[asyncio.Lock] = None  # created in the loop, see `lock`
+        self.__segment_no = 0
+        self.__segment = None
+        self.__written_records = 0
+        self.__fsync_count = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def written_records(self) -> int:
+        return self.__written_records
+
+    @property
+    def fsync_count(self) -> int:
+        return self.__fsync_count
+
+    @property
+    def pending_count(self) -> int:
+        return len(self.__pending)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # Before 3.10 a lock is bound to the current loop when it is created,
+        #   the log itself is created before the loop runs
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        return self.__lock
+
+    # Events of the pools
+
+    def append(self, record: list) -> None:
+        self.__pending.append(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+
+    def message_added(self, msg: MessageItem) -> None:
+        self.append(self.message_record(msg, with_receipts=False))
+
+    def message_received(self, msg: MessageItem, user: str) -> None:
+        self.append([RECEIVED, msg.uuid, user])
+
+    def user_banned(self, user: str, ban_time: datetime) -> None:
+        self.append([BAN, user, ban_time.timestamp()])
+
+    def history_skipped(self, destination_type: str, destination_name: str, user: str,
+                        seq: int) -> None:
+        self.append([SKIPPED, destination_type, destination_name, user, seq])
+
+    @staticmethod
+    def message_record(msg: MessageItem, with_receipts: bool = True) -> list:
+        return [MESSAGE, msg.seq, msg.uuid, msg.ts, msg.creator, msg.destination_type,
+                msg.destination_name, msg.message, msg.received_users if with_receipts else []]
+
+    # Files
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _snapshots(self) -> List[int]:
+        return sorted(int(name[len(SNAPSHOT_PREFIX):-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.path)
+                      if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, f'{number:08}{SEGMENT_SUFFIX}')
+
+    def _snapshot_path(self, number: int) -> str:
+        return os.path.join(self.path, f'{SNAPSHOT_PREFIX}{number:08}{SEGMENT_SUFFIX}')
+
+    def _open_segment(self, number: int) -> None:
+        if self.__segment:
+            self.__segment.close()
+        self.__segment_no = number
+        self.__segment = open(self._segment_path(number), 'ab')
+
+    def _write_batch(self, batch: List[bytes]) -> None:
+        if self.__segment is None:
+            self._open_segment(self.__segment_no + 1)
+        elif self.__segment.tell() >= self.segment_size:
+            self._open_segment(self.__segment_no + 1)
+
+        self.__segment.write(b''.join(batch))
+        self.__segment.flush()
+        os.fsync(self.__segment.fileno())
+        self.__written_records += len(batch)
+        self.__fsync_count += 1
+
+    async def flush(self) -> None:
+        """
+        Write and sync all collected records
+        """
+
+        async with self.lock:
+            if not self.__pending:
+                return
+            batch, self.__pending = self.__pending, []
+            await asyncio.get_running_loop().run_in_executor(None, self._write_batch, batch)
+
+    async def flushing(self) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            await self.flush()
+
+    def close(self) -> None:
+        if self.__pending:
+            self._write_batch(self.__pending)
+            self.__pending = []
+        if self.__segment:
+            self.__segment.close()
+            self.__segment = None
+
+    # Restoring
+
+    @staticmethod
+    def _read_records(path: str) -> Iterator[list]:
+        """
+        Records of the file, a chunk of lines is parsed at once as one JSON array
+        """
+
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.rfind(b'\n') + 1
+                pos = 0
+                while pos < end:
+                    stop = mm.rfind(b'\n', pos, min(pos + READ_CHUNK_SIZE, end)) + 1
+                    if stop <= pos:
+                        stop = mm.find(b'\n', pos) + 1
+                    chunk = mm[pos:stop - 1]
+                    pos = stop
+
+                    try:
+                        yield from json.loads(b'[' + chunk.replace(b'\n', b',') + b']')
+                    except ValueError:
+                        for line in chunk.split(b'\n'):
+                            try:
+                                yield json.loads(line)
+                            except ValueError:
+                                logger.error(f'Broken record in {path}, skipping it')
+
+                if end < len(mm):
+                    # The tail of a record which had not been written before a crash
+                    logger.error(f'Incomplete record at the end of {path}, skipping it')
+
+    def restore(self, msg_pool: MessagePool, conn_pool: ConnectionPool) -> Tuple[int, int]:
+        """
+        Load the latest snapshot and the log after it into the pools,
+        return the count of read records and the count of restored messages
+        """
+
+        snapshots = self._snapshots()
+        start = snapshots[-1] if snapshots else 0
+        paths = [self._snapshot_path(start)] if snapshots else []
+        paths += [self._segment_path(number) for number in self._segments() if number >= start]
+
+        # Restored objects live until they expire, collecting garbage meanwhile is a waste
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        records_cnt = 0
+        try:
+            for path in paths:
+                for record in self._read_records(path):
+                    records_cnt += 1
+                    self._apply(record, msg_pool, conn_pool)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self._follow_segments(start)
+        return records_cnt, msg_pool.count
+
+    def _follow_segments(self, start: int = 0) -> None:
+        # New records go to a segment after the existing ones
+        segments = self._segments()
+        self.__segment_no = segments[-1] if segments else start
+
+    def follow(self) -> None:
+        """
+        Continue the log without reading it, the pools already have its state
+        """
+
+        snapshots = self._snapshots()
+        self._follow_segments(snapshots[-1] if snapshots else 0)
+
+    @staticmethod
+    def _apply(record: list, msg_pool: MessagePool, conn_pool: ConnectionPool) -> None:
+        kind = record[0]
+        if kind == MESSAGE:
+            _, seq, uuid, ts, creator, destination_type, destination_name, message, received = \
+                record
+            if msg_pool.get_message_by_uuid(uuid):
+                return
+            msg = MessageItem.restore(uuid, ts, creator, destination_type, destination_name,
+                                      message, seq)
+            for user in received:
+                msg.mark_received(user)
+            msg_pool.add(msg)
+
+        elif kind == RECEIVED:
+            msg = msg_pool.get_message_by_uuid(record[1])
+            if msg:
+                msg_pool.mark_received(msg, record[2])
+
+        elif kind == BAN:
+            conn_pool.bans[record[1]] = datetime.fromtimestamp(record[2])
+
+        elif kind == SKIPPED:
+            msg_pool.skip_history(*record[1:])
+
+        elif kind == EPOCH:
+            msg_pool.epoch = record[1]
+
+    # Compaction
+
+    def _write_snapshot(self, number: int, records: List[bytes]) -> None:
+        tmp_path = self._snapshot_path(number) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path(number))
+
+        for segment in self._segments():
+            if segment < number:
+                os.remove(self._segment_path(segment))
+        for snapshot in self._snapshots():
+            if snapshot < number:
+                os.remove(self._snapshot_path(snapshot))
+
+    async def compact(self, msg_pool: MessagePool, conn_pool: ConnectionPool) -> None:
+        """
+        Replace the log written so far with a snapshot of the pools
+        """
+
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            # The records in the new segment follow the snapshot
+            batch, self.__pending = self.__pending, []
+            if batch:
+                await loop.run_in_executor(None, self._write_batch, batch)
+            number = self.__segment_no + 1
+            await loop.run_in_executor(None, self._open_segment, number)
+
+        # Encoding is split into parts to let the loop serve the clients meanwhile
+        records = [json.dumps([EPOCH, msg_pool.epoch]).encode() + b'\n']
+        for idx, msg in enumerate(list(msg_pool.all_messages())):
+            record = json.dumps(self.message_record(msg), ensure_ascii=False)
+            records.append(record.encode() + b'\n')
+            if idx % 10000 == 0:
+                await asyncio.sleep(0)
+
+        for skipped in list(msg_pool.skipped_history()):
+            records.append(json.dumps([SKIPPED, *skipped], ensure_ascii=False).encode() + b'\n')
+
+        now = datetime.now()
+        for user, ban_time in conn_pool.bans.items():
+            if ban_time > now:
+                records.append(json.dumps([BAN, user, ban_time.timestamp()]).encode() + b'\n')
+
+        await loop.run_in_executor(None, self._write_snapshot, number, records)
+        logger.info(f'The message log has been compacted to {len(records)} records')
+
+
+def open_message_log(path: Optional[str],
+                     msg_pool: MessagePool,
+                     conn_pool: ConnectionPool,
+                     restore: bool = True) -> Optional[MessageLog]:
+    """
+    Restore the pools from the log at the path and start journaling to it.
+    Pools handed over by the previous server process are not restored
+    """
+
+    if not path:
+        return None
+
+    log = MessageLog(path)
+    if restore:
+        records_cnt, msgs_cnt = log.restore(msg_pool, conn_pool)
+        logger.info(f'Restored {msgs_cnt} messages from {records_cnt} records of the message log')
+    else:
+        log.follow()
+
+    msg_pool.listeners.append(log)
+    # A new log starts the epoch of the pool, a restored one confirms it
+    log.append([EPOCH, msg_pool.epoch])
+    conn_pool.listeners.append(log)
+    return log
+
+
+class SpillStore:
+    """
+    Messages moved out of memory by `MessagePool.spill`.
+
+    An SQLite database indexed like the pool: by destination and by
+    (recipient, creator) of private messages, both ordered by seq, and by uuid.
+    It is a cache of one process recreated on every start, the message log stays
+    the source of truth, so the database is written without a journal and syncs.
+    Batches are written from an executor thread, the lock serializes the queries
+    """
+
+    COLUMNS = 'seq, uuid, ts, creator, destination_type, destination_name, message, received'
+
+    def __init__(self, path: str, page_size: int = SPILL_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self.__count = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE messages (
+                seq INTEGER PRIMARY KEY,
+                uuid TEXT NOT NULL,
+                ts REAL NOT NULL,
+                creator TEXT NOT NULL,
+                destination_type TEXT NOT NULL,
+                destination_name TEXT NOT NULL,
+                message TEXT NOT NULL,
+                received TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX messages_uuid ON messages (uuid);
+            CREATE INDEX messages_destination
+                ON messages (destination_type, destination_name, seq);
+            CREATE INDEX messages_private
+                ON messages (destination_type, destination_name, creator, seq);
+        ''')
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @staticmethod
+    def _message(row: tuple) -> MessageItem:
+        seq, uuid, ts, creator, destination_type, destination_name, message, received = row
+        msg = MessageItem.restore(uuid, ts, creator, destination_type, destination_name,
+                                  message, seq)
+        for user in json.loads(received):
+            msg.mark_received(user)
+        return msg
+
+    def _fetch(self, query: str, args: tuple) -> List[tuple]:
+        with self.lock:
+            return self.db.execute(query, args).fetchall()
+
+    def put(self, msgs: List[MessageItem]) -> None:
+        rows = [(msg.seq, msg.uuid, msg.ts, msg.creator, msg.destination_type,
+                 msg.destination_name, msg.message, json.dumps(msg.received_users))
+                for msg in msgs]
+        with self.lock, self.db:
+            self.db.executemany(
+                f'INSERT INTO messages ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.__count += len(msgs)
+
+    def get(self, uuid: str) -> Optional[MessageItem]:
+        rows = self._fetch(f'SELECT {self.COLUMNS} FROM messages WHERE uuid = ?', (uuid,))
+        return self._message(rows[0]) if rows else None
+
+    def get_by_seq(self, seq: int) -> Optional[MessageItem]:
+        rows = self._fetch(f'SELECT {self.COLUMNS} FROM messages WHERE seq = ?', (seq,))
+        return self._message(rows[0]) if rows else None
+
+    def mark_received(self, uuid: str, user: str) -> Optional[MessageItem]:
+        """
+        Add the read receipt to the stored message, return the message with all its
+        receipts or None if the receipt is already there or the message is not stored
+        """
+
+        msg = self.get(uuid)
+        if msg is None or not msg.mark_received(user):
+            return None
+        with self.lock, self.db:
+            self.db.execute('UPDATE messages SET received = ? WHERE seq = ?',
+                            (json.dumps(msg.received_users), msg.seq))
+        return msg
+
+    def delete(self, uuid: str) -> bool:
+        return bool(self.delete_many([uuid]))
+
+    def delete_many(self, uuids: List[str]) -> int:
+        with self.lock, self.db:
+            deleted = self.db.executemany('DELETE FROM messages WHERE uuid = ?',
+                                          [(uuid,) for uuid in uuids]).rowcount
+            self.__count -= deleted
+        return deleted
+
+    def iter_chat(self, destination_type: str, destination_name: str,
+                  creator: Optional[str] = None,
+                  since: int = 0,
+                  before: Optional[int] = None,
+                  descending: bool = False) -> Iterator[MessageItem]:
+        """
+        Messages of the chat with `since` <= seq < `before` by pages, the oldest first
+        or the newest first. `creator` narrows the chat to one side of a private one
+        """
+
+        query = f'SELECT {self.COLUMNS} FROM messages ' \
+                f'WHERE destination_type = ? AND destination_name = ?'
+        args: list = [destination_type, destination_name]
+        if creator is not None:
+            query += ' AND creator = ?'
+            args.append(creator)
+        query += f' AND seq >= ? AND seq < ? ORDER BY seq {"DESC" if descending else ""} LIMIT ?'
+
+        high = (1 << 63) - 1 if before is None else before
+        while True:
+            page = self._fetch(query, (*args, since, high, self.page_size))
+            for row in page:
+                yield self._message(row)
+            if len(page) < self.page_size:
+                return
+            if descending:
+                high = page[-1][0]
+            else:
+                since = page[-1][0] + 1
+
+    def iter_all(self) -> Iterator[MessageItem]:
+        since = 0
+        while True:
+            page = self._fetch(
+                f'SELECT {self.COLUMNS} FROM messages WHERE seq >= ? ORDER BY seq LIMIT ?',
+                (since, self.page_size))
+            for row in page:
+                yield self._message(row)
+            if len(page) < self.page_size:
+                return
+            since = page[-1][0] + 1
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+        os.remove(self.path)
+
+
+def open_spill_store(directory: Optional[str], msg_pool: MessagePool) -> Optional[SpillStore]:
+    """
+    Let the pool move messages over its memory budget to a store in the directory
+    """
+
+    if not msg_pool.memory_budget:
+        return None
+
+    os.makedirs(directory or tempfile.gettempdir(), exist_ok=True)
+    path = os.path.join(directory or tempfile.gettempdir(), f'chat-spill-{os.getpid()}.sqlite')
+    msg_pool.spill_store = SpillStore(path)
+    return msg_pool.spill_store
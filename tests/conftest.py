@@ -1,9 +1,13 @@
+import asyncio
+import contextlib
 from asyncio import BaseTransport
 from datetime import datetime
 
 import pytest
 
-from services import MessageItem, CHANNEL, GENERAL, PRIVATE, ConnectionItem
+import server
+from services import (MessageItem, MessagePool, ConnectionItem, ConnectionPool, RateLimiter,
+                      CHANNEL, GENERAL, PRIVATE)
 
 
 @pytest.fixture
@@ -53,5 +57,80 @@ def connection_to_springfield_not_banned() -> ConnectionItem:
     conn = ConnectionItem(
         transport=BaseTransport(),
         user_name='Bart',
+        rate_limiter=RateLimiter(),
     )
     return conn
+
+
+@pytest.fixture
+def message_pool() -> MessagePool:
+    pool = MessagePool()
+    for idx, (creator, destination_type, destination_name) in enumerate([
+        ('Homer', CHANNEL, GENERAL),
+        ('Bart', CHANNEL, GENERAL),
+        ('Homer', PRIVATE, 'Bart'),
+        ('Lisa', PRIVATE, 'Bart'),
+        ('Homer', CHANNEL, GENERAL),
+    ]):
+        pool.add(MessageItem(
+            uuid=str(idx),
+            dt=datetime(year=2023, month=1, day=1, hour=0, minute=0, second=idx),
+            creator=creator,
+            destination_type=destination_type,
+            destination_name=destination_name,
+            message=f'text{idx}',
+            received_users=[]
+        ))
+    return pool
+
+
+class RecordingTransport(BaseTransport):
+    def __init__(self):
+        super().__init__()
+        self.data = []
+        self.aborted = False
+
+    def write(self, data: bytes) -> None:
+        self.data.append(data)
+
+    def writelines(self, list_of_data) -> None:
+        self.data.append(b''.join(list_of_data))
+
+    def abort(self) -> None:
+        self.aborted = True
+
+
+@pytest.fixture
+def connection_pool() -> ConnectionPool:
+    pool = ConnectionPool()
+    for name in ('Homer', 'Bart', 'Lisa'):
+        pool.add(ConnectionItem(transport=RecordingTransport(), user_name=name))
+    return pool
+
+
+@pytest.fixture
+def transport_factory():
+    return RecordingTransport
+
+
+@pytest.fixture
+def chat_server(monkeypatch):
+    """
+    Start the chat server with the history replay in the running loop, yield its port
+    """
+
+    @contextlib.asynccontextmanager
+    async def start():
+        loop = asyncio.get_running_loop()
+        # Every test runs its own loop, the event of the replay task is bound to one
+        monkeypatch.setattr(server, 'REPLAY_EVENT', asyncio.Event())
+        srv = await loop.create_server(server.ChatServerProtocol, '127.0.0.1', 0)
+        replay = loop.create_task(server.Server('127.0.0.1', 0).send_messages_from_queue())
+        try:
+            yield srv.sockets[0].getsockname()[1]
+        finally:
+            replay.cancel()
+            srv.close()
+            await asyncio.sleep(0.01)
+
+    return start
@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+
+from bus import MessageBusHub, MessageBusClient
+from services import (MessageItem, MessagePool, ConnectionPool, ConnectionItem,
+                      CHANNEL, GENERAL)
+
+
+class Worker:
+    def __init__(self, path, worker, transport_factory):
+        self.transport_factory = transport_factory
+        self.msg_pool = MessagePool()
+        self.conn_pool = ConnectionPool()
+        self.complaints = []
+        self.bus = MessageBusClient(path, worker, self.msg_pool, self.conn_pool,
+                                    lambda conn, who: self.complaints.append((conn.user_name, who)))
+
+    def join(self, name) -> ConnectionItem:
+        conn = ConnectionItem(transport=self.transport_factory(), user_name=None)
+        self.conn_pool.add(conn)
+        self.conn_pool.set_user_name(conn, name)
+        return conn
+
+
+async def run_workers(tmp_path, transport_factory, scenario):
+    path = str(tmp_path / 'bus.sock')
+    hub = MessageBusHub(path)
+    await hub.start()
+
+    workers = [Worker(path, 0, transport_factory), Worker(path, 1, transport_factory)]
+    tasks = []
+    for worker in workers:
+        await worker.bus.connect()
+        tasks.append(asyncio.create_task(worker.bus.receiving()))
+
+    async def settle():
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+
+    try:
+        await scenario(workers, settle)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.server.close()
+
+
+def test_bus_shares_messages_and_roster(tmp_path, transport_factory):
+    async def scenario(workers, settle):
+        first, second = workers
+        first.join('Homer')
+        bart = second.join('Bart')
+        await settle()
+
+        assert first.conn_pool.has_user_name('Bart')
+        assert sorted(second.conn_pool.get_all_user_names()) == ['Bart', 'Homer']
+
+        msg = MessageItem(uuid='x', dt=datetime.now(), creator='Homer', destination_type=CHANNEL,
+                          destination_name=GENERAL, message='Hi', received_users=[])
+        first.msg_pool.add(msg)
+        first.conn_pool.send_message(msg)
+        await settle()
+
+        remote_msg = second.msg_pool.get_message_by_uuid('x')
+        assert remote_msg.message == 'Hi'
+        assert b'Hi' in b''.join(bart.transport.data)
+
+        second.msg_pool.mark_received(remote_msg, 'Bart')
+        await settle()
+        assert msg.is_received_by('Bart')
+
+        second.conn_pool.del_by_transport(bart.transport)
+        await settle()
+        assert not first.conn_pool.has_user_name('Bart')
+
+    asyncio.run(run_workers(tmp_path, transport_factory, scenario))
+
+
+def test_bus_forwards_complaints(tmp_path, transport_factory):
+    async def scenario(workers, settle):
+        first, second = workers
+        first.join('Homer')
+        second.join('Bart')
+        await settle()
+
+        first.conn_pool.forward_complaint('Bart', 'Homer')
+        await settle()
+
+        assert second.complaints == [('Bart', 'Homer')]
+        assert first.complaints == []
+
+    asyncio.run(run_workers(tmp_path, transport_factory, scenario))
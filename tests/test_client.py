@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime
+
+import client
+import server
+from client import AsyncChatClient
+from services import CHANNEL, GENERAL, PRIVATE, EOS, InfoMsgStatuses, MessageItem
+
+
+async def take(bot: AsyncChatClient, count: int):
+    msgs = []
+    async for msg in bot:
+        msgs.append(msg['message'])
+        if len(msgs) == count:
+            return msgs
+
+
+def test_async_client_reconnects(chat_server, monkeypatch):
+    monkeypatch.setattr(client, 'RECONNECT_DELAY', 0.01)
+
+    async def chat():
+        async with chat_server() as port:
+            alice = AsyncChatClient(port=port)
+            bob = AsyncChatClient(port=port)
+            await alice.connect('bot_alice')
+            await bob.connect('bot_bob')
+            await alice.change_chat(PRIVATE, 'bot_bob')
+            await bob.change_chat(PRIVATE, 'bot_alice')
+            await asyncio.sleep(0.05)
+
+            await alice.send_many(['one', 'two', 'three'])
+            assert await asyncio.wait_for(take(bob, 3), 1) == ['one', 'two', 'three']
+
+            # The server loses Bob before the read ack, he comes back to the same chat
+            #   and gets only the new message
+            server.CONNECTION_POOL.get_by_user_name('bot_bob').transport.abort()
+            await asyncio.sleep(0.05)
+            await alice.send('four')
+            assert await asyncio.wait_for(take(bob, 1), 2) == ['four']
+            assert bob.reconnects == 1
+            assert bob.chat == (PRIVATE, 'bot_alice')
+
+            await alice.close()
+            await bob.close()
+            assert [msg async for msg in bob] == []
+
+    asyncio.run(chat())
+
+
+def test_async_client_keeps_history_after_live_messages(monkeypatch):
+    monkeypatch.setattr(client, 'RECONNECT_DELAY', 0.01)
+
+    def frame(seq):
+        return MessageItem(uuid=str(seq), dt=datetime.now(), creator='Homer',
+                           destination_type=CHANNEL, destination_name=GENERAL,
+                           message=f'text{seq}', seq=seq).frame()
+
+    # A live message comes before the history, the next connection replays an unread one
+    connections = [[frame(10), frame(5), frame(6)], [frame(6), frame(11)]]
+
+    async def serve(reader, writer):
+        writer.write(InfoMsgStatuses.CHOOSE_NAME.msg_bts + EOS)
+        name = (await reader.readline()).strip()
+        writer.write(InfoMsgStatuses.NAME_ACCEPTED.msg_bts + b' ' + name + EOS)
+        writer.writelines(connections.pop(0))
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.close()
+
+    async def chat():
+        srv = await asyncio.start_server(serve, '127.0.0.1', 0)
+        bot = AsyncChatClient(port=srv.sockets[0].getsockname()[1])
+        await bot.connect('bot_homer')
+        msgs = await asyncio.wait_for(take(bot, 4), 2)
+        await bot.close()
+        srv.close()
+        return msgs
+
+    assert asyncio.run(chat()) == ['text10', 'text5', 'text6', 'text11']
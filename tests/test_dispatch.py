@@ -0,0 +1,118 @@
+import asyncio
+import os
+import pstats
+
+import server
+from client import AsyncChatClient
+from dispatch import CommandDispatcher
+from profiler import Profiler
+from services import InfoMsgStatuses, EOS
+
+
+def test_dispatcher_middlewares():
+    calls = []
+
+    def tagged(tag):
+        def middleware(command, handler):
+            if not command.options.get(tag):
+                return handler
+
+            def wrapper(protocol, args):
+                calls.append((tag, command.label))
+                handler(protocol, args)
+            return wrapper
+        return middleware
+
+    dispatcher = CommandDispatcher([tagged('outer'), tagged('inner')])
+
+    @dispatcher.command(InfoMsgStatuses.BAN_USER, outer=True, inner=True)
+    def ban_user(protocol, args):
+        calls.append(('ban', args))
+
+    @dispatcher.command(InfoMsgStatuses.HISTORY, label='pages')
+    def history(protocol, args):
+        calls.append(('history', args))
+
+    @dispatcher.fallback()
+    def unknown(protocol, frame):
+        calls.append(('unknown', frame))
+
+    dispatcher.dispatch(None, b'ban_user Bart\n')
+    dispatcher.dispatch(None, b'history channel general')
+    dispatcher.dispatch(None, b'hello there')
+    assert calls == [('outer', 'ban_user'), ('inner', 'ban_user'), ('ban', b'Bart'),
+                     ('history', b'channel general'), ('unknown', b'hello there')]
+
+    # A middleware added later wraps the registered handlers too
+    calls.clear()
+    dispatcher.use(tagged('label'))
+    dispatcher.commands[b'history'].options['label'] = True
+    dispatcher.use(lambda command, handler: handler)
+    dispatcher.dispatch(None, b'history private Lisa')
+    assert calls == [('label', 'pages'), ('history', b'private Lisa')]
+
+
+def test_naming_keywords_are_not_names(chat_server):
+    async def chat():
+        async with chat_server() as port:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            await reader.readline()
+
+            for name in (b'encoding', b'encoding Bart'):
+                writer.write(name + EOS)
+                assert await reader.readline() == b'The name can\'t start with `encoding`\n'
+                assert await reader.readline() == InfoMsgStatuses.NAME_REJECTED.msg_bts + EOS
+
+            writer.write(b'encoding compact' + EOS)
+            assert await reader.readline() == b'encoding compact\n'
+            writer.write(b'keyword_bart' + EOS)
+            assert (await reader.readline()).startswith(InfoMsgStatuses.NAME_ACCEPTED.msg_bts)
+            writer.close()
+
+    asyncio.run(chat())
+
+
+def test_profile_command(chat_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'ADMIN_USERS', ('admin',))
+    monkeypatch.setattr(server, 'PROFILER', Profiler(str(tmp_path), sample_interval=0.001))
+
+    async def wait_text(texts, prefix):
+        while not any(text.startswith(prefix) for text in texts):
+            await asyncio.sleep(0.01)
+        return next(text for text in texts if text.startswith(prefix))
+
+    async def chat():
+        async with chat_server() as port:
+            admin_texts, user_texts = [], []
+            admin = AsyncChatClient(port=port, reconnect=False, echo=admin_texts.append)
+            user = AsyncChatClient(port=port, reconnect=False, echo=user_texts.append)
+            await admin.connect('admin')
+            await user.connect('user')
+
+            await user.send_command('profile sample 0.1')
+            await asyncio.wait_for(wait_text(user_texts, 'Only admins can use `profile`'), 1)
+            await admin.send_command('profile sample 1000000')
+            await asyncio.wait_for(wait_text(admin_texts, 'Wrong command'), 1)
+
+            await admin.send_command('profile sample 0.2')
+            await admin.send_command('profile cprofile 0.2')
+            await asyncio.wait_for(wait_text(admin_texts, 'The server is being profiled'), 1)
+            written = await asyncio.wait_for(wait_text(admin_texts, 'The profile is written'), 2)
+            folded = written.rsplit(' ', 1)[1]
+
+            admin_texts.clear()
+            await admin.send_command('profile cprofile 0.2')
+            written = await asyncio.wait_for(wait_text(admin_texts, 'The profile is written'), 2)
+            prof = written.rsplit(' ', 1)[1]
+
+            await admin.close()
+            await user.close()
+            return folded, prof
+
+    folded, prof = asyncio.run(chat())
+    assert os.path.dirname(folded) == str(tmp_path)
+    with open(folded) as file:
+        samples = [line.rsplit(' ', 1) for line in file]
+    assert samples and all(int(count) > 0 for _, count in samples)
+    assert any('run_forever' in stack for stack, _ in samples)
+    assert pstats.Stats(prof).total_calls > 0
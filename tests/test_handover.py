@@ -0,0 +1,152 @@
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from client import AsyncChatClient
+from handover import (dump_pools, load_pools, dump_connection, load_connection,
+                      listen_handover, wait_takeover, send_handover, take_over)
+from server import Server
+from services import (MessagePool, ConnectionPool, ConnectionItem, RateLimiter, CHANNEL, GENERAL,
+                      PRIVATE)
+
+
+def test_handover_state_and_sockets(tmp_path, message_pool, connection_pool):
+    rate_limiter = RateLimiter({GENERAL: (2, 60)})
+    assert rate_limiter.acquire('Homer', GENERAL) and rate_limiter.acquire('Homer', GENERAL)
+
+    homer = connection_pool.get_by_user_name('Homer')
+    homer.ban_time = datetime.now() + timedelta(minutes=5)
+    connection_pool.ban(homer)
+    bart = connection_pool.get_by_user_name('Bart')
+    connection_pool.change_chat(bart, PRIVATE, 'Lisa')
+    message_pool.mark_received(message_pool.get_message_by_uuid('0'), 'Bart')
+    message_pool.skip_history(CHANNEL, GENERAL, 'Lisa', 5)
+    connection_pool.write_messages(bart, [message_pool.get_message_by_uuid('3')])
+    bart.backlog.append(message_pool.get_message_by_uuid('2'))
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    # The chat server listens on two addresses, both of them are handed over
+    listener6 = socket.create_server(('::1', 0), family=socket.AF_INET6)
+    client_side, server_side = socket.socketpair()
+
+    async def hand_over():
+        loop = asyncio.get_running_loop()
+        sock = listen_handover(str(tmp_path / 'handover.sock'))
+        taking = loop.run_in_executor(None, take_over, str(tmp_path / 'handover.sock'), 5)
+        peer = await wait_takeover(sock)
+
+        state = dump_pools(message_pool, connection_pool, rate_limiter)
+        state['listeners'] = ['chat', 'chat']
+        state['connections'] = [dump_connection(bart, b'messages_re')]
+        fds = [listener.fileno(), listener6.fileno(), server_side.fileno()]
+        await loop.run_in_executor(None, send_handover, peer, fds, state, 5)
+        peer.close()
+        sock.close()
+        return await taking
+
+    handover = asyncio.run(hand_over())
+
+    # Both processes share the sockets now
+    assert [sock.getsockname() for sock in handover.listeners['chat']] == \
+        [listener.getsockname(), listener6.getsockname()]
+    (handed_sock, state), = handover.connections
+    client_side.send(b'hello')
+    assert handed_sock.recv(5) == b'hello'
+
+    msg_pool, conn_pool, limiter = MessagePool(), ConnectionPool(), RateLimiter({GENERAL: (2, 60)})
+    assert load_pools(handover.state, msg_pool, conn_pool, limiter)
+    assert msg_pool.epoch == message_pool.epoch
+    assert msg_pool.last_seq == message_pool.last_seq
+    assert [msg.uuid for msg in msg_pool.all_messages()] == ['0', '1', '2', '3', '4']
+    assert msg_pool.get_message_by_uuid('0').received_users == ['Bart']
+    unread = msg_pool.get_messages(CHANNEL, GENERAL, not_received_user='Lisa',
+                                   not_from_creator='Lisa')
+    assert [msg.uuid for msg in unread] == ['4']
+    assert abs(conn_pool.bans['Homer'] - connection_pool.bans['Homer']) < timedelta(milliseconds=1)
+    assert not limiter.acquire('Homer', GENERAL)
+    assert sorted(conn_pool.roster.users) == ['Bart', 'Homer', 'Lisa']
+
+    conn = ConnectionItem(transport=None, user_name=None)
+    backlog = load_connection(state, conn, msg_pool)
+    assert (conn.user_name, conn.current_connection_type, conn.current_connection_name) == \
+        ('Bart', PRIVATE, 'Lisa')
+    assert [msg.uuid for msg in conn.delivered[(PRIVATE, 'Lisa')]] == ['3']
+    assert [msg.uuid for msg in backlog] == ['2']
+    assert state['pending'] == b'messages_re'
+
+    # A server started on the handed over sockets accepts on both addresses
+    async def serve():
+        server = Server('127.0.0.1', 0, handover_path=None)
+        await server.start_servers(0, None, handover.listeners)
+        for address in (listener.getsockname(), listener6.getsockname()[:2]):
+            client = AsyncChatClient(*address, reconnect=False)
+            await client.connect(f'dual{address[1]}')
+            await client.close()
+        for srv in server.servers['chat']:
+            srv.close()
+        return len(server.servers['chat'])
+
+    assert asyncio.run(serve()) == 2
+
+    for sock in (listener, listener6, client_side, server_side, handed_sock,
+                 *handover.listeners['chat']):
+        sock.close()
+
+
+def start_server(port: int, path: str, *args: str) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, 'server.py', '--handover', path, *args],
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    process.stdin.write(f'127.0.0.1\n{port}\n'.encode())
+    process.stdin.close()
+    return process
+
+
+def test_server_hands_over_connections(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    path = str(tmp_path / 'handover.sock')
+
+    async def chat():
+        alice = AsyncChatClient(port=port, reconnect=False)
+        bob = AsyncChatClient(port=port, reconnect=False)
+        for _ in range(100):
+            try:
+                await alice.connect('alice')
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        await bob.connect('bob')
+        await alice.send('before')
+        assert (await bob.__anext__())['message'] == 'before'
+
+        new = start_server(port, path, '--takeover')
+        started = time.monotonic()
+        while old.poll() is None and time.monotonic() - started < 10:
+            await asyncio.sleep(0.05)
+        assert old.returncode == 0
+
+        # The connections are served by the new process, the port too
+        await alice.send('after')
+        assert (await asyncio.wait_for(bob.__anext__(), 5))['message'] == 'after'
+        carol = AsyncChatClient(port=port, reconnect=False)
+        await carol.connect('carol')
+        assert [(await carol.__anext__())['message'] for _ in range(2)] == ['before', 'after']
+
+        for client in (alice, bob, carol):
+            await client.close()
+        return new
+
+    old = start_server(port, path)
+    new = None
+    try:
+        new = asyncio.run(chat())
+    finally:
+        for process in (old, new):
+            if process and process.poll() is None:
+                process.terminate()
+                process.wait()
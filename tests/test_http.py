@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import server
+from http_server import HttpFrontend
+from services import MAX_FRAME_SIZE
+
+
+async def start_frontend() -> HttpFrontend:
+    frontend = HttpFrontend(server.ChatServerProtocol, server.CONNECTION_POOL)
+    await frontend.start('127.0.0.1', 0)
+    return frontend
+
+
+async def read_response(reader: asyncio.StreamReader):
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()).strip():
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while size := int(await reader.readline(), 16):
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        await reader.readexactly(2)
+    else:
+        body = await reader.readexactly(int(headers['content-length']))
+    return status, headers, json.loads(body)
+
+
+def request(method: str, path: str, data=None, token=None) -> bytes:
+    body = json.dumps(data).encode() if data is not None else b''
+    head = f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n'
+    if token:
+        head += f'Authorization: Bearer {token}\r\n'
+    return head.encode() + b'\r\n' + body
+
+
+def test_http_chat():
+    async def chat():
+        frontend = await start_frontend()
+        port = frontend.servers[0].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        async def call(method, path, data=None, token=None):
+            writer.write(request(method, path, data, token))
+            return await read_response(reader)
+
+        status, _, alice = await call('POST', '/connect', {'name': 'http_alice'})
+        assert status == 200
+        _, _, bob = await call('POST', '/connect', {'name': 'http_bob'})
+        assert (await call('POST', '/connect', {'name': 'http_bob'}))[0] == 409
+        for name in ('encoding bob', 'resume bob'):
+            status, _, answer = await call('POST', '/connect', {'name': name})
+            assert status == 400 and answer['error'].startswith('The name can\'t start with')
+
+        status, _, roster = await call('GET', '/status')
+        assert {'http_alice', 'http_bob'} <= set(roster['users'])
+
+        # Bob waits for a message which Alice sends on another connection
+        status, _, _ = await call('POST', '/chat', {'type': 'private', 'name': 'http_alice'},
+                                  bob['token'])
+        assert status == 200
+        _, _, answer = await call('GET', f'/messages?since={bob["last"]}&timeout=0',
+                                  token=bob['token'])
+        poll = asyncio.create_task(
+            call('GET', f'/messages?since={answer["last"]}&timeout=5', token=bob['token']))
+        await asyncio.sleep(0.05)
+        other_reader, other_writer = await asyncio.open_connection('127.0.0.1', port)
+        other_writer.write(request('POST', '/send', {'text': 'hello bob', 'chat': {
+            'type': 'private', 'name': 'http_bob'}}, alice['token']))
+        assert (await read_response(other_reader))[0] == 202
+
+        status, headers, answer = await poll
+        assert headers['transfer-encoding'] == 'chunked'
+        messages = [event['data'] for event in answer['events']
+                    if event['type'] == 'message_from_srv']
+        assert [msg['message'] for msg in messages] == ['hello bob']
+
+        # Pipelined requests are answered in order, the poll acknowledges the message
+        writer.write(request('GET', f'/messages?since={answer["last"]}&timeout=0',
+                             token=bob['token']) + request('GET', '/nowhere'))
+        status, _, answer = await read_response(reader)
+        assert status == 200 and answer['events'] == []
+        assert (await read_response(reader))[0] == 404
+        assert server.CONNECTION_POOL.get_by_user_name('http_bob').delivered == {}
+
+        assert (await call('POST', '/send', {'text': 'hi'}))[0] == 401
+        assert (await call('GET', '/send'))[0] == 405
+        assert (await call('POST', '/disconnect', token=alice['token']))[0] == 200
+        assert 'http_alice' not in server.CONNECTION_POOL.get_all_user_names()
+
+        for stream in (writer, other_writer):
+            stream.close()
+        frontend.servers[0].close()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(chat())
+
+
+def test_http_1_0_poll_and_internal_error():
+    async def chat():
+        frontend = await start_frontend()
+        port = frontend.servers[0].sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request('POST', '/connect', {'name': 'http_old'}))
+        _, _, old = await read_response(reader)
+        writer.write(f'GET /messages?timeout=0 HTTP/1.0\r\nConnection: keep-alive\r\n'
+                     f'Authorization: Bearer {old["token"]}\r\n\r\n'.encode())
+        status, headers, answer = await read_response(reader)
+        assert status == 200 and 'transfer-encoding' not in headers
+        assert headers['connection'] == 'close' and 'events' in answer
+        assert await reader.read() == b''
+        writer.close()
+
+        async def broken(request, writer):
+            raise KeyError('broken')
+
+        frontend.routes[('GET', '/status')] = broken
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request('GET', '/status'))
+        status, _, answer = await read_response(reader)
+        assert status == 500 and answer['error'] == 'Internal Server Error'
+        assert await reader.read() == b''
+        writer.close()
+
+        # A ValueError of a handler is not taken for a broken request
+        async def broken_value(request, writer):
+            raise ValueError('broken')
+
+        frontend.routes[('GET', '/status')] = broken_value
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request('GET', '/status'))
+        status, _, answer = await read_response(reader)
+        assert status == 500
+        writer.close()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /status HTTP/1.1\r\nX-Long: ' + b'x' * MAX_FRAME_SIZE + b'\r\n\r\n')
+        status, _, answer = await read_response(reader)
+        assert status == 400 and answer['error'] == 'The request line is too long'
+        writer.close()
+
+        frontend.sessions[old['token']].close()
+        frontend.servers[0].close()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(chat())
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import server
+from client import AsyncChatClient
+from services import AdmissionControl, TimerWheel, EOS
+
+
+def test_timer_wheel():
+    fired = []
+    wheel = TimerWheel(fired.append, tick=1, slots=4)
+    wheel.schedule('a', 1)
+    wheel.schedule('b', 2.5)
+    wheel.schedule('c', 6)  # in the next turn of the wheel
+    wheel.schedule('d', 1)
+    wheel.cancel('d')
+    assert len(wheel) == 3
+
+    assert wheel.advance() == 1 and fired == ['a']
+    wheel.schedule('b', 1)  # moved to the next tick
+    assert wheel.advance() == 1 and fired == ['a', 'b']
+    for _ in range(3):
+        wheel.advance()
+    assert fired == ['a', 'b'] and wheel.elapsed(0) == 5
+    wheel.advance()
+    assert fired == ['a', 'b', 'c'] and len(wheel) == 0
+
+
+def test_admission_control():
+    admission = AdmissionControl(max_connections=3, max_per_ip=2)
+    assert admission.admit('10.0.0.1') and admission.admit('10.0.0.1')
+    assert not admission.admit('10.0.0.1')
+    assert admission.admit(None)
+    assert not admission.admit('10.0.0.2')
+    assert admission.admit('10.0.0.2', force=True)
+    assert admission.refused == 2
+
+    admission.release('10.0.0.1')
+    admission.release('10.0.0.2')
+    assert admission.total == 2 and admission.by_ip == {'10.0.0.1': 1}
+
+
+async def read_frames(reader: asyncio.StreamReader):
+    frames = []
+    while line := await reader.readline():
+        frames.append(line.rstrip(EOS).decode())
+    return frames
+
+
+def test_connection_timeouts(chat_server, monkeypatch):
+    monkeypatch.setattr(server, 'ADMISSION', AdmissionControl(max_per_ip=3))
+    monkeypatch.setattr(server, 'WHEEL', TimerWheel(lambda protocol: protocol.check_liveness(),
+                                                    tick=0.05))
+    monkeypatch.setattr(server, 'NAME_TIMEOUT', 0.3)
+    monkeypatch.setattr(server, 'HEARTBEAT_INTERVAL', 0.3)
+    monkeypatch.setattr(server, 'HEARTBEAT_TIMEOUT', 0.2)
+    dead_peers = server.ChatServerProtocol.dead_peers
+
+    async def chat():
+        async with chat_server() as port:
+            wheel = asyncio.create_task(server.Server('127.0.0.1', 0).turning_wheel())
+
+            alive = AsyncChatClient(port=port, reconnect=False)
+            await alive.connect('alive')
+
+            # Asks for heartbeats but never answers them
+            silent_reader, silent_writer = await asyncio.open_connection('127.0.0.1', port)
+            await silent_reader.readline()
+            silent_writer.write(b'encoding json heartbeat\nsilent\n')
+
+            nameless_reader, _ = await asyncio.open_connection('127.0.0.1', port)
+            with pytest.raises(ConnectionRefusedError):
+                await AsyncChatClient(port=port, reconnect=False).connect('refused')
+
+            await alive.send('hello')
+            nameless, silent = await asyncio.wait_for(asyncio.gather(
+                read_frames(nameless_reader), read_frames(silent_reader)), 2)
+
+            # The client answering pings stays
+            assert server.CONNECTION_POOL.get_by_user_name('alive')
+            assert not alive.protocol.transport.is_closing()
+            assert server.ADMISSION.total == 1
+            await alive.close()
+            wheel.cancel()
+            return nameless, silent
+
+    nameless, silent = asyncio.run(chat())
+    assert len(nameless) == 2 and nameless[0].startswith('choose_name')
+    assert nameless[1] == 'The name has not been chosen in time'
+    assert 'encoding json heartbeat' in silent and 'ping' in silent
+    assert any(frame.startswith('message_from_srv') for frame in silent)
+    assert server.ChatServerProtocol.dead_peers == dead_peers + 1
@@ -0,0 +1,57 @@
+import io
+import json
+import logging
+import threading
+import time
+
+from logs import LogPipeline
+
+
+class BlockedStream(io.StringIO):
+    """
+    A stream which blocks the writer until it is released, like a stuck pipe
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.writing = threading.Event()
+        self.released = threading.Event()
+
+    def write(self, text: str) -> int:
+        self.writing.set()
+        self.released.wait()
+        return super().write(text)
+
+
+def test_log_pipeline_never_blocks():
+    stream = BlockedStream()
+    pipeline = LogPipeline(stream, json_format=True, queue_size=3, sampling={'expiry': 3})
+    pipeline.start()
+    logger = logging.getLogger()
+    try:
+        logger.info('first')
+        assert stream.writing.wait(1)
+
+        started = time.perf_counter()
+        for idx in range(10):
+            logger.info('record %d', idx)
+        assert time.perf_counter() - started < 0.5
+        assert pipeline.dropped == 7 and pipeline.queued == 3
+
+        stream.released.set()
+        while pipeline.queued:
+            time.sleep(0.01)
+        logger.warning('after the drops')
+        for idx in range(6):
+            logger.info(f'expired {idx}', extra={'category': 'expiry'})
+    finally:
+        stream.released.set()
+        pipeline.stop()
+
+    assert pipeline.handler not in logger.handlers and logger.handlers
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [record['message'] for record in records] == [
+        'first', 'record 0', 'record 1', 'record 2', 'after the drops', 'expired 0', 'expired 3']
+    assert records[4]['dropped'] == 7 and records[4]['level'] == 'WARNING'
+    assert records[5]['category'] == 'expiry' and records[5]['sample_rate'] == 3
+    assert pipeline.sampled_out == 4
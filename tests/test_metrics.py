@@ -0,0 +1,77 @@
+import asyncio
+
+from metrics import Histogram, MetricsRegistry, MetricsEndpoint, COUNT_BUCKETS
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(unit=1e-6)
+    for value in range(1, 1001):
+        histogram.observe(value / 1000)  # 1 ms .. 1 s
+
+    assert histogram.count == 1000
+    for q, expected in ((0.5, 0.5), (0.95, 0.95), (0.99, 0.99)):
+        assert abs(histogram.quantile(q) - expected) / expected < 1 / 16
+
+    for idx in range(1000):
+        low, high = Histogram.bucket_bounds(idx)
+        assert Histogram.bucket_index(low) == Histogram.bucket_index(high) == idx
+
+
+def test_metrics_render():
+    registry = MetricsRegistry()
+    registry.gauge('chat_connections', 'Connections', lambda: 3)
+    fanout = registry.histogram('chat_fanout_recipients', 'Recipients', unit=1,
+                                buckets=COUNT_BUCKETS)
+    commands = registry.histogram('chat_command_seconds', 'Commands', label='command')
+    for recipients in (0, 1, 1, 40):
+        fanout.observe(recipients)
+    commands.labels('get_statistic').observe(0.002)
+
+    text = registry.render()
+    assert 'chat_connections 3' in text
+    assert 'chat_fanout_recipients_bucket{le="1"} 3' in text
+    assert 'chat_fanout_recipients_bucket{le="+Inf"} 4' in text
+    assert 'chat_fanout_recipients_count 4' in text
+    assert 'chat_command_seconds_bucket{command="get_statistic",le="0.001"} 0' in text
+    assert 'chat_command_seconds_count{command="get_statistic"} 1' in text
+
+    snapshot = registry.snapshot()
+    assert snapshot['chat_connections'] == 3
+    assert snapshot['chat_command_seconds']['get_statistic']['count'] == 1
+
+
+def test_metrics_endpoint():
+    registry = MetricsRegistry()
+    registry.counter('chat_bytes_written_total', 'Bytes', lambda: 42)
+
+    async def scrape(path: bytes) -> bytes:
+        endpoint = MetricsEndpoint(registry)
+        await endpoint.start('127.0.0.1', 0)
+        port = endpoint.servers[0].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET ' + path + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        endpoint.servers[0].close()
+        return response
+
+    response = asyncio.run(scrape(b'/metrics'))
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert b'chat_bytes_written_total 42' in response
+
+    assert asyncio.run(scrape(b'/')).startswith(b'HTTP/1.1 404')
+
+
+def test_metrics_endpoint_drops_idle_scraper():
+    async def idle() -> bytes:
+        endpoint = MetricsEndpoint(MetricsRegistry(), request_timeout=0.1)
+        await endpoint.start('127.0.0.1', 0)
+        port = endpoint.servers[0].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\n')  # the headers never end
+        response = await asyncio.wait_for(reader.read(), 2)
+        writer.close()
+        endpoint.servers[0].close()
+        return response
+
+    assert asyncio.run(idle()) == b''
@@ -1,4 +1,16 @@
-from services import CHANNEL, GENERAL, PRIVATE, AVAILABLE_MSGS
+import asyncio
+import json
+import sys
+from datetime import datetime
+
+import pytest
+
+import services
+from client import ChatClientProtocol
+from services import (CHANNEL, GENERAL, PRIVATE, AVAILABLE_MSGS, RECEIPTS_TUPLE_LIMIT,
+                      ConnectionItem, FrameReader, FrameTooLargeError, MessageBucket, MessageItem,
+                      MessagePool, RateLimiter, Roster, InfoMsgStatuses, ReplayScheduler,
+                      SlowConsumerPolicy, USER_IDS, split_command, decode_compact_message)
 
 
 def test_text_to_general_true(message_to_general_channel):
@@ -56,6 +68,497 @@ def test_conn_can_send_message(connection_to_springfield_not_banned):
 
 
 def test_conn_can_not_send_message(connection_to_springfield_not_banned):
-    connection_to_springfield_not_banned.msgs_sent = AVAILABLE_MSGS
+    for _ in range(AVAILABLE_MSGS):
+        connection_to_springfield_not_banned.can_send_message(is_general_channel=True)
     can_send, _ = connection_to_springfield_not_banned.can_send_message(is_general_channel=True)
     assert can_send is False
+
+    # Private chats are not limited
+    can_send, _ = connection_to_springfield_not_banned.can_send_message()
+    assert can_send is True
+
+
+def test_rate_limiter_refills_lazily():
+    limiter = RateLimiter({GENERAL: (2, 1)})  # 2 messages per minute
+    assert limiter.acquire('Bart', GENERAL, now=0)
+    assert limiter.acquire('Bart', GENERAL, now=0)
+    assert not limiter.acquire('Bart', GENERAL, now=10)
+    assert limiter.retry_after('Bart', GENERAL, now=10) == pytest.approx(20)
+    assert limiter.acquire('Bart', GENERAL, now=30)
+    assert limiter.acquire('Lisa', GENERAL, now=30)
+    assert limiter.acquire('Bart', 'other', now=30)
+    assert limiter.limited_count == 1
+
+
+def test_rate_limit_survives_reconnect():
+    limiter = RateLimiter({GENERAL: (1, 60)})
+    conn = ConnectionItem(transport=None, user_name='Bart', rate_limiter=limiter)
+    assert conn.can_send_message(channel=GENERAL)[0] is True
+
+    conn = ConnectionItem(transport=None, user_name='Bart', rate_limiter=limiter)
+    can_send, error_text = conn.can_send_message(channel=GENERAL)
+    assert can_send is False
+    assert 'limit of 1 messages per 60 minutes' in error_text
+
+
+def test_rate_limiter_evicts_idle_buckets():
+    limiter = RateLimiter({GENERAL: (2, 1)}, max_entries=3)
+    for idx in range(3):
+        assert limiter.acquire(f'user{idx}', GENERAL, now=0)
+    assert limiter.entries_count == 3
+
+    # Buckets in use are kept, so a new sender waits for the first one to be full again
+    assert not limiter.acquire('user3', GENERAL, now=0)
+    assert limiter.retry_after('user3', GENERAL, now=10) == pytest.approx(20)
+    assert limiter.acquire('user0', GENERAL, now=0)
+    assert not limiter.acquire('user0', GENERAL, now=0)
+    assert limiter.entries_count == 3
+
+    # Full again after a minute, so they are dropped
+    limiter.acquire('Bart', GENERAL, now=60)
+    assert limiter.entries_count == 1
+
+
+def test_pool_get_message_by_uuid(message_pool):
+    assert message_pool.get_message_by_uuid('2').message == 'text2'
+    assert message_pool.get_message_by_uuid('unknown') is None
+
+
+def test_pool_unread_channel_messages(message_pool):
+    message_pool.mark_received(message_pool.get_message_by_uuid('0'), 'Bart')
+    msgs = message_pool.get_messages(not_received_user='Bart', not_from_creator='Bart')
+    assert [msg.uuid for msg in msgs] == ['4']
+
+    message_pool.mark_received(message_pool.get_message_by_uuid('4'), 'Bart')
+    assert message_pool.get_messages(not_received_user='Bart', not_from_creator='Bart') == []
+    assert len(message_pool.get_messages()) == 3
+
+
+def test_pool_unread_private_messages(message_pool):
+    msgs = message_pool.get_messages(destination_type=PRIVATE, destination_name='Bart',
+                                     creator='Lisa', not_received_user='Bart',
+                                     not_from_creator='Bart')
+    assert [msg.uuid for msg in msgs] == ['3']
+
+
+def test_pool_remove_message(message_pool):
+    message_pool.remove(message_pool.get_message_by_uuid('2'))
+    assert message_pool.count == 4
+    assert message_pool.get_messages(destination_type=PRIVATE, destination_name='Bart',
+                                     creator='Homer') == []
+
+
+def test_pool_delete_only_delivered_messages(message_pool):
+    assert message_pool.next_expiry() is None
+    assert message_pool.delete_delivered_messages() == 0
+
+    message_pool.mark_received(message_pool.get_message_by_uuid('0'), 'Bart')
+    message_pool.mark_received(message_pool.get_message_by_uuid('0'), 'Lisa')
+    assert message_pool.next_expiry() is not None
+
+    assert message_pool.delete_delivered_messages() == 1
+    assert message_pool.get_message_by_uuid('0') is None
+    assert message_pool.count == 4
+    assert message_pool.expired_count == 1
+    assert message_pool.next_expiry() is None
+
+
+def test_connection_pool_indexes(connection_pool):
+    bart = connection_pool.get_by_user_name('Bart')
+    assert connection_pool.get_by_transport(bart.transport) is bart
+    assert connection_pool.has_user_name('Bart')
+
+    connection_pool.del_by_transport(bart.transport)
+    assert connection_pool.get_by_user_name('Bart') is None
+    assert connection_pool.pool_len == 2
+
+
+def test_connection_pool_send_message(connection_pool, message_to_general_channel,
+                                      message_to_private_bart):
+    homer = connection_pool.get_by_user_name('Homer')
+    bart = connection_pool.get_by_user_name('Bart')
+    lisa = connection_pool.get_by_user_name('Lisa')
+    connection_pool.change_chat(bart, PRIVATE, 'Name1')
+    message_to_general_channel.creator = 'Lisa'
+
+    connection_pool.send_message(message_to_general_channel)
+    connection_pool.send_message(message_to_private_bart)
+
+    assert len(homer.transport.data) == 1
+    assert len(lisa.transport.data) == 0
+    assert len(bart.transport.data) == 0
+    assert connection_pool.get_all_channel_names() == [GENERAL]
+
+
+def test_connection_pool_send_private_message(connection_pool, message_to_private_bart):
+    message_to_private_bart.destination_name = 'Bart'
+    bart = connection_pool.get_by_user_name('Bart')
+    connection_pool.change_chat(bart, PRIVATE, 'Name1')
+
+    connection_pool.send_message(message_to_private_bart)
+    assert len(bart.transport.data) == 1
+
+
+def test_compact_frame_decodes_as_json(message_to_general_channel):
+    msg = message_to_general_channel
+    msg.seq = 7
+    expected = json.loads(msg.serialize())
+    expected['uuid'] = None
+
+    operator, args = split_command(msg.compact_frame())
+    assert operator is InfoMsgStatuses.COMPACT_MESSAGE
+    assert len(msg.compact_frame()) < len(msg.frame()) / 2
+    names = dict(zip(msg.name_ids(), (msg.creator, msg.destination_name)))
+    assert decode_compact_message(args, names) == expected
+
+
+def test_compact_connection_gets_names_once(connection_pool, message_to_general_channel):
+    homer = connection_pool.get_by_user_name('Homer')
+    homer.compact = True
+    message_to_general_channel.creator = 'Lisa'
+
+    connection_pool.send_message(message_to_general_channel)
+    connection_pool.send_message(message_to_general_channel)
+
+    first, second = homer.transport.data
+    frames = first.splitlines()
+    assert [split_command(frame)[0] for frame in frames] == [
+        InfoMsgStatuses.NAME_ID, InfoMsgStatuses.NAME_ID, InfoMsgStatuses.COMPACT_MESSAGE]
+    assert second == message_to_general_channel.compact_frame()
+
+
+def test_frame_reader_splits_and_joins_chunks():
+    reader = FrameReader()
+    assert reader.feed(b'get_statistic\nmessage_from_client he') == [b'get_statistic']
+    assert reader.feed(b'llo') == []
+    assert reader.feed(b'\nban_user Bart\n') == [b'message_from_client hello', b'ban_user Bart']
+
+
+def test_frame_reader_limit():
+    reader = FrameReader(max_size=8)
+    with pytest.raises(FrameTooLargeError):
+        reader.feed(b'message_from_client')
+
+
+def test_split_command():
+    assert split_command(b'change_chat private Bart') == (InfoMsgStatuses.CHANGE_CHAT,
+                                                          b'private Bart')
+    assert split_command(b'unknown')[0] is None
+
+
+def test_paused_connection_drops_oldest(connection_pool):
+    connection_pool.outbox_limit = 2
+    bart = connection_pool.get_by_user_name('Bart')
+
+    connection_pool.pause_writing(bart)
+    for frame in (b'1', b'2', b'3'):
+        connection_pool.write(bart, frame)
+    assert bart.transport.data == []
+    assert connection_pool.paused_count == 1
+    assert connection_pool.dropped_frames == 1
+
+    assert connection_pool.resume_writing(bart) is False
+    assert bart.transport.data == [b'2', b'3']
+    assert connection_pool.paused_count == 0
+
+
+def test_paused_connection_disconnect(connection_pool):
+    connection_pool.outbox_limit = 1
+    connection_pool.policy = SlowConsumerPolicy.DISCONNECT
+    bart = connection_pool.get_by_user_name('Bart')
+
+    connection_pool.pause_writing(bart)
+    connection_pool.write(bart, b'1')
+    connection_pool.write(bart, b'2')
+    assert bart.transport.aborted is True
+    assert connection_pool.slow_disconnects == 1
+
+
+def test_paused_connection_defer(connection_pool):
+    connection_pool.outbox_limit = 1
+    connection_pool.policy = SlowConsumerPolicy.DEFER
+    bart = connection_pool.get_by_user_name('Bart')
+
+    msg = MessageItem(uuid='1', dt=datetime.now(), creator='Homer', destination_type=CHANNEL,
+                      destination_name=GENERAL, message='text')
+
+    connection_pool.pause_writing(bart)
+    connection_pool.write(bart, b'1')
+    connection_pool.write(bart, msg.frame(), msg)
+    connection_pool.write(bart, b'2')  # a control frame is never dropped
+    assert connection_pool.dropped_frames == 1
+    assert connection_pool.resume_writing(bart) is True
+    assert bart.transport.data == [b'1', b'2']
+    assert connection_pool.frames_written == 2 and connection_pool.bytes_written == 2
+
+
+def test_unacked_overflow(connection_pool, message_pool, monkeypatch):
+    monkeypatch.setattr(services, 'UNACKED_LIMIT', 2)
+    bart = connection_pool.get_by_user_name('Bart')
+    msgs = [msg for msg in message_pool.get_messages() if msg.destination_type == CHANNEL]
+
+    connection_pool.write_messages(bart, msgs)
+    assert list(bart.delivered[(CHANNEL, GENERAL)]) == msgs[1:]
+    assert connection_pool.unacked_dropped == bart.unacked_dropped == 1
+    assert bart.transport.aborted is False
+
+    lisa = connection_pool.get_by_user_name('Lisa')
+    connection_pool.policy = SlowConsumerPolicy.DISCONNECT
+    connection_pool.write_messages(lisa, msgs)
+    assert lisa.transport.aborted is True
+    assert connection_pool.slow_disconnects == 1
+
+
+def test_replay_round_robin(connection_pool, message_pool):
+    replay = ReplayScheduler(connection_pool, batch_size=2)
+    bart = connection_pool.get_by_user_name('Bart')
+    lisa = connection_pool.get_by_user_name('Lisa')
+    msgs = message_pool.get_messages()
+
+    replay.schedule(bart, msgs)
+    replay.schedule(lisa, msgs[:1])
+    assert replay.send_round() == 3
+    assert len(bart.transport.data) == 1  # two messages are written at once
+    assert len(lisa.transport.data) == 1
+
+    assert replay.send_round() == 1
+    assert replay.has_ready is False
+    assert bart.transport.data[-1] == msgs[-1].frame()
+
+
+def test_replay_compressed_batch(connection_pool, message_pool, transport_factory):
+    replay = ReplayScheduler(connection_pool, zlib_threshold=3)
+    bart = connection_pool.get_by_user_name('Bart')
+    bart.compact = bart.zlib_batches = True
+    msgs = [msg for msg in message_pool.get_messages() if msg.destination_type == CHANNEL]
+
+    replay.schedule(bart, msgs)
+    assert replay.send_round() == 3
+    [batch] = bart.transport.data
+    assert split_command(batch)[0] is InfoMsgStatuses.MESSAGE_BATCH
+    assert len(bart.delivered[(CHANNEL, GENERAL)]) == 3
+
+    async def receive():
+        loop = asyncio.get_running_loop()
+        client = ChatClientProtocol(loop.create_future(), loop.create_future())
+        client.connection_made(transport_factory())
+        client.own_name = 'Bart'
+        client.data_received(batch)
+        client.read_ack_handle.cancel()
+        return client.read_seqs
+
+    assert asyncio.run(receive()) == {(CHANNEL, GENERAL): msgs[-1].seq}
+
+
+def test_batch_frame_fits_client_reader(connection_pool, message_pool, monkeypatch):
+    bart = connection_pool.get_by_user_name('Bart')
+    msgs = message_pool.get_messages()
+    connection_pool.write_batch(bart, msgs)
+    [batch] = bart.transport.data
+
+    # The header counts: a frame one byte over the limit is sent as separate frames
+    monkeypatch.setattr(services, 'MAX_BATCH_SIZE', len(batch) - 1)
+    bart.transport.data.clear()
+    connection_pool.write_batch(bart, msgs)
+    frames = b''.join(bart.transport.data).splitlines()
+    assert [split_command(frame)[0] for frame in frames] == \
+        [InfoMsgStatuses.MESSAGE_FROM_SRV] * len(msgs)
+
+    reader = FrameReader(max_size=len(batch))
+    assert reader.feed(batch[:-1]) == []
+    assert reader.feed(batch[-1:]) == [batch[:-1]]
+
+
+def test_replay_waits_for_paused_connection(connection_pool, message_pool):
+    replay = ReplayScheduler(connection_pool)
+    bart = connection_pool.get_by_user_name('Bart')
+
+    connection_pool.pause_writing(bart)
+    replay.schedule(bart, message_pool.get_messages())
+    assert replay.has_ready is False
+
+    connection_pool.resume_writing(bart)
+    replay.wake(bart)
+    assert replay.send_round() == 3
+
+
+def test_live_message_waits_for_replay(connection_pool, message_pool):
+    replay = ReplayScheduler(connection_pool, batch_size=1)
+    bart = connection_pool.get_by_user_name('Bart')
+    msgs = [msg for msg in message_pool.get_messages() if msg.destination_type == CHANNEL]
+
+    replay.schedule(bart, msgs)
+    assert replay.send_round() == 1
+    live = MessageItem(uuid='5', dt=datetime.now(), creator='Homer', destination_type=CHANNEL,
+                       destination_name=GENERAL, message='live', received_users=[])
+    message_pool.add(live)
+    assert connection_pool.send_message(live) == 2
+    while replay.has_ready:
+        replay.send_round()
+
+    seqs = [msg.seq for msg in bart.delivered[(CHANNEL, GENERAL)]]
+    assert seqs == sorted(seqs) and seqs[-1] == live.seq
+    assert bart.transport.data[-1] == live.frame()
+
+
+def test_history_pages(message_pool):
+    general = message_pool.history_page(CHANNEL, GENERAL, limit=2)
+    assert [msg.message for msg in general] == ['text1', 'text4']
+    older = message_pool.history_page(CHANNEL, GENERAL, before=general[0].seq, limit=2)
+    assert [msg.message for msg in older] == ['text0']
+
+    # Both sides of the private chat, the newest first
+    private = message_pool.iter_history(PRIVATE, 'Homer', user='Bart')
+    assert [msg.message for msg in private] == ['text2']
+    message_pool.add(MessageItem(uuid='5', dt=datetime.now(), creator='Bart',
+                                 destination_type=PRIVATE, destination_name='Homer',
+                                 message='text5'))
+    private = message_pool.history_page(PRIVATE, 'Homer', user='Bart')
+    assert [msg.message for msg in private] == ['text2', 'text5']
+
+
+def test_skip_history(message_pool):
+    seq = message_pool.history_page(CHANNEL, GENERAL, limit=1)[0].seq
+    message_pool.skip_history(CHANNEL, GENERAL, 'Marge', seq)
+
+    unread = message_pool.get_messages(CHANNEL, GENERAL, not_received_user='Marge',
+                                       not_from_creator='Marge')
+    assert [msg.message for msg in unread] == ['text4']
+    assert list(message_pool.skipped_history()) == [(CHANNEL, GENERAL, 'Marge', seq)]
+
+
+def test_message_read_receipts(message_to_general_channel):
+    users = [f'user{idx}' for idx in range(RECEIPTS_TUPLE_LIMIT + 2)]
+    for user in users:
+        assert message_to_general_channel.mark_received(user) is True
+    assert message_to_general_channel.mark_received(users[0]) is False
+
+    assert message_to_general_channel.received_count == len(users)
+    assert message_to_general_channel.received_users == users
+    assert message_to_general_channel.is_received_by(users[-1]) is True
+    assert message_to_general_channel.is_received_by('Bart') is False
+
+    # The size of the receipts doesn't depend on the ids of the readers
+    for idx in range(10_000):
+        USER_IDS.get_or_create(f'known{idx}')
+    size = sys.getsizeof(message_to_general_channel._receipts)
+    message_to_general_channel.mark_received('known9999')
+    assert message_to_general_channel.is_received_by('known9999') is True
+    assert sys.getsizeof(message_to_general_channel._receipts) - size < 64
+
+
+def test_message_frame_is_cached(message_to_general_channel):
+    frame = message_to_general_channel.frame()
+    assert frame.startswith(InfoMsgStatuses.MESSAGE_FROM_SRV.msg_bts)
+    assert message_to_general_channel.frame() is frame
+
+
+def test_cumulative_read_ack(connection_pool, message_pool):
+    bart = connection_pool.get_by_user_name('Bart')
+    msgs = message_pool.get_messages()
+    connection_pool.write_messages(bart, msgs)
+
+    read = connection_pool.pop_delivered(bart, CHANNEL, GENERAL, msgs[1].seq)
+    assert read == msgs[:2]
+    for msg in read:
+        message_pool.mark_received(msg, 'Bart')
+
+    unread = message_pool.get_messages(not_received_user='Bart', not_from_creator='Bart')
+    assert unread == msgs[2:]
+    assert connection_pool.pop_delivered(bart, CHANNEL, GENERAL, msgs[2].seq) == msgs[2:]
+    assert bart.delivered == {}
+
+
+def test_roster_versions_and_deltas():
+    roster = Roster(history=3)
+    roster.update('Homer', CHANNEL, GENERAL)
+    roster.update('Bart', CHANNEL, GENERAL)
+    frame = roster.snapshot_frame()
+    assert roster.snapshot_frame() is frame  # cached until a change
+
+    roster.update('Bart', PRIVATE, 'Lisa')
+    roster.update('Bart', PRIVATE, 'Lisa')  # not a change
+    assert roster.snapshot_frame() is not frame
+    assert roster.version == 3
+    assert roster.channels == [GENERAL]
+    assert roster.deltas_since(2) == [[Roster.CHAT, 'Bart', PRIVATE, 'Lisa']]
+    assert roster.deltas_since(3) == []
+
+    roster.remove('Homer')
+    assert roster.users == ['Bart']
+    assert roster.channels == []
+    assert roster.deltas_since(0) is None  # only 3 changes are kept
+    assert roster.delta_frame(0) is None
+    assert roster.delta_frame(1).startswith(InfoMsgStatuses.ROSTER_DELTA.msg_bts)
+
+
+def test_roster_copy_applies_deltas():
+    roster = Roster()
+    roster.update('Homer', CHANNEL, GENERAL)
+    copy = Roster()
+    copy.load(roster.snapshot())
+
+    roster.update('Bart', CHANNEL, GENERAL)
+    roster.update('Homer', PRIVATE, 'Bart')
+    roster.remove('Bart')
+    _, args = split_command(roster.delta_frame(1))
+    delta = json.loads(args)
+
+    assert not copy.apply_deltas(0, delta['version'], delta['deltas'])
+    assert copy.apply_deltas(delta['from'], delta['version'], delta['deltas'])
+    assert copy.snapshot() == roster.snapshot()
+
+
+def test_connection_pool_roster(connection_pool):
+    roster = connection_pool.roster
+    assert roster.users == ['Homer', 'Bart', 'Lisa']
+
+    bart = connection_pool.get_by_user_name('Bart')
+    connection_pool.change_chat(bart, PRIVATE, 'Lisa')
+    connection_pool.set_remote_user(1, 'Marge', CHANNEL, 'kitchen')
+    assert roster.chat_of('Bart') == (PRIVATE, 'Lisa')
+    assert connection_pool.get_all_channel_names() == [GENERAL, 'kitchen']
+
+    connection_pool.del_by_transport(bart.transport)
+    connection_pool.del_remote_worker(1)
+    assert connection_pool.get_all_user_names() == ['Homer', 'Lisa']
+    assert roster.version == 7
+
+
+def test_unread_scan_skips_read_messages(monkeypatch):
+    pool = MessagePool()
+    pool.add(MessageItem(uuid='old', dt=datetime.now(), creator='Homer',
+                         destination_type=CHANNEL, destination_name=GENERAL, message='old'))
+    for idx in range(100):
+        pool.add(MessageItem(uuid=str(idx), dt=datetime.now(), creator='Homer',
+                             destination_type=CHANNEL, destination_name=GENERAL,
+                             message=f'text{idx}', received_users=['Marge']))
+
+    scanned = []
+    iter_from = MessageBucket.iter_from
+
+    def counting_iter_from(bucket, seq=0):
+        for msg in iter_from(bucket, seq):
+            scanned.append(msg)
+            yield msg
+
+    monkeypatch.setattr(MessageBucket, 'iter_from', counting_iter_from)
+
+    def unread():
+        return pool.get_messages(CHANNEL, GENERAL, not_received_user='Marge',
+                                 not_from_creator='Marge')
+
+    assert [msg.message for msg in unread()] == ['old']
+    assert len(scanned) == 101
+
+    # The old unread message doesn't pin the scan, only the new messages are read
+    scanned.clear()
+    pool.add(MessageItem(uuid='new', dt=datetime.now(), creator='Homer',
+                         destination_type=CHANNEL, destination_name=GENERAL, message='new'))
+    assert [msg.message for msg in unread()] == ['old', 'new']
+    assert len(scanned) == 1
+
+    pool.mark_received(pool.get_message_by_uuid('old'), 'Marge')
+    assert [msg.message for msg in unread()] == ['new']
+    assert list(pool.skipped_history()) == [(CHANNEL, GENERAL, 'Marge',
+                                             pool.get_message_by_uuid('new').seq)]
@@ -0,0 +1,99 @@
+import asyncio
+
+import server
+from client import ChatClientProtocol, HistoryCache
+from services import CHANNEL, GENERAL, EOS, InfoMsgStatuses
+
+
+class RecordingClient(ChatClientProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    def message_received(self, msg: dict) -> None:
+        self.received.append(msg['message'])
+        super().message_received(msg)
+
+
+async def join(port: int, name: str, cache_dir) -> RecordingClient:
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_connection(
+        lambda: RecordingClient(loop.create_future(), loop.create_future(), cache_dir=cache_dir),
+        '127.0.0.1', port)
+    await client.name_offered
+    client.transport.write(client.name_frames(name))
+    await client.on_name_chosen
+    return client
+
+
+def test_history_cache(tmp_path):
+    cache = HistoryCache(str(tmp_path), 'Bart/Simpson', limit=2)
+    cache.start_epoch('e1')
+    for seq in (1, 3, 2, 3):  # the history may come after a newer message
+        cache.add((CHANNEL, GENERAL), {'seq': seq, 'creator': 'Homer', 'message': f'text{seq}'})
+    cache.save()
+
+    restored = HistoryCache(str(tmp_path), 'Bart/Simpson')
+    assert [msg['seq'] for msg in restored.messages((CHANNEL, GENERAL))] == [2, 3]
+    assert restored.resume_token('Bart')['chats'] == [[CHANNEL, GENERAL, 3]]
+
+    restored.start_epoch('e2')
+    assert restored.messages((CHANNEL, GENERAL)) == []
+
+
+def test_resume_sends_only_new_messages(tmp_path, chat_server):
+    async def chat():
+        async with chat_server() as port:
+            await resume(port)
+
+    async def resume(port):
+        async def post(texts):
+            for text in texts:
+                writer.write(f'message_from_client {text}'.encode() + EOS)
+            await writer.drain()
+            await asyncio.sleep(0.05)
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await reader.readline()
+        writer.write(b'resume_writer' + EOS)
+
+        alice = await join(port, 'resume_alice', tmp_path)
+        await post(['one', 'two', 'three'])
+        assert alice.received[-3:] == ['one', 'two', 'three']
+
+        # The link breaks before the read ack is sent
+        alice.read_ack_handle.cancel()
+        alice.transport.abort()
+        await asyncio.sleep(0.01)
+        await post(['four'])
+
+        alice = await join(port, 'resume_alice', tmp_path)
+        await asyncio.sleep(0.05)
+        assert alice.received == ['four']
+        unread = server.MSG_POOL.get_messages(CHANNEL, GENERAL, not_received_user='resume_alice',
+                                              not_from_creator='resume_alice')
+        assert [msg.message for msg in unread] == ['four']
+
+        alice.transport.close()
+        writer.close()
+
+    asyncio.run(chat())
+
+
+def test_malformed_resume_token(chat_server):
+    async def chat():
+        async with chat_server() as port:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            await reader.readline()
+
+            for frame in (b'resume', b'resume x', b'resume [1]', b'resume {"chats": [[1]]}'):
+                writer.write(frame + EOS)
+                assert await reader.readline() == b'The name can\'t start with `resume`\n'
+                assert await reader.readline() == InfoMsgStatuses.NAME_REJECTED.msg_bts + EOS
+
+            writer.write(b'resume {"user": "resume_bart", "epoch": "old", "chats": []}' + EOS)
+            writer.write(b'resume_bart' + EOS)
+            assert (await reader.readline()).startswith(InfoMsgStatuses.NAME_ACCEPTED.msg_bts)
+            writer.close()
+
+    asyncio.run(chat())
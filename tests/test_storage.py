@@ -0,0 +1,157 @@
+import asyncio
+import threading
+from datetime import datetime
+
+from services import (MessageItem, MessagePool, ConnectionPool, ConnectionItem,
+                      CHANNEL, GENERAL, PRIVATE)
+from storage import MessageLog, open_message_log, open_spill_store
+
+
+def fill_pool(path, message_pool) -> MessagePool:
+    msg_pool = MessagePool()
+    conn_pool = ConnectionPool()
+    log = open_message_log(str(path), msg_pool, conn_pool)
+
+    for msg in message_pool.get_messages(destination_type=None, destination_name=None):
+        msg_pool.add(msg)
+    msg_pool.mark_received(msg_pool.get_message_by_uuid('0'), 'Bart')
+
+    conn = ConnectionItem(transport=None, user_name='Bart')
+    conn.make_user_baned('Homer')
+    conn.make_user_baned('Lisa')
+    conn.make_user_baned('Marge')
+    conn_pool.ban(conn)
+
+    asyncio.run(log.flush())
+    return msg_pool
+
+
+def test_restore_message_log(tmp_path, message_pool):
+    filled = fill_pool(tmp_path, message_pool)
+
+    msg_pool = MessagePool()
+    conn_pool = ConnectionPool()
+    records_cnt, msgs_cnt = MessageLog(str(tmp_path)).restore(msg_pool, conn_pool)
+
+    assert (records_cnt, msgs_cnt) == (8, 5)
+    assert msg_pool.epoch == filled.epoch
+    assert msg_pool.get_message_by_uuid('0').received_users == ['Bart']
+    assert msg_pool.get_message_by_uuid('3').destination_type == PRIVATE
+    assert 'Bart' in conn_pool.bans
+
+
+def test_compact_message_log(tmp_path, message_pool):
+    msg_pool = fill_pool(tmp_path, message_pool)
+    log = MessageLog(str(tmp_path))
+    log.restore(MessagePool(), ConnectionPool())
+
+    asyncio.run(log.compact(msg_pool, ConnectionPool()))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['00000002.log',
+                                                                'snapshot-00000002.log']
+
+    restored = MessagePool()
+    MessageLog(str(tmp_path)).restore(restored, ConnectionPool())
+    assert restored.count == 5
+    assert restored.get_message_by_uuid('0').received_users == ['Bart']
+
+
+def test_restore_skips_broken_tail(tmp_path, message_pool):
+    fill_pool(tmp_path, message_pool)
+    with open(tmp_path / '00000001.log', 'ab') as f:
+        f.write(b'["m", 100, "broken')
+
+    msg_pool = MessagePool()
+    MessageLog(str(tmp_path)).restore(msg_pool, ConnectionPool())
+    assert msg_pool.count == 5
+
+
+def test_restore_skipped_history(tmp_path, message_pool):
+    msg_pool = fill_pool(tmp_path, message_pool)
+    msg_pool.skip_history(CHANNEL, GENERAL, 'Marge', 5)
+    asyncio.run(msg_pool.listeners[0].flush())
+
+    restored = MessagePool()
+    MessageLog(str(tmp_path)).restore(restored, ConnectionPool())
+    assert list(restored.skipped_history()) == [(CHANNEL, GENERAL, 'Marge', 5)]
+
+
+def test_spill_cold_messages(tmp_path):
+    msg_pool = MessagePool(memory_budget=10 * 600)
+    store = open_spill_store(str(tmp_path), msg_pool)
+    for idx in range(60):
+        msg_pool.add(MessageItem(
+            uuid=str(idx),
+            dt=datetime(year=2023, month=1, day=1, hour=0, minute=idx),
+            creator=('Homer', 'Lisa')[idx % 2],
+            destination_type=(CHANNEL, PRIVATE)[idx % 3 == 0],
+            destination_name=(GENERAL, 'Moe')[idx % 3 == 0],
+            message=f'text{idx}',
+        ))
+
+    assert msg_pool.resident_bytes <= msg_pool.memory_budget
+    assert msg_pool.resident_count + store.count == msg_pool.count == 60
+
+    # Unread queries and the history read the spilled messages back in order
+    unread = msg_pool.get_messages(CHANNEL, GENERAL, not_received_user='Bart',
+                                   not_from_creator='Bart')
+    assert [msg.seq for msg in unread] == [seq for seq in range(1, 61) if (seq - 1) % 3]
+    private = msg_pool.get_messages(PRIVATE, 'Moe', not_received_user='Moe',
+                                    creator='Homer', not_from_creator='Moe')
+    assert [msg.message for msg in private] == [f'text{idx}' for idx in range(0, 60, 6)]
+    assert [msg.seq for msg in msg_pool.history_page(CHANNEL, GENERAL, before=10, limit=3)] == \
+           [6, 8, 9]
+
+    # A receipt of a spilled message is kept in the store and expires it
+    msg_pool.mark_received(unread[0], 'Bart')
+    assert msg_pool.get_message_by_uuid('1').received_users == ['Bart']
+    assert msg_pool.get_messages(CHANNEL, GENERAL, not_received_user='Bart',
+                                 not_from_creator='Bart')[0].seq == 3
+    assert msg_pool.delete_delivered_messages() == 1
+    assert msg_pool.get_message_by_uuid('1') is None
+    assert len(list(msg_pool.all_messages())) == msg_pool.count == 59
+
+
+
+def test_spill_from_executor(tmp_path, monkeypatch):
+    msg_pool = MessagePool(memory_budget=10 * 600)
+    store = open_spill_store(str(tmp_path), msg_pool)
+    passes = []
+    spill = MessagePool.spill
+    monkeypatch.setattr(MessagePool, 'spill', lambda pool: passes.append(1) or spill(pool))
+    written = threading.Event()
+    put = store.put
+    monkeypatch.setattr(store, 'put', lambda msgs: written.wait(5) and put(msgs))
+
+    def message(idx: int, **kwargs) -> MessageItem:
+        return MessageItem(uuid=str(idx), dt=datetime(year=2023, month=1, day=1, minute=idx),
+                           creator='Homer', destination_type=CHANNEL, destination_name=GENERAL,
+                           message=f'text{idx}', **kwargs)
+
+    def unread():
+        return [msg.uuid for msg in msg_pool.get_messages(not_received_user='Lisa',
+                                                          not_from_creator='Lisa')]
+
+    async def fill():
+        # Received messages are never spilled, so no pass is started for them
+        for idx in range(30):
+            msg_pool.add(message(idx, received_users=['Bart']))
+        assert passes == [] and msg_pool.resident_count == 30
+
+        # One pass at a time, the messages stay in memory until they are written
+        for idx in range(30, 60):
+            msg_pool.add(message(idx))
+        assert len(passes) == 1 and msg_pool.resident_count == 60
+        msg_pool.mark_received(msg_pool.get_message_by_uuid('30'), 'Lisa')
+
+        written.set()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if msg_pool.spilled_total == 29 and store.count == 29:
+                break
+
+    asyncio.run(fill())
+    # The message received during the write stays resident, its stored copy is deleted
+    assert store.count == 29 and msg_pool.resident_count == 31
+    assert msg_pool.get_message_by_uuid('30').received_users == ['Lisa']
+    assert unread() == [str(idx) for idx in range(60) if idx != 30]
+    store.close()